@@ -1,5 +1,5 @@
 import numpy as np
-import os,sys,h5py
+import os,sys,re,h5py
 import scipy.io as sio
 from scipy.linalg import solve_sylvester
 import pickle as pkl
@@ -8,152 +8,215 @@ import torch
 from torchvision import datasets, transforms
 
 import utils
+from structure.layer import StructuredLinear
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
 
-def get_dataset(dataset_name, data_dir, transform):
-    """
-    Get paths of datasets.
-    """
-    if dataset_name == 'mnist':
-        train_loc = os.path.join(data_dir, 'mnist/train_normalized')
-        test_loc = os.path.join(data_dir, 'mnist/test_normalized')
-    elif dataset_name == 'cifar10':
-        train_loc = os.path.join(data_dir, 'cifar10_combined/train')
-        test_loc = os.path.join(data_dir, 'cifar10_combined/test')
-    elif dataset_name == 'cifar10mono':
-        train_loc = os.path.join(data_dir, 'cifar10_combined/train_grayscale')
-        test_loc = os.path.join(data_dir, 'cifar10_combined/test_grayscale')
-    elif dataset_name.startswith('mnist_noise'):
-        idx = dataset_name[-1]
-        train_loc = os.path.join(data_dir,'mnist_noise/train_' + str(idx))
-        test_loc = os.path.join(data_dir,'mnist_noise/test_' + str(idx))
-    elif dataset_name == 'norb':
-        train_loc = os.path.join(data_dir,'norb_full/processed_py2_train_32.pkl')
-        test_loc = os.path.join(data_dir,'norb_full/processed_py2_test_32.pkl')
-    elif dataset_name == 'rect_images': #TODO
-        train_loc = os.path.join(data_dir, 'rect_images/rectangles_im_train.amat')
-        test_loc = os.path.join(data_dir, 'rect_images/rectangles_im_test.amat')
-    elif dataset_name == 'rect':
-        train_loc = os.path.join(data_dir,'rect/train_normalized')
-        test_loc = os.path.join(data_dir, 'rect/test_normalized')
-    elif dataset_name == 'convex':
-        train_loc = os.path.join(data_dir, 'convex/train_normalized')
-        test_loc = os.path.join(data_dir, 'convex/test_normalized')
-    elif dataset_name == 'mnist_rand_bg': #TODO
-        train_loc = os.path.join(data_dir, 'mnist_rand_bg/mnist_background_random_train.amat')
-        test_loc = os.path.join(data_dir, 'mnist_rand_bg/mnist_background_random_test.amat')
-    elif dataset_name == 'mnist_bg_rot':
-        train_loc = os.path.join(data_dir, 'mnist_bg_rot/train_normalized')
-        test_loc = os.path.join(data_dir, 'mnist_bg_rot/test_normalized')
-    elif dataset_name == 'mnist_bg_rot_swap':
-        train_loc = os.path.join(data_dir, 'mnist_bg_rot/test_normalized')
-        test_loc = os.path.join(data_dir, 'mnist_bg_rot/train_normalized')
-    #TODO handle iwslt, copy tasks
-    # TODO smallnorb, timit
-    else:
-        print('dataset.py: unknown dataset name')
-
-    # TODO maybe want the .amat if that's standard and do postprocessing in a uniform way instead of having a separate script per dataset
-    train_data = pkl.load(open(train_loc, 'rb'))
-    train_X = train_data['X']
-    train_Y = train_data['Y']
-    test_data = pkl.load(open(test_loc, 'rb'))
-    test_X = test_data['X']
-    test_Y = test_data['Y']
+class DatasetSpec:
+    """
+    Where and how a dataset is stored.
 
-    train_X, train_Y = postprocess(transform, train_X, train_Y)
-    test_X, test_Y = postprocess(transform, test_X, test_Y)
+    train, test: locations of the splits, relative to the data directory.
+    format: 'pkl' for a pickled dict {'X', 'Y'} at the location (converted to .npy on first use),
+        'npy' for the files loc + '_X.npy', loc + '_Y.npy' written by a streaming preprocessing script.
+    shape: shape of one example, e.g. (28, 28) for MNIST-like images; None if not an image.
+    transforms: the shape-dependent transforms that apply to this dataset, e.g. 'pad'.
+    """
+    def __init__(self, train, test, format='pkl', shape=None, transforms=()):
+        self.train = train
+        self.test = test
+        self.format = format
+        self.shape = shape
+        self.transforms = transforms
+
+
+dataset_specs = {}
+
+def register(name, spec):
+    dataset_specs[name] = spec
+
+def get_spec(dataset_name):
+    if dataset_name not in dataset_specs:
+        raise ValueError('Unknown dataset "{}", known datasets: {}'.format(dataset_name, ', '.join(sorted(dataset_specs))))
+    return dataset_specs[dataset_name]
+
+
+mnist_transforms = ('pad',)
+register('mnist', DatasetSpec('mnist/train_normalized', 'mnist/test_normalized', shape=(28, 28), transforms=mnist_transforms))
+register('cifar10', DatasetSpec('cifar10_combined/train', 'cifar10_combined/test', shape=(3, 32, 32)))
+register('cifar10mono', DatasetSpec('cifar10_combined/train_grayscale', 'cifar10_combined/test_grayscale', shape=(32, 32)))
+for idx in range(1, 7):
+    spec = DatasetSpec('mnist_noise/train_' + str(idx), 'mnist_noise/test_' + str(idx), shape=(28, 28), transforms=mnist_transforms)
+    register('mnist_noise_' + str(idx), spec)
+    register('mnist_noise' + str(idx), spec)
+register('norb', DatasetSpec('norb_full/processed_py2_train_32.pkl', 'norb_full/processed_py2_test_32.pkl', format='npy',
+                             shape=(32, 32)))
+register('rect', DatasetSpec('rect/train_normalized', 'rect/test_normalized', shape=(28, 28), transforms=mnist_transforms))
+register('convex', DatasetSpec('convex/train_normalized', 'convex/test_normalized', shape=(28, 28), transforms=mnist_transforms))
+register('mnist_bg_rot', DatasetSpec('mnist_bg_rot/train_normalized', 'mnist_bg_rot/test_normalized', shape=(28, 28),
+                                     transforms=mnist_transforms))
+register('mnist_bg_rot_swap', DatasetSpec('mnist_bg_rot/test_normalized', 'mnist_bg_rot/train_normalized', shape=(28, 28),
+                                          transforms=mnist_transforms))
+register('timit', DatasetSpec('timit/timit_train_top25', 'timit/timit_test_top25', format='npy'))
+# TODO rect_images, mnist_rand_bg (from the .amat), smallnorb, iwslt, copy tasks
+
+
+def get_split(dataset_name, data_dir, split, transform):
+    """
+    Load split ('train' or 'test') of a registered dataset as torch tensors backed by memory maps.
+    """
+    spec = get_spec(dataset_name)
+    for t in ('pad',):
+        if t in transform:
+            assert t in spec.transforms, 'transform {} does not apply to dataset {}'.format(t, dataset_name)
+    X, Y = load_arrays(os.path.join(data_dir, getattr(spec, split)), transform, spec.format)
+    print(split + " dataset size: ", X.shape[0])
+    return torch.from_numpy(X), torch.from_numpy(Y)
 
-    in_size = train_X.shape[1]
-    out_size = train_Y.shape[1]
 
-    print("Train dataset size: ", train_X.shape[0])
-    print("Test dataset size: ", test_X.shape[0])
-    print("In size: ", in_size)
-    print("Out size: ", out_size)
+def _save_npy(path, array):
+    # Write to a temporary file and rename, so that concurrent readers never see a partial file
+    tmp_path = path + '.tmp' + str(os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
 
-    return torch.FloatTensor(train_X), torch.FloatTensor(train_Y), torch.FloatTensor(test_X), torch.FloatTensor(test_Y), in_size, out_size
 
-def split_train_val(train_X, train_Y, val_fraction, train_fraction=None):
+def load_arrays(loc, transform, format='pkl'):
     """
-    Input: training data as a torch.Tensor
+    Load the arrays X, Y of the dataset at loc as float32 memory maps.
+    The first call converts the pickle to .npy files next to it; every later
+    call (from any process) maps those files instead of unpickling its own
+    copy, so concurrent runs share a single copy of the data through the page
+    cache. Maps are copy-on-write: in-place changes stay private to the process.
+    Transformed variants (e.g. 'pad') are cached the same way, so they are
+    only computed once.
     """
-    # Shuffle
-    idx = np.arange(train_X.shape[0])
-    np.random.shuffle(idx)
-    train_X = train_X[idx,:]
-    train_Y = train_Y[idx,:]
+    # Only deterministic transforms are cached; 'randomize' is applied on top
+    cached_transform = 'pad' if 'pad' in transform else ''
+    paths = [loc + '_' + cached_transform + name + '.npy' for name in ('X', 'Y')]
+    if not all(os.path.exists(path) for path in paths):
+        if format == 'pkl':
+            data = pkl.load(open(loc, 'rb'))
+        else:  # Written directly as .npy by a streaming preprocessing script, e.g. scripts/data/preprocess_norb.py
+            data = {name: np.load(loc + '_' + name + '.npy', mmap_mode='r') for name in ('X', 'Y')}
+        X, Y = postprocess(cached_transform, data['X'], data['Y'])
+        for path, array in zip(paths, (X, Y)):
+            _save_npy(path, np.asarray(array, dtype=np.float32))
+        del data, X, Y
+    X, Y = (np.load(path, mmap_mode='c') for path in paths)
+    if 'randomize' in transform:
+        Y = np.array(Y)
+        X, Y = postprocess('randomize', X, Y)
+    return X, Y
+
 
+def split_train_val(num_examples, val_fraction, train_fraction=None):
+    """
+    Random split of range(num_examples) into training and validation indices.
+    Only the indices are materialized, the data is not copied.
+    """
     # Compute validation set size
-    val_size = int(val_fraction*train_X.shape[0])
+    val_size = int(val_fraction*num_examples)
 
     # Downsample for sample complexity experiments
     if train_fraction is not None:
-        train_size = int(train_fraction*train_X.shape[0])
-        assert val_size + train_size <= train_X.shape[0]
+        train_size = int(train_fraction*num_examples)
+        assert val_size + train_size <= num_examples
     else:
-        train_size = train_X.shape[0] - val_size
+        train_size = num_examples - val_size
 
-    # Shuffle X
-    idx = np.arange(0, train_X.shape[0])
+    # Shuffle
+    idx = np.arange(0, num_examples)
     np.random.shuffle(idx)
 
     train_idx = idx[0:train_size]
     val_idx = idx[-val_size:]
-    val_X = train_X[val_idx, :]
-    val_Y = train_Y[val_idx, :]
-    train_X = train_X[train_idx, :]
-    train_Y = train_Y[train_idx, :]
 
-    print('train_X: ', train_X.shape)
-    print('train_Y: ', train_Y.shape)
-    print('val_X: ', val_X.shape)
-    print('val_Y: ', val_Y.shape)
+    print('train size: ', train_idx.shape)
+    print('val size: ', val_idx.shape)
 
+    return train_idx, val_idx
 
-    return train_X, train_Y, val_X, val_Y
-
-
-
-def create_data_loaders(dataset_name, data_dir, transform, train_fraction, val_fraction, batch_size):
-    if device.type == 'cuda':
-        loader_args = {'num_workers': 16, 'pin_memory': True}
-    else:
-        loader_args = {'num_workers': 4, 'pin_memory': False}
-
-    train_X, train_Y, test_X, test_Y, in_size, out_size = get_dataset(dataset_name, data_dir, transform) # train/test data, input/output size
-    # train_X, train_Y = postprocess(transform, train_X, train_Y)
-    # test_X, test_Y = postprocess(transform, test_X, test_Y)
-
-    # TODO: use torch.utils.data.random_split instead
-    # however, this requires creating the dataset, then splitting, then applying transformations
-    train_X, train_Y, val_X, val_Y = split_train_val(train_X, train_Y, val_fraction, train_fraction)
-
-
-    # TODO: use pytorch transforms to postprocess
-
-    train_dataset = torch.utils.data.TensorDataset(train_X, train_Y)
-    val_dataset = torch.utils.data.TensorDataset(val_X, val_Y)
-    test_dataset = torch.utils.data.TensorDataset(test_X, test_Y)
-    # create dataloaders
-    train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=batch_size, shuffle=True, **loader_args)
-    val_loader = torch.utils.data.DataLoader(val_dataset, batch_size=batch_size, shuffle=True, **loader_args)
-    test_loader = torch.utils.data.DataLoader(test_dataset, batch_size=batch_size, shuffle=True, **loader_args)
-
-    return train_loader, val_loader, test_loader, in_size, out_size
 
 
 class DatasetLoaders:
+    """
+    Train, validation and test loaders of a dataset. The test split is only
+    loaded the first time test_loader is accessed.
+    Names starting with 'true' are synthetic regression tasks, see synthetic_target.
+    """
     def __init__(self, name, data_dir, val_fraction, transform=None, train_fraction=None, batch_size=50):
-        if name.startswith('true'):
-            # TODO: Add support for synthetic datasets back. Possibly should be split into separate class
-            self.loss = utils.mse_loss
+        self.name = name
+        self.data_dir = data_dir
+        self.transform = transform if transform is not None else 'none'
+        self.batch_size = batch_size
+        if device.type == 'cuda':
+            self.loader_args = {'num_workers': 16, 'pin_memory': True}
         else:
-            self.train_loader, self.val_loader, self.test_loader, self.in_size, self.out_size = create_data_loaders(name,
-                data_dir, transform, train_fraction, val_fraction, batch_size)
-            self.loss = utils.cross_entropy_loss
+            self.loader_args = {'num_workers': 4, 'pin_memory': False}
+        self._test_loader = None
+        if name.startswith('true'):
+            self._init_synthetic(val_fraction, train_fraction)
+            return
+
+        train_X, train_Y = get_split(name, data_dir, 'train', self.transform)
+        self.in_size = train_X.shape[1]
+        self.out_size = train_Y.shape[1]
+        print("In size: ", self.in_size)
+        print("Out size: ", self.out_size)
+
+        # TODO: use torch.utils.data.random_split instead
+        # however, this requires creating the dataset, then splitting, then applying transformations
+        train_idx, val_idx = split_train_val(train_X.shape[0], val_fraction, train_fraction)
+        self.train_idx, self.val_idx = train_idx, val_idx
+
+        # TODO: use pytorch transforms to postprocess
+
+        full_train_dataset = torch.utils.data.TensorDataset(train_X, train_Y)
+        train_dataset = torch.utils.data.Subset(full_train_dataset, train_idx)
+        val_dataset = torch.utils.data.Subset(full_train_dataset, val_idx)
+        augment = [name for name in augmentations if name in self.transform]
+        collate_fn = None
+        if augment:
+            shape = (32, 32) if 'pad' in self.transform else get_spec(name).shape
+            train_dataset = AugmentedDataset(train_dataset, len(augment))
+            collate_fn = AugmentBatch(augment, shape, offset=2 if 'pad' in self.transform else 0)
+        # create dataloaders
+        self.train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=batch_size, shuffle=True,
+                                                        collate_fn=collate_fn, **self.loader_args)
+        self.val_loader = torch.utils.data.DataLoader(val_dataset, batch_size=batch_size, shuffle=True, **self.loader_args)
+        self.loss = utils.cross_entropy_loss
+
+    def _init_synthetic(self, val_fraction, train_fraction):
+        self.target = synthetic_target(self.name)
+        self.collate_fn = SyntheticBatch(self.target)
+        self.in_size = self.out_size = self.target.layer_size
+        print("In size: ", self.in_size)
+        print("Out size: ", self.out_size)
+
+        full_train_dataset = SyntheticDataset(SYNTHETIC_TRAIN_SIZE, seed=0)
+        train_idx, val_idx = split_train_val(len(full_train_dataset), val_fraction, train_fraction)
+        self.train_idx, self.val_idx = train_idx, val_idx
+        self.train_loader, self.val_loader = (
+            torch.utils.data.DataLoader(torch.utils.data.Subset(full_train_dataset, idx), batch_size=self.batch_size,
+                                        shuffle=True, collate_fn=self.collate_fn, **self.loader_args)
+            for idx in (train_idx, val_idx))
+        self.loss = utils.mse_loss
+
+    @property
+    def test_loader(self):
+        if self._test_loader is None and self.name.startswith('true'):
+            self._test_loader = torch.utils.data.DataLoader(SyntheticDataset(SYNTHETIC_TEST_SIZE, seed=1),
+                                                            batch_size=self.batch_size, shuffle=True,
+                                                            collate_fn=self.collate_fn, **self.loader_args)
+        if self._test_loader is None:
+            test_X, test_Y = get_split(self.name, self.data_dir, 'test', self.transform)
+            test_dataset = torch.utils.data.TensorDataset(test_X, test_Y)
+            self._test_loader = torch.utils.data.DataLoader(test_dataset, batch_size=self.batch_size, shuffle=True,
+                                                            **self.loader_args)
+        return self._test_loader
 
 
 
@@ -171,38 +234,136 @@ def postprocess(transform, X, Y=None):
         np.random.shuffle(Y)
     return X, Y
 
-def augment(self, X, Y=None):
-    if 'contrast' in self.transform:
-        def scale_patch(X):
-            patch = ((9, 19), (9, 19))
-            X_ = X.copy()
-            X_[:, patch[0][0]:patch[0][1], patch[1][0]:patch[1][1]] *= 2
-            return X_
-        # subsample
-        idx = np.arange(X.shape[0])
-        np.random.shuffle(idx)
-        X = X[idx,...]
-        Y = Y[idx,...]
-
-        X1 = X.reshape((-1,28,28))
-        X2 = scale_patch(X1)
-        X3 = scale_patch(X2)
-        X4 = scale_patch(X3)
-        # X5 = scale_patch(X4)
-        X = np.concatenate([X1, X2, X3, X4], axis=0).reshape(-1, 28*28)
-        Y = np.concatenate([Y, Y, Y, Y], axis=0)
-
-    if 'patch' in self.transform:
-        def add_patch(X):
-            patch = ((0, 4), (10, 18))
-            X_ = X.copy()
-            X_[:, patch[0][0]:patch[0][1], patch[1][0]:patch[1][1]] += 3.0
-            return X_
-        X1 = X.reshape((-1,28,28))
-        X2 = add_patch(X1)
-        X3 = add_patch(X2)
-        X4 = add_patch(X3)
-        X = np.concatenate([X1, X2, X3, X4], axis=0).reshape(-1, 28*28)
-        Y = np.concatenate([Y, Y, Y, Y], axis=0)
 
-    return X, Y
+### On-the-fly augmentations, applied to batches of the training set by its loader
+# Each augmentation modifies a patch (rows, cols) of 28x28 images. The training set is
+# extended with AUGMENT_LEVELS versions of every example: level k scales the patch by 2^k
+# ('contrast') or adds 3k to it ('patch'). Only the level of each example is stored,
+# the augmented images are computed per batch.
+AUGMENT_LEVELS = 4
+augmentations = {
+    'contrast': (((9, 19), (9, 19)), lambda patch, level: patch * 2.0**level),
+    'patch': (((0, 4), (10, 18)), lambda patch, level: patch + 3.0*level),
+}
+
+
+class AugmentedDataset(torch.utils.data.Dataset):
+    """
+    dataset repeated AUGMENT_LEVELS**num_augmentations times; items are (x, y, code)
+    where code encodes the level of each augmentation in base AUGMENT_LEVELS.
+    """
+    def __init__(self, dataset, num_augmentations):
+        self.dataset = dataset
+        self.copies = AUGMENT_LEVELS**num_augmentations
+
+    def __len__(self):
+        return self.copies * len(self.dataset)
+
+    def __getitem__(self, i):
+        x, y = self.dataset[i % len(self.dataset)]
+        return x, y, i // len(self.dataset)
+
+
+class AugmentBatch:
+    """
+    Collate function for AugmentedDataset: stacks the batch and applies the augmentations
+    to all examples at once. offset shifts the patches, e.g. by 2 for images padded to 32x32.
+    """
+    def __init__(self, names, shape, offset=0):
+        assert len(shape) == 2, 'augmentations need 2D images'
+        self.names = names
+        self.shape = shape
+        self.offset = offset
+
+    def __call__(self, batch):
+        X, Y, code = torch.utils.data.dataloader.default_collate(batch)
+        X = X.view(-1, *self.shape).clone()
+        for i, name in enumerate(self.names):
+            (r0, r1), (c0, c1) = (tuple(x + self.offset for x in p) for p in augmentations[name][0])
+            level = ((code // AUGMENT_LEVELS**i) % AUGMENT_LEVELS).to(X.dtype).view(-1, 1, 1)
+            X[:, r0:r1, c0:c1] = augmentations[name][1](X[:, r0:r1, c0:c1], level)
+        return X.view(X.shape[0], -1), Y
+
+
+### Synthetic regression tasks: learn the map x -> x W of a random structured matrix W
+# The targets are computed per batch by the fast multiplication of a structured layer, so
+# neither W nor the examples are ever stored.
+SYNTHETIC_TRAIN_SIZE = 60000
+SYNTHETIC_TEST_SIZE = 10000
+
+
+def synthetic_target(name):
+    """
+    Random structured layer (without bias) for the dataset name 'true_{class_type}[_n{size}][_r{rank}]',
+    e.g. true_toeplitz or true_subdiagonal_n256_r4; class_type is any class of structure.layer.
+    The generators G, H are random and the other parameters (operators) keep their initialization.
+    Defaults: size 1024, rank 2.
+    """
+    match = re.match(r'^true_(.+?)(?:_n(\d+))?(?:_r(\d+))?$', name)
+    assert match is not None, 'synthetic dataset names are true_{class_type}[_n{size}][_r{rank}], got ' + name
+    class_type, n, r = match.group(1), int(match.group(2) or 1024), int(match.group(3) or 2)
+    # The target is fixed by the name, whatever the global random state
+    with torch.random.fork_rng(devices=[]):
+        torch.manual_seed(0)
+        target = StructuredLinear(class_type, layer_size=n, r=r, bias=False)
+    return target.requires_grad_(False)
+
+
+class SyntheticDataset(torch.utils.data.Dataset):
+    """
+    size examples x ~ N(0, I); items are only indices, the collate function SyntheticBatch
+    draws the inputs and computes their targets. Example i is the same in every epoch.
+    """
+    def __init__(self, size, seed):
+        self.size = size
+        self.seed = seed
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        return self.seed, i
+
+
+def _hash32(x):
+    """Elementwise integer hash (lowbias32) of an int32 tensor, in place.
+    The multiplications wrap around; the masks make the shifts logical.
+    """
+    x ^= (x >> 16) & 0xffff
+    x *= 0x7feb352d
+    x ^= (x >> 15) & 0x1ffff
+    x *= 0x846ca68b - 2**32
+    x ^= (x >> 16) & 0xffff
+    return x
+
+
+def counter_randn(seed, idx, n):
+    """
+    (len(idx), n) standard normal samples whose row k only depends on (seed, idx[k]).
+    Counter-based: each pair of samples is the Box-Muller transform of two hashes of
+    (seed, index, coordinate), so a whole batch of indices is drawn at once, in any order.
+    """
+    key = _hash32(_hash32(torch.as_tensor(idx, dtype=torch.int32) ^ _hash32(torch.tensor(seed, dtype=torch.int32))))
+    m = (n + 1) // 2
+    # The coordinates are hashed before they are combined with the keys: keys differing only in their low
+    # bits would otherwise give rows that are permutations of each other
+    counter = _hash32(torch.arange(2*m, dtype=torch.int32))
+    # 24 bit uniforms in (0, 1)
+    u = (((_hash32(key[:, None] ^ counter) >> 8) & 0xffffff).float() + 0.5) / 2**24
+    radius, angle = torch.sqrt(-2*torch.log(u[:, :m])), 2*np.pi*u[:, m:]
+    return torch.cat((radius*torch.cos(angle), radius*torch.sin(angle)), 1)[:, :n]
+
+
+class SyntheticBatch:
+    """
+    Collate function for SyntheticDataset: (X, X W) for the structured layer target.
+    """
+    def __init__(self, target):
+        self.target = target
+
+    def __call__(self, batch):
+        seeds, idx = zip(*batch)
+        # All the items of a batch come from one SyntheticDataset, with one seed
+        X = counter_randn(seeds[0], idx, self.target.layer_size)
+        with torch.no_grad():
+            return X, self.target(X)
@@ -5,25 +5,42 @@ Some parts modified from https://github.com/jihunchoi/recurrent-batch-normalizat
 import torch
 from torch import nn
 from torch.nn import init
-from torch.autograd import Variable
 import sys
 sys.path.insert(0, '../../../pytorch/')
 import structure.layer as sl
 
+
+def lstm_gates_eager(gates, c_0):
+    """Pointwise part of an LSTM step: gates = W_ih x + W_hh h + b, split as (f, i, o, g)."""
+    f, i, o, g = gates.chunk(4, 1)
+    c_1 = torch.sigmoid(f)*c_0 + torch.sigmoid(i)*torch.tanh(g)
+    h_1 = torch.sigmoid(o) * torch.tanh(c_1)
+    return h_1, c_1
+
+# Fused into one kernel on GPU. TorchScript does not fuse on CPU, where the scripted
+# backward is slower than the eager one, so CPU steps use lstm_gates_eager.
+lstm_gates = torch.jit.script(lstm_gates_eager)
+
+
 class LSTMCell(nn.Module):
-    def __init__(self, class_type, r, input_size, hidden_size, use_bias=True):
+    def __init__(self, class_type, r, input_size, hidden_size, use_bias=True, hh_class_type=None):
         super(LSTMCell, self).__init__()
         self.input_size = input_size
         self.hidden_size = hidden_size
         self.use_bias = use_bias
         self.class_type = class_type
+        self.hh_class_type = hh_class_type
         self.r = r
 
         # Replace W_ih with structured matrices
-        self.W_ih = sl.StructuredLinear(class_type, layer_size=4*hidden_size, r=r, bias=False)
+        self.W_ih = self._structured(class_type, input_size, 'pad')
 
-        self.W_hh = nn.Parameter(
-            torch.FloatTensor(hidden_size, 4 * hidden_size))
+        # W_hh is dense unless a structured class is given for it as well
+        if hh_class_type is None:
+            self.W_hh = nn.Parameter(
+                torch.FloatTensor(hidden_size, 4 * hidden_size))
+        else:
+            self.W_hh = self._structured(hh_class_type, hidden_size, 'hh_pad')
         if use_bias:
             self.bias = nn.Parameter(torch.FloatTensor(4 * hidden_size))
         else:
@@ -31,31 +48,63 @@ class LSTMCell(nn.Module):
         self.reset_parameters()
 
     def reset_parameters(self):
-        W_hh_data = torch.eye(self.hidden_size).repeat(1,4)
-        self.W_hh.data.set_(W_hh_data)
+        if self.hh_class_type is None:
+            W_hh_data = torch.eye(self.hidden_size).repeat(1,4)
+            self.W_hh.data.copy_(W_hh_data)
         if self.use_bias:
-            init.constant(self.bias.data, val=0)
+            init.constant_(self.bias.data, val=0)
 
-    def forward(self, input_, hx):
+    def _structured(self, class_type, in_size, pad_name):
+        """Structured in_size -> 4*hidden_size map. Classes that support
+        rectangular matrices are used as is; the others are square of size
+        4*hidden_size and their input is zero padded through the buffer pad_name.
+        """
+        if sl.class_map[class_type].rectangular:
+            self.register_buffer(pad_name, None)
+            return sl.StructuredLinear(class_type, layer_size=in_size,
+                                       hidden_size=4*self.hidden_size, r=self.r, bias=False)
+        # Zero padding, grown on demand and reused across calls
+        self.register_buffer(pad_name, torch.zeros(0, 4*self.hidden_size - in_size), persistent=False)
+        return sl.StructuredLinear(class_type, layer_size=4*self.hidden_size, r=self.r, bias=False)
+
+    def _pad(self, x, name):
+        """Concatenate x with the zero buffer `name`, growing the buffer if needed."""
+        pad = getattr(self, name)
+        if pad is None:
+            return x
+        if pad.size(0) < x.size(0):
+            pad = x.new_zeros(x.size(0), pad.size(1))
+            setattr(self, name, pad)
+        return torch.cat((x, pad[:x.size(0)]), dim=1)
+
+    def input_projection(self, input_):
+        """Apply W_ih and the bias to all rows of input_ at once.
+        input_: (..., input_size)
+        out: (..., 4*hidden_size)
+        """
+        shape = input_.shape[:-1]
+        x = self._pad(input_.reshape(-1, self.input_size), 'pad')
+        wi = self.W_ih(x)
+        if self.bias is not None:
+            wi = wi + self.bias
+        return wi.view(*shape, 4*self.hidden_size)
+
+    def recurrence(self, wi, hx):
+        """One LSTM step given the precomputed input projection wi = W_ih(input_) + bias."""
         h_0, c_0 = hx
-        h_0 = h_0.squeeze()
-        c_0 = c_0.squeeze()
-        batch_size = h_0.size(0)
-        bias_batch = (self.bias.unsqueeze(0)
-                      .expand(batch_size, *self.bias.size()))
-        wh_b = torch.addmm(bias_batch, h_0, self.W_hh)
-        z = torch.zeros(input_.size(0),3*self.hidden_size).cuda()
-        input_padded = torch.cat((input_, z), dim=1)
-        wi = self.W_ih(input_padded)
-
-        f, i, o, g = torch.split(wh_b + wi,
-                                 split_size_or_sections=self.hidden_size, dim=1)
-        c_1 = torch.sigmoid(f)*c_0 + torch.sigmoid(i)*torch.tanh(g)
-        h_1 = torch.sigmoid(o) * torch.tanh(c_1)
-        return h_1, c_1
+        h_0 = h_0.view(-1, self.hidden_size)
+        c_0 = c_0.view(-1, self.hidden_size)
+        if self.hh_class_type is None:
+            gates = torch.addmm(wi, h_0, self.W_hh)
+        else:
+            gates = wi + self.W_hh(self._pad(h_0, 'hh_pad'))
+        return (lstm_gates if gates.is_cuda else lstm_gates_eager)(gates, c_0)
+
+    def forward(self, input_, hx):
+        return self.recurrence(self.input_projection(input_), hx)
 
 class SingleLayerLSTM(nn.Module):
-    def __init__(self, class_type, r, input_size, hidden_size,use_bias=True,dropout=0):
+    def __init__(self, class_type, r, input_size, hidden_size,use_bias=True,dropout=0,hh_class_type=None):
         super(SingleLayerLSTM, self).__init__()
         self.input_size = input_size
         self.hidden_size = hidden_size
@@ -64,7 +113,7 @@ class SingleLayerLSTM(nn.Module):
 
         # Initialize LSTMCell
         self.cell = LSTMCell(class_type=class_type, r=r, input_size=input_size,
-                              hidden_size=hidden_size, use_bias=use_bias)
+                              hidden_size=hidden_size, use_bias=use_bias, hh_class_type=hh_class_type)
         self.dropout_layer = nn.Dropout(dropout)
         self.reset_parameters()
 
@@ -73,27 +122,37 @@ class SingleLayerLSTM(nn.Module):
 
     @staticmethod
     def _forward_rnn(cell, input_, length, hx):
-        max_time = input_.size(0)
-        output = []
+        """
+        length: None if every sequence spans the full max_time, else LongTensor of shape (batch, )
+        """
+        max_time, batch_size = input_.size(0), input_.size(1)
+        # Project the whole sequence as a single (time*batch, n) multiply
+        wi = cell.input_projection(input_)
+        if length is not None:
+            # Build all masks up front instead of one per step
+            steps = torch.arange(max_time, device=length.device).unsqueeze(1)
+            masks = (steps < length).float().unsqueeze(2)
+        h, c = hx[0].view(batch_size, -1), hx[1].view(batch_size, -1)
+        # Write states into a preallocated buffer when not recording autograd; with
+        # autograd, stacking at the end avoids a CopySlices node per step
+        if torch.is_grad_enabled():
+            output = [None] * max_time
+        else:
+            output = wi.new_empty(max_time, batch_size, cell.hidden_size)
         for time in range(max_time):
-            h_next, c_next = cell(input_=input_[time], hx=hx)
-            mask = (time < length).float().unsqueeze(1).expand_as(h_next)
-            h_next = h_next*mask + hx[0]*(1 - mask)
-            c_next = c_next*mask + hx[1]*(1 - mask)
-            hx_next = (h_next, c_next)
-            output.append(h_next)
-            hx = hx_next
-        output = torch.stack(output, 0)
-        return output, hx
-
-    def forward(self, input_, hx):
-        max_time, batch_size, _ = input_.size()
-        length = Variable(torch.LongTensor([max_time] * batch_size))
-        if input_.is_cuda:
-            device = input_.get_device()
-            length = length.cuda(device)
+            h_next, c_next = cell.recurrence(wi[time], hx=(h, c))
+            if length is not None:
+                mask = masks[time]
+                h_next = h_next*mask + h*(1 - mask)
+                c_next = c_next*mask + c*(1 - mask)
+            output[time] = h_next
+            h, c = h_next, c_next
+        if isinstance(output, list):
+            output = torch.stack(output, 0)
+        return output, (h, c)
 
+    def forward(self, input_, hx, length=None):
         output, (h_n, c_n) = SingleLayerLSTM._forward_rnn(
                 cell=self.cell, input_=input_, length=length, hx=hx)
         input_ = self.dropout_layer(output)
-        return output, (h_n, c_n)
\ No newline at end of file
+        return output, (h_n, c_n)
@@ -20,6 +20,8 @@ parser.add_argument('--class_type', type=str, default='unconstrained',
                     help='structured class')
 parser.add_argument('--r', type=int, default=1,
                     help='displacement rank')
+parser.add_argument('--hh_class_type', type=str, default=None,
+                    help='structured class of the recurrent matrix W_hh (dense if not given)')
 parser.add_argument('--data', type=str, default='./data/wikitext-2',
                     help='location of the data corpus')
 parser.add_argument('--model', type=str, default='LSTM',
@@ -106,7 +108,8 @@ if not os.path.exists(out_dir):
 ###############################################################################
 
 ntokens = len(corpus.dictionary)
-model = model.RNNModel(args.class_type, args.r, args.model, ntokens, args.emsize, args.nhid, args.nlayers, args.dropout, args.tied).to(device)
+model = model.RNNModel(args.class_type, args.r, args.model, ntokens, args.emsize, args.nhid, args.nlayers, args.dropout, args.tied,
+                       args.hh_class_type).to(device)
 
 # Print params
 for name, param in model.named_parameters():
@@ -164,6 +167,7 @@ def train():
     # Turn on training mode which enables dropout.
     model.train()
     total_loss = 0.
+    total_tokens = 0
     start_time = time.time()
     ntokens = len(corpus.dictionary)
     hidden = model.init_hidden(args.batch_size)
@@ -186,15 +190,17 @@ def train():
             p.data.add_(-lr, p.grad.data)
 
         total_loss += loss.item()
+        total_tokens += data.numel()
 
         if batch % args.log_interval == 0 and batch > 0:
             cur_loss = total_loss / args.log_interval
             elapsed = time.time() - start_time
-            print('| epoch {:3d} | {:5d}/{:5d} batches | lr {:02.2f} | ms/batch {:5.2f} | '
+            print('| epoch {:3d} | {:5d}/{:5d} batches | lr {:02.2f} | ms/batch {:5.2f} | tok/s {:8.0f} | '
                     'loss {:5.2f} | ppl {:8.2f}'.format(
                 epoch, batch, len(train_data) // args.bptt, lr,
-                elapsed * 1000 / args.log_interval, cur_loss, math.exp(cur_loss)))
+                elapsed * 1000 / args.log_interval, total_tokens / elapsed, cur_loss, math.exp(cur_loss)))
             total_loss = 0
+            total_tokens = 0
             start_time = time.time()
 
 # Loop over epochs.
@@ -12,14 +12,15 @@ from lstm import SingleLayerLSTM, LSTMCell
 class RNNModel(nn.Module):
     """Container module with an encoder, a recurrent module, and a decoder."""
 
-    def __init__(self, class_type, r, rnn_type, ntoken, ninp, nhid, nlayers, dropout=0.5, tie_weights=False):
+    def __init__(self, class_type, r, rnn_type, ntoken, ninp, nhid, nlayers, dropout=0.5, tie_weights=False, hh_class_type=None):
         super(RNNModel, self).__init__()
         self.drop = nn.Dropout(dropout)
         self.encoder = nn.Embedding(ntoken, ninp)
         if rnn_type in ['LSTM', 'GRU']:
             print('ninp, nhid, nlayers: ', ninp, nhid, nlayers)
             if rnn_type == 'LSTM':
-                self.rnn = SingleLayerLSTM(class_type, r, input_size=ninp, hidden_size=nhid, dropout=dropout)
+                self.rnn = SingleLayerLSTM(class_type, r, input_size=ninp, hidden_size=nhid, dropout=dropout,
+                                           hh_class_type=hh_class_type)
             else:
                 self.rnn = getattr(nn, rnn_type)(ninp, nhid, nlayers, dropout=dropout)
         else:
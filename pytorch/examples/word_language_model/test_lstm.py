@@ -0,0 +1,59 @@
+import os
+import sys
+
+import pytest
+import torch
+from torch import nn
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+import lstm
+from lstm import LSTMCell
+
+torch.manual_seed(0)
+
+
+def reference_cell(cell):
+    """nn.LSTMCell computing the same step as cell, from the dense matrices of its layers.
+    cell splits its gates as (f, i, o, g), nn.LSTMCell as (i, f, g, o).
+    """
+    h = cell.hidden_size
+    W_ih = cell.W_ih.to_dense()[: cell.input_size]
+    W_hh = cell.W_hh if cell.hh_class_type is None else cell.W_hh.to_dense()[:h]
+    perm = torch.cat([torch.arange(k * h, (k + 1) * h) for k in (1, 0, 3, 2)])
+    ref = nn.LSTMCell(cell.input_size, h)
+    with torch.no_grad():
+        ref.weight_ih.copy_(W_ih[:, perm].t())
+        ref.weight_hh.copy_(W_hh[:, perm].t())
+        ref.bias_ih.copy_(cell.bias[perm])
+        ref.bias_hh.zero_()
+    return ref
+
+
+@pytest.mark.parametrize(
+    "class_type, hh_class_type", [("toeplitz", None), ("low_rank", None), ("toeplitz", "toeplitz"), ("low_rank", "low_rank")]
+)
+@pytest.mark.parametrize("fused", [False, True])
+def test_lstm_cell(class_type, hh_class_type, fused, monkeypatch):
+    if fused:
+        # Use the scripted gates on CPU as well
+        monkeypatch.setattr(lstm, "lstm_gates_eager", lstm.lstm_gates)
+    batch_size, input_size, hidden_size = 5, 12, 8
+    cell = LSTMCell(class_type, 2, input_size, hidden_size, hh_class_type=hh_class_type)
+    with torch.no_grad():
+        cell.bias.normal_()
+        if hh_class_type is None:
+            cell.W_hh.normal_(std=0.3)
+    ref = reference_cell(cell)
+
+    x = torch.randn(batch_size, input_size, requires_grad=True)
+    h_0, c_0 = torch.randn(batch_size, hidden_size), torch.randn(batch_size, hidden_size)
+    h_1, c_1 = cell(x, (h_0, c_0))
+    h_ref, c_ref = ref(x, (h_0, c_0))
+    torch.testing.assert_close(h_1, h_ref, rtol=1e-4, atol=1e-5)
+    torch.testing.assert_close(c_1, c_ref, rtol=1e-4, atol=1e-5)
+
+    grad_h, grad_c = torch.randn_like(h_1), torch.randn_like(c_1)
+    (grad,) = torch.autograd.grad((h_1 * grad_h + c_1 * grad_c).sum(), x)
+    (grad_ref,) = torch.autograd.grad((h_ref * grad_h + c_ref * grad_c).sum(), x)
+    torch.testing.assert_close(grad, grad_ref, rtol=1e-4, atol=1e-5)
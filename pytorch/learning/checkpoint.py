@@ -0,0 +1,106 @@
+import os, glob, random, threading, logging
+import numpy as np
+import torch
+
+
+def to_cpu(obj):
+    """Copy of obj (nested dicts/lists/tuples) with every tensor cloned to CPU,
+    so that it can be serialized while training keeps updating the originals.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class Checkpointer:
+    """Writes checkpoints to checkpoint_path on a background thread.
+
+    save() takes a CPU snapshot of the state on the calling thread (the only
+    part that has to synchronize with training) and hands the serialization
+    to a writer thread. At most one write is in flight; a new save waits for
+    the previous one. Files are written to a temporary name and renamed, so a
+    killed run never leaves a truncated checkpoint behind.
+
+    Periodic checkpoints are named step_<total_step>; only the keep most
+    recent ones are kept. Named checkpoints (e.g. 'best', 'last') are never pruned.
+    """
+
+    def __init__(self, checkpoint_path, keep=3):
+        self.checkpoint_path = checkpoint_path
+        self.keep = keep
+        self._thread = None
+        self._error = None
+        os.makedirs(checkpoint_path, exist_ok=True)
+
+    def save(self, state, name):
+        snapshot = to_cpu(state)
+        self.wait()
+        path = os.path.join(self.checkpoint_path, name)
+        self._thread = threading.Thread(target=self._write, args=(snapshot, path), daemon=True)
+        self._thread.start()
+        return path
+
+    def save_step(self, state, total_step):
+        return self.save(state, 'step_%d' % total_step)
+
+    def wait(self):
+        """Block until the pending write is done, re-raising its error if it failed."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _write(self, snapshot, path):
+        try:
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                torch.save(snapshot, f)
+            os.replace(tmp_path, path)
+            logging.debug("Checkpoint saved in file: %s" % path)
+            self._prune()
+        except Exception as e:
+            self._error = e
+
+    def _prune(self):
+        if self.keep is None or self.keep <= 0:
+            return
+        for path in step_checkpoints(self.checkpoint_path)[:-self.keep]:
+            os.remove(path)
+
+
+def step_checkpoints(checkpoint_path):
+    """Paths of the periodic checkpoints in checkpoint_path, oldest first."""
+    paths = glob.glob(os.path.join(checkpoint_path, 'step_*'))
+    paths = [p for p in paths if not p.endswith('.tmp')]
+    return sorted(paths, key=lambda p: int(p.rsplit('_', 1)[1]))
+
+
+def latest(checkpoint_path):
+    """Most recent periodic checkpoint in checkpoint_path, or None."""
+    paths = step_checkpoints(checkpoint_path)
+    return paths[-1] if paths else None
+
+
+def load(path):
+    return torch.load(path, map_location='cpu', weights_only=False)
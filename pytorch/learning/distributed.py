@@ -0,0 +1,115 @@
+"""Multi-process data-parallel training with torch.distributed (gloo backend).
+
+Every process holds a full copy of the model and trains on its shard of the
+training set; gradients are averaged across processes before each optimizer
+step, so all copies stay identical. Evaluation, logging and checkpointing are
+done by rank 0 only.
+"""
+
+import os, random
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+
+def init(rank, world_size, dist_url, num_threads=None):
+    dist.init_process_group('gloo', init_method=dist_url, rank=rank, world_size=world_size)
+    if num_threads is not None:
+        # Share the cores of the machine between the local processes
+        torch.set_num_threads(num_threads)
+
+
+def seed_all(src=0):
+    """Seed numpy and torch on every rank with the same random seed drawn on
+    rank src, so that e.g. the train/validation split is the same everywhere.
+    Training reseeds the ranks differently (seed_ranks), so call this again
+    before anything else that has to be identical across ranks.
+    """
+    seed = torch.tensor([int.from_bytes(os.urandom(4), 'little') >> 1])
+    dist.broadcast(seed, src)
+    np.random.seed(seed.item())
+    torch.manual_seed(seed.item())
+
+
+def seed_ranks(src=0):
+    """Draw a seed on rank src and reseed python, numpy and torch on every rank
+    with seed + rank, so that the ranks have different random streams (e.g. dropout
+    masks) from here on. Returns the shared seed, e.g. for the shuffle of the shards.
+    """
+    seed = torch.randint(2**31 - dist.get_world_size(), (1,))
+    dist.broadcast(seed, src)
+    seed = seed.item()
+    rank_seed = seed + dist.get_rank()
+    random.seed(rank_seed)
+    np.random.seed(rank_seed)
+    torch.manual_seed(rank_seed)
+    return seed
+
+
+def assert_same(tensor, name, src=0):
+    """Check that tensor has the same value on every rank as on rank src."""
+    reference = tensor.clone()
+    dist.broadcast(reference, src)
+    assert torch.equal(tensor, reference), '%s differs between rank %d and rank %d' % (name, dist.get_rank(), src)
+
+
+def broadcast_object(obj, src=0):
+    """obj of rank src, on every rank (it only needs to exist on rank src)."""
+    objects = [obj]
+    dist.broadcast_object_list(objects, src)
+    return objects[0]
+
+
+def gather_object(obj, dst=0):
+    """List of the obj of every rank, indexed by rank, on rank dst; None on the other ranks."""
+    objects = [None] * dist.get_world_size() if dist.get_rank() == dst else None
+    dist.gather_object(obj, objects, dst)
+    return objects
+
+
+def spawn(fn, nprocs, args=()):
+    """Run fn(local_rank, *args) in nprocs processes and wait for them."""
+    torch.multiprocessing.spawn(fn, args=args, nprocs=nprocs, join=True)
+
+
+def threads_per_process(nprocs):
+    return max(1, (os.cpu_count() or 1) // nprocs)
+
+
+def shard_loader(dataloader, rank, world_size, seed):
+    """Loader over the shard of dataloader's dataset that belongs to rank.
+    The shards have the same number of batches, as required by the gradient all-reduce.
+    seed: seed of the shuffle, the same on every rank (e.g. the one returned by seed_ranks).
+    """
+    sampler = torch.utils.data.distributed.DistributedSampler(dataloader.dataset, num_replicas=world_size,
+        rank=rank, shuffle=True, seed=seed)
+    return torch.utils.data.DataLoader(dataloader.dataset, batch_size=dataloader.batch_size, sampler=sampler,
+        num_workers=dataloader.num_workers, pin_memory=dataloader.pin_memory, collate_fn=dataloader.collate_fn)
+
+
+def broadcast_parameters(net, src=0):
+    """Copy the parameters and buffers of net on rank src to every other rank."""
+    with torch.no_grad():
+        for tensor in list(net.parameters()) + list(net.buffers()):
+            dist.broadcast(tensor.data, src)
+
+
+def average_gradients(net):
+    """All-reduce the gradients of net and divide by the number of processes.
+    The gradients are flattened into a single buffer so that there is one
+    all-reduce per step instead of one per parameter (the structured layers
+    have many small parameters: G, H, subdiagonals, corners).
+    """
+    grads = [p.grad for p in net.parameters() if p.grad is not None]
+    if not grads:
+        return
+    flat = _flatten_dense_tensors(grads)
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+    for grad, synced in zip(grads, _unflatten_dense_tensors(flat, grads)):
+        grad.copy_(synced)
+
+
+def cleanup():
+    dist.destroy_process_group()
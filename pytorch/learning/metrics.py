@@ -0,0 +1,87 @@
+import threading, queue, logging
+import pickle as pkl
+import torch
+
+
+class Metrics:
+    """Collects losses and accuracies and writes them out on a background thread.
+
+    Values may be passed as device tensors: converting them to Python numbers
+    (a host sync), writing to the SummaryWriter and pickling the history all
+    happen on the writer thread, so the training loop never waits for them.
+    The training loss is accumulated on the device at every step with add()
+    and logged as the mean over the steps since the last log().
+    """
+
+    def __init__(self, writer, losses=None, accuracies=None):
+        self.writer = writer
+        self.losses = losses if losses is not None else {'Train': [], 'Val': [], 'DR': [], 'ratio': [], 'Test':[]}
+        self.accuracies = accuracies if accuracies is not None else {'Train': [], 'Val': [], 'Test':[]}
+        self._sums = {}
+        self._counts = {}
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add(self, split, loss):
+        """Add a loss to the running (device-side) sum of split."""
+        loss = loss.detach()
+        self._sums[split] = self._sums[split] + loss if split in self._sums else loss.clone()
+        self._counts[split] = self._counts.get(split, 0) + 1
+
+    def log(self, name, split, loss, acc, step):
+        """Record loss and accuracy of split at step. If loss is None, the
+        mean of the losses added since the last log of split is used.
+        """
+        if loss is None:
+            loss = self._sums.pop(split) / self._counts.pop(split)
+        if torch.is_tensor(loss):
+            loss = loss.detach()
+        if torch.is_tensor(acc):
+            acc = acc.detach()
+        self._queue.put((self._log, (name, split, loss, acc, step)))
+
+    def scalar(self, tag, value):
+        self._queue.put((self.writer.add_scalar, (tag, value)))
+
+    def dump(self, result_path):
+        """Pickle the losses and accuracies to result_path + '_{losses,accuracies}.p'."""
+        self._queue.put((self._dump, (result_path,)))
+
+    def wait(self):
+        """Block until everything logged so far has been written."""
+        self._queue.join()
+
+    def state_dict(self):
+        self.wait()
+        return {'losses': self.losses, 'accuracies': self.accuracies}
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _log(self, name, split, loss, acc, step):
+        loss, acc = float(loss), float(acc)
+        self.losses[split].append(loss)
+        self.accuracies[split].append(acc)
+        self.writer.add_scalar(split+'/Loss', loss, step)
+        self.writer.add_scalar(split+'/Accuracy', acc, step)
+        logging.debug(f"{name} loss, accuracy: {loss:.6f}, {acc:.6f}")
+
+    def _dump(self, result_path):
+        pkl.dump(self.losses, open(result_path + '_losses.p', 'wb'), protocol=2)
+        pkl.dump(self.accuracies, open(result_path + '_accuracies.p', 'wb'), protocol=2)
+        logging.debug('Saved losses and accuracies to: ' + result_path)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                fn, args = item
+                fn(*args)
+            except Exception:
+                logging.exception('Failed to write metrics')
+            finally:
+                self._queue.task_done()
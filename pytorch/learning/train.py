@@ -1,49 +1,104 @@
 import numpy as np
 import os, time, logging
-import pickle as pkl
 import torch
 import torch.optim as optim
 from torch.optim.lr_scheduler import StepLR
 from tensorboardX import SummaryWriter
+from learning import checkpoint, distributed
+from learning.metrics import Metrics
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
+def eval_loader(dataloader, batch_size=None, num_samples=None, seed=0):
+    """Unshuffled loader over the dataset of dataloader for evaluation.
+    batch_size: evaluation batch size (defaults to the one of dataloader); without
+        autograd there are no activations to keep, so this can be much larger.
+    num_samples: if not None, evaluate on a fixed random subset of this many examples.
+    """
+    dataset = dataloader.dataset
+    if num_samples is not None and num_samples < len(dataset):
+        generator = torch.Generator().manual_seed(seed)
+        idx = torch.randperm(len(dataset), generator=generator)[:num_samples]
+        dataset = torch.utils.data.Subset(dataset, idx.tolist())
+    return torch.utils.data.DataLoader(dataset, batch_size=batch_size or dataloader.batch_size, shuffle=False,
+        num_workers=dataloader.num_workers, pin_memory=dataloader.pin_memory, collate_fn=dataloader.collate_fn)
+
+
 def test_split(net, dataloader, loss_fn):
+    """Average loss and accuracy of net over dataloader.
+    Runs in inference mode and accumulates on the device, so there is a single host sync at the end.
+    """
     n = len(dataloader.dataset)
-    total_loss = 0.0
-    total_acc = 0.0
-    for data in dataloader:
-        batch_X, batch_Y = data
-        batch_X, batch_Y = batch_X.to(device), batch_Y.to(device)
-
-        output = net(batch_X)
-        loss_batch, acc_batch = loss_fn(output, batch_Y)
-        total_loss += len(batch_X)*loss_batch.data.item()
-        total_acc += len(batch_X)*acc_batch.data.item()
+    total_loss = torch.zeros((), device=device)
+    total_acc = torch.zeros((), device=device)
+    with torch.inference_mode():
+        for data in dataloader:
+            batch_X, batch_Y = data
+            batch_X, batch_Y = batch_X.to(device, non_blocking=True), batch_Y.to(device, non_blocking=True)
+
+            output = net(batch_X)
+            loss_batch, acc_batch = loss_fn(output, batch_Y)
+            total_loss += len(batch_X)*loss_batch.sum()
+            total_acc += len(batch_X)*acc_batch.to(device).sum()
+        total_loss, total_acc = torch.stack((total_loss, total_acc)).tolist()
     return total_loss/n, total_acc/n
 
 
+def accumulate_gradients(net, loss_fn, batch_X, batch_Y, accum_steps=1, accuracy=True):
+    """Forward and backward of one batch, split into accum_steps micro-batches
+    whose gradients are accumulated. Each micro-batch loss is weighted by its
+    share of the batch, so the gradient equals the one of the whole batch.
+    Returns the (detached) loss and accuracy of the batch; accuracy is None if not requested.
+    """
+    total_loss, total_acc = 0.0, 0.0 if accuracy else None
+    micro_batches = list(zip(batch_X.chunk(accum_steps), batch_Y.chunk(accum_steps)))
+    for i, (micro_X, micro_Y) in enumerate(micro_batches):
+        weight = len(micro_X) / len(batch_X)
+        output = net(micro_X)
+        loss, acc = loss_fn(output, micro_Y, accuracy=accuracy)
+        loss = weight*loss
+        if i == len(micro_batches) - 1:
+            loss = loss + net.loss()
+        loss.backward()
+        total_loss += loss.detach()
+        if accuracy:
+            total_acc += weight*acc
+    return total_loss, total_acc
+
+
 # Epoch_offset: to ensure stats are not overwritten when called during pruning
+# checkpoint_freq: save a resumable checkpoint every checkpoint_freq steps (and at the end of every epoch)
+# keep_checkpoints: number of periodic checkpoints kept on disk
+# resume: path of a periodic checkpoint to continue from
+# eval_freq: validate every eval_freq epochs (and after the last one)
+# eval_batch_size: batch size for evaluation (defaults to the training batch size)
+# eval_samples: if not None, validate (and report final train accuracy) on a fixed random subset of this size
+# accum_steps: number of micro-batches each batch is split into, with gradients accumulated over them
+# rank, world_size: position of this process in data-parallel training (see learning/distributed.py);
+#   the training set is sharded, and only rank 0 evaluates, logs and checkpoints. Only rank 0 reads resume,
+#   the other ranks receive the checkpoint from it.
 def train(dataset, net, optimizer, lr_scheduler, epochs, log_freq, log_path, checkpoint_path, result_path,
-    test, save_model, epoch_offset=0):
+    test, save_model, epoch_offset=0, checkpoint_freq=0, keep_checkpoints=3, resume=None,
+    eval_freq=1, eval_batch_size=None, eval_samples=None, accum_steps=1, rank=0, world_size=1):
+    is_main = rank == 0
     logging.debug('Tensorboard log path: ' + log_path)
     logging.debug('Tensorboard checkpoint path: ' + checkpoint_path)
     logging.debug('Results directory: ' + result_path)
 
-    os.makedirs(checkpoint_path, exist_ok=True)
-
-    writer = SummaryWriter(log_path)
+    if is_main:
+        checkpointer = checkpoint.Checkpointer(checkpoint_path, keep_checkpoints)
+        writer = SummaryWriter(log_path)
+        metrics = Metrics(writer)
+        log_stats = metrics.log
     net.to(device)
 
-    logging.debug((torch.cuda.get_device_name(0)))
+    if torch.cuda.is_available():
+        logging.debug((torch.cuda.get_device_name(0)))
 
     for name, param in net.named_parameters():
         if param.requires_grad:
             logging.debug(('Parameter name, shape: ', name, param.data.shape))
 
-    losses = {'Train': [], 'Val': [], 'DR': [], 'ratio': [], 'Test':[]}
-    accuracies = {'Train': [], 'Val': [], 'Test':[]}
-
     best_val_acc = 0.0
     best_val_save = None
 
@@ -51,48 +106,124 @@ def train(dataset, net, optimizer, lr_scheduler, epochs, log_freq, log_path, che
     test_acc_of_best_val = 0.0
     test_loss_of_best_val = 0.0
 
-    def log_stats(name, split, loss, acc, step):
-        losses[split].append(loss)
-        accuracies[split].append(acc)
-        writer.add_scalar(split+'/Loss', loss, step)
-        writer.add_scalar(split+'/Accuracy', acc, step)
-        logging.debug(f"{name} loss, accuracy: {loss:.6f}, {acc:.6f}")
+    val_loader = eval_loader(dataset.val_loader, eval_batch_size, eval_samples)
+    # The test set is only loaded if it is evaluated
+    test_loader = None
+    def evaluate_test():
+        nonlocal test_loader
+        if test_loader is None:
+            test_loader = eval_loader(dataset.test_loader, eval_batch_size)
+        return test_split(net, test_loader, dataset.loss)
+
+    # RNG states of every rank, indexed by rank (on rank 0 only): the current one and epoch_rng.
+    # Called by all ranks at the same points of training.
+    def rng_states(epoch_rng):
+        states = (checkpoint.rng_state(), epoch_rng)
+        states = distributed.gather_object(states) if world_size > 1 else [states]
+        if states is None:
+            return None
+        return [s[0] for s in states], [s[1] for s in states]
+
+    # State needed to continue training exactly where it stopped. epoch_rng is
+    # the RNG state before the epoch's shuffle, so that a resumed run sees the
+    # same batch order and can skip the batches already trained on.
+    def training_state(epoch, step, rngs):
+        return {'net': net.state_dict(), 'optimizer': optimizer.state_dict(),
+                'lr_scheduler': lr_scheduler.state_dict(), 'rng': rngs[0],
+                'epoch_rng': rngs[1], 'epoch': epoch, 'step': step, 'sampler_seed': sampler_seed,
+                'best_val_acc': best_val_acc, 'best_val_save': best_val_save,
+                'test_acc_of_best_val': test_acc_of_best_val, 'test_loss_of_best_val': test_loss_of_best_val,
+                **metrics.state_dict()}
 
-
-    # Compute initial stats
     t1 = time.time()
-    init_loss, init_accuracy = test_split(net, dataset.val_loader, dataset.loss)
-    log_stats('Initial', 'Val', init_loss, init_accuracy, epoch_offset)
+    samples = 0
+    start_epoch, start_step, resume_state = 0, 0, None
+    if resume is not None:
+        resume_state = checkpoint.load(resume)
+    if world_size > 1:
+        # The other ranks may be on nodes that do not see the checkpoint directory
+        resume_state = distributed.broadcast_object(resume_state)
+    if resume_state is not None:
+        assert len(resume_state['rng']) == world_size, "the checkpoint was saved with a different number of processes"
+        net.load_state_dict(resume_state['net'])
+        optimizer.load_state_dict(resume_state['optimizer'])
+        lr_scheduler.load_state_dict(resume_state['lr_scheduler'])
+        start_epoch, start_step = resume_state['epoch'], resume_state['step']
+        best_val_acc, best_val_save = resume_state['best_val_acc'], resume_state['best_val_save']
+        test_acc_of_best_val = resume_state['test_acc_of_best_val']
+        test_loss_of_best_val = resume_state['test_loss_of_best_val']
+        if is_main:
+            metrics.losses, metrics.accuracies = resume_state['losses'], resume_state['accuracies']
+        logging.debug(f'Resumed at epoch {start_epoch}, step {start_step}')
+    elif is_main:
+        # Compute initial stats
+        init_loss, init_accuracy = test_split(net, val_loader, dataset.loss)
+        log_stats('Initial', 'Val', init_loss, init_accuracy, epoch_offset)
+
+    train_loader, sampler_seed = dataset.train_loader, None
+    if world_size > 1:
+        distributed.broadcast_parameters(net)
+        # Each rank gets its own random stream (restored from the checkpoint when resuming);
+        # the shards are shuffled with a seed shared by all ranks and drawn anew for every trial
+        if resume_state is not None:
+            sampler_seed = resume_state['sampler_seed']
+        else:
+            sampler_seed = distributed.seed_ranks()
+        train_loader = distributed.shard_loader(dataset.train_loader, rank, world_size, sampler_seed)
 
-    for epoch in range(epochs):
+    for epoch in range(start_epoch, epochs):
         logging.debug('Starting epoch ' + str(epoch+epoch_offset))
-        for step, data in enumerate(dataset.train_loader, 0):
+        if world_size > 1:
+            train_loader.sampler.set_epoch(epoch + epoch_offset)
+        if resume_state is not None:
+            checkpoint.set_rng_state(resume_state['epoch_rng' if start_step > 0 else 'rng'][rank])
+            if start_step == 0:
+                resume_state = None
+        epoch_rng = checkpoint.rng_state()
+        for step, data in enumerate(train_loader, 0):
+            # Skip the batches of a resumed epoch that were already trained on
+            if epoch == start_epoch and step < start_step:
+                continue
+            if resume_state is not None:
+                checkpoint.set_rng_state(resume_state['rng'][rank])
+                resume_state = None
             # Get the inputs
             batch_xs, batch_ys = data
             batch_xs, batch_ys = batch_xs.to(device), batch_ys.to(device)
 
             optimizer.zero_grad()   # Zero the gradient buffers
 
-            output = net(batch_xs)
-            train_loss, train_accuracy = dataset.loss(output, batch_ys)
-            train_loss += net.loss()
-            train_loss.backward()
+            # Log training every log_freq steps; the accuracy is only computed then
+            total_step = (epoch + epoch_offset)*len(train_loader) + step+1
+            log_step = total_step % log_freq == 0
+
+            train_loss, train_accuracy = accumulate_gradients(net, dataset.loss, batch_xs, batch_ys, accum_steps,
+                accuracy=log_step)
+            if world_size > 1:
+                distributed.average_gradients(net)
 
             optimizer.step()
 
-            # Log training every log_freq steps
-            total_step = (epoch + epoch_offset)*len(dataset.train_loader) + step+1
-            if total_step % log_freq == 0:
-                logging.debug(('Time: ', time.time() - t1))
-                t1 = time.time()
+            # Every rank takes part in gathering the RNG states of a checkpoint
+            save_step = checkpoint_freq and total_step % checkpoint_freq == 0 and step+1 < len(train_loader)
+            if save_step:
+                rngs = rng_states(epoch_rng)
+
+            if not is_main:
+                continue
+            metrics.add('Train', train_loss)
+            samples += len(batch_xs)*world_size
+            if log_step:
+                elapsed = time.time() - t1
+                logging.debug(('Time: ', elapsed, 'samples/s: ', samples / elapsed))
+                t1, samples = time.time(), 0
                 logging.debug(('Training step: ', total_step))
 
-                log_stats('Train', 'Train', train_loss.data.item(), train_accuracy.data.item(), total_step)
+                # Mean training loss since the last log, accuracy of this batch
+                log_stats('Train', 'Train', None, train_accuracy, total_step)
 
-        # Validate and checkpoint by epoch
-        # Test on validation set
-        val_loss, val_accuracy = test_split(net, dataset.val_loader, dataset.loss)
-        log_stats('Validation', 'Val', val_loss, val_accuracy, epoch+epoch_offset+1)
+            if save_step:
+                checkpointer.save_step(training_state(epoch, step+1, rngs), total_step)
 
         # Update LR
         lr_scheduler.step()
@@ -100,29 +231,40 @@ def train(dataset, net, optimizer, lr_scheduler, epochs, log_freq, log_path, che
         for param_group in optimizer.param_groups:
             logging.debug('Current LR: ' + str(param_group['lr']))
 
-        # Record best model
-        if val_accuracy > best_val_acc:
-            if save_model:
-                save_path = os.path.join(checkpoint_path, 'best')
-                with open(save_path, 'wb') as f:
-                    torch.save(net.state_dict(), f)
-                logging.debug(("Best model saved in file: %s" % save_path))
-                best_val_save = save_path
+        # Validate and checkpoint every eval_freq epochs
+        if is_main and ((epoch+1) % eval_freq == 0 or epoch+1 == epochs):
+            # Test on validation set
+            val_loss, val_accuracy = test_split(net, val_loader, dataset.loss)
+            log_stats('Validation', 'Val', val_loss, val_accuracy, epoch+epoch_offset+1)
+
+            # Record best model
+            if val_accuracy > best_val_acc:
+                if save_model:
+                    best_val_save = checkpointer.save(net.state_dict(), 'best')
+
+                else:
+                    test_loss, test_accuracy = evaluate_test()
+                    test_loss_of_best_val = test_loss
+                    test_acc_of_best_val = test_accuracy
+
 
-            else:
-                test_loss, test_accuracy = test_split(net, dataset.test_loader, dataset.loss)
-                test_loss_of_best_val = test_loss
-                test_acc_of_best_val = test_accuracy
+                best_val_acc = val_accuracy
 
+            metrics.dump(result_path)
 
-            best_val_acc = val_accuracy
+        if checkpoint_freq:
+            rngs = rng_states(None)
+            if is_main:
+                total_step = (epoch + epoch_offset + 1)*len(train_loader)
+                checkpointer.save_step(training_state(epoch+1, 0, rngs), total_step)
+
+    if not is_main:
+        return None, None
 
     # Save last checkpoint
     if save_model:
-        save_path = os.path.join(checkpoint_path, 'last')
-        with open(save_path, 'wb') as f:
-            torch.save(net.state_dict(), f)
-        logging.debug(("Last model saved in file: %s" % save_path))
+        checkpointer.save(net.state_dict(), 'last')
+    checkpointer.wait()
 
     # Test trained model
     if test:
@@ -131,24 +273,22 @@ def train(dataset, net, optimizer, lr_scheduler, epochs, log_freq, log_path, che
             if best_val_save is not None: net.load_state_dict(torch.load(best_val_save))
             logging.debug(f'Loaded best validation checkpoint from: {best_val_save}')
 
-            test_loss, test_accuracy = test_split(net, dataset.test_loader, dataset.loss)
+            test_loss, test_accuracy = evaluate_test()
             log_stats('Test', 'Test', test_loss, test_accuracy, 0)
 
         else:
             log_stats('Test', 'Test', test_loss_of_best_val, test_acc_of_best_val, 0)
 
-        train_loss, train_accuracy = test_split(net, dataset.train_loader, dataset.loss)
+        train_loss, train_accuracy = test_split(net, eval_loader(dataset.train_loader, eval_batch_size, eval_samples),
+            dataset.loss)
 
         # Log best validation accuracy and training acc for that model
-        writer.add_scalar('MaxAcc/Val', best_val_acc)
-        writer.add_scalar('MaxAcc/Train', train_accuracy)
+        metrics.scalar('MaxAcc/Val', best_val_acc)
+        metrics.scalar('MaxAcc/Train', train_accuracy)
 
+    metrics.dump(result_path)
+    metrics.close()
     writer.export_scalars_to_json(os.path.join(log_path, "all_scalars.json"))
     writer.close()
 
-
-    pkl.dump(losses, open(result_path + '_losses.p', 'wb'), protocol=2)
-    pkl.dump(accuracies, open(result_path + '_accuracies.p', 'wb'), protocol=2)
-    logging.debug('Saved losses and accuracies to: ' + result_path)
-
-    return losses, accuracies
+    return metrics.losses, metrics.accuracies
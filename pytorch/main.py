@@ -15,7 +15,7 @@ pytorch_root = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__fi
 sys.path.insert(0, pytorch_root)
 from dataset import DatasetLoaders
 from models.nets import ArghModel, construct_model
-from learning import train, prune
+from learning import train, prune, checkpoint, distributed
 from utils import descendants
 
 logging.basicConfig(level=logging.DEBUG,
@@ -28,13 +28,14 @@ logging.basicConfig(level=logging.DEBUG,
 parser = argparse.ArgumentParser()
 parser.add_argument("--name", default='', help='Name of run')
 parser.add_argument("--dataset", help='Dataset')
-parser.add_argument('--transform', default='none', help='Any transform of dataset, e.g. padding')
+parser.add_argument('--transform', default='none', help='Any transforms of dataset, e.g. pad (784 to 1024), randomize (labels), contrast and/or patch (augmentations computed per batch)')
 parser.add_argument('--train-frac', type=float, nargs='+', default=[None])
 parser.add_argument('--val-frac', type=float, default=0.15)
 parser.add_argument("--result-dir", help='Where to save results')
 parser.add_argument('--trials', type=int, default=1, help='Number of independent runs')
 parser.add_argument('--trial-id', type=int, nargs='+', help='Specify trial numbers; alternate to --trials')
 parser.add_argument('--batch-size', type=int, default=50, help='Batch size')
+parser.add_argument('--accum-steps', type=int, default=1, help='Split each batch into this many micro-batches and accumulate their gradients')
 parser.add_argument("--epochs", type=int, default=1, help='Number of passes through the training data')
 parser.add_argument('--optim', default='sgd', help='Optimizer')
 parser.add_argument('--lr', nargs='+', type=float, default=[1e-3], help='Learning rates')
@@ -42,12 +43,22 @@ parser.add_argument('--mom', nargs='+', type=float, default=[0.9], help='Momentu
 parser.add_argument('--lr-decay', type=float, default=1.0)
 parser.add_argument('--log-freq', type=int, default=100)
 parser.add_argument('--test', action='store_false', help='Toggle testing on test set')
+parser.add_argument('--eval-freq', type=int, default=1, help='Validate every this many epochs (and after the last one)')
+parser.add_argument('--eval-batch-size', type=int, default=1000, help='Batch size for evaluation')
+parser.add_argument('--eval-samples', type=int, default=None, help='Validate on a fixed random subset of this many examples (default: all)')
 parser.add_argument('--prune', action='store_true', help='Whether to do pruning')
 parser.add_argument('--prune-lr-decay', type=float, default=0.1, help='LR decay factor in each pruning iter')
 parser.add_argument('--prune-factor', type=float, default=1, help='Factor by which to prune')
 parser.add_argument('--prune-iters', type=int, default=1, help='Number of pruning iters')
 parser.add_argument('--save-model', action='store_false', help='Whether to save best model')
+parser.add_argument('--checkpoint-freq', type=int, default=0, help='Save a resumable checkpoint every this many steps and every epoch (0: disabled)')
+parser.add_argument('--keep-checkpoints', type=int, default=3, help='Number of periodic checkpoints to keep')
+parser.add_argument('--resume', action='store_true', help='Resume each trial from its latest periodic checkpoint')
 parser.add_argument('--data-dir', default='../../datasets/', help='Data directory')
+parser.add_argument('--workers', type=int, default=1, help='Number of data-parallel training processes on this node')
+parser.add_argument('--nodes', type=int, default=1, help='Number of nodes for data-parallel training')
+parser.add_argument('--node-rank', type=int, default=0, help='Index of this node')
+parser.add_argument('--dist-url', default='tcp://127.0.0.1:23456', help='Address of the rank 0 process, for torch.distributed')
 
 out_dir = os.path.dirname(pytorch_root) # Repo root
 
@@ -76,7 +87,13 @@ def save_args(args, results_dir):
 
 def mlp(args):
     for train_frac in args.train_frac:
+        if args.world_size > 1:
+            # Previous runs left different random states on the ranks; they must split the data the same way
+            distributed.seed_all()
         dataset = DatasetLoaders(args.dataset, args.data_dir, args.val_frac, args.transform, train_frac, args.batch_size)
+        if args.world_size > 1:
+            distributed.assert_same(torch.from_numpy(dataset.train_idx), 'the training split')
+            distributed.assert_same(torch.from_numpy(dataset.val_idx), 'the validation split')
         model = construct_model(nets[args.model], dataset.in_size, dataset.out_size, args)
 
         for lr, mom in itertools.product(args.lr, args.mom):
@@ -103,7 +120,8 @@ def mlp(args):
                                         'results',
                                         args.result_dir,
                                         run_name + '_' + str(datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")))
-            save_args(args, results_dir)
+            if args.rank == 0:
+                save_args(args, results_dir)
 
             trial_ids = args.trial_id if args.trial_id is not None else range(args.trials)
             for trial_iter in trial_ids:
@@ -123,14 +141,20 @@ def mlp(args):
                 lr_scheduler = StepLR(optimizer, step_size=1, gamma=args.lr_decay)
 
                 if args.prune:
+                    assert args.world_size == 1, "pruning does not support data-parallel training"
                     # Is there a better way to enforce pruning only for unconstrained and MLP?
                     assert model.class_type in ['unconstrained', 'u'] and args.model in ['MLP','CNN']
                     prune.prune(dataset, model, optimizer, lr_scheduler, args.epochs, args.log_freq, log_path,
                         checkpoint_path, result_path, args.test, args.save_model, args.prune_lr_decay, args.prune_factor,
                         args.prune_iters)
                 else:
+                    # Only rank 0 writes checkpoints; train() sends the state to the other ranks
+                    resume = checkpoint.latest(checkpoint_path) if args.resume and args.rank == 0 else None
                     train.train(dataset, model, optimizer, lr_scheduler, args.epochs, args.log_freq,
-                        log_path, checkpoint_path, result_path, args.test, args.save_model)
+                        log_path, checkpoint_path, result_path, args.test, args.save_model,
+                        checkpoint_freq=args.checkpoint_freq, keep_checkpoints=args.keep_checkpoints, resume=resume,
+                        eval_freq=args.eval_freq, eval_batch_size=args.eval_batch_size, eval_samples=args.eval_samples,
+                        accum_steps=args.accum_steps, rank=args.rank, world_size=args.world_size)
 
 
 ## Parse
@@ -153,5 +177,18 @@ for model in ArghModel.__subclasses__():
     model.args.__name__ = 'args'
 
 
-args = parser.parse_args()
-args.task(args)
+def worker(local_rank, args):
+    args.rank = args.node_rank*args.workers + local_rank
+    distributed.init(args.rank, args.world_size, args.dist_url, distributed.threads_per_process(args.workers))
+    args.task(args)
+    distributed.cleanup()
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    args.world_size = args.nodes*args.workers
+    args.rank = 0
+    if args.world_size > 1:
+        distributed.spawn(worker, args.workers, (args,))
+    else:
+        args.task(args)
@@ -309,13 +309,22 @@ class LDRLDR2(ArghModel):
             self.layer_size = self.in_size
         self.n = self.layer_size
 
-        self.LDR1 = sl.StructuredLinear(self.class1, layer_size=self.channels*self.n, r=self.rank1, bias=True)
-        self.LDR2 = sl.StructuredLinear(self.class2,layer_size=self.channels*self.n, r=self.rank2, bias=True)
+        # Classes that support rectangular matrices are used directly as
+        # n -> channels*n -> fc_size; the others are padded to channels*n
+        self.rectangular = sl.class_map[self.class1].rectangular and sl.class_map[self.class2].rectangular
+        if self.rectangular:
+            self.LDR1 = sl.StructuredLinear(self.class1, layer_size=self.n, hidden_size=self.channels*self.n,
+                r=self.rank1, bias=True)
+            self.LDR2 = sl.StructuredLinear(self.class2, layer_size=self.channels*self.n, hidden_size=self.fc_size,
+                r=self.rank2, bias=True)
+        else:
+            self.LDR1 = sl.StructuredLinear(self.class1, layer_size=self.channels*self.n, r=self.rank1, bias=True)
+            self.LDR2 = sl.StructuredLinear(self.class2,layer_size=self.channels*self.n, r=self.rank2, bias=True)
         self.logits = nn.Linear(self.fc_size, 10)
 
     def forward(self, x):
-        batch_size, n = x.shape[0], x.shape[1]
-        x = torch.cat((x, torch.zeros(batch_size, self.channels*self.n-n).cuda()), dim=-1)
+        if not self.rectangular:
+            x = F.pad(x, (0, self.channels*self.n - x.shape[1]))
         x = F.relu(self.LDR1(x))
         x = F.relu(self.LDR2(x))
         x = x[:,:self.fc_size]
@@ -16,7 +16,6 @@
 
 import torch
 import torch.nn as nn
-from torch.autograd import Variable
 from torch.nn.parameter import Parameter
 
 from . import krylov as kry, toeplitz as toep
@@ -32,9 +31,15 @@ class LDR(nn.Module):
             + str(self.r)
         )
 
-    # TODO: support non-square multiplications
     def __init__(
-        self, displacement, in_channels, out_channels, rank, layer_size, bias=True
+        self,
+        displacement,
+        in_channels,
+        out_channels,
+        rank,
+        layer_size,
+        bias=True,
+        out_size=None,
     ):
         super(LDR, self).__init__()
         self.displacement = displacement
@@ -42,10 +47,12 @@ class LDR(nn.Module):
         self.out_channels = out_channels
         self.r = rank
         self.n = layer_size
+        # Output length; defaults to a square n x n multiplication
+        self.m = layer_size if out_size is None else out_size
         self.bias = None
 
         self.G = Parameter(
-            torch.Tensor(self.in_channels, self.out_channels, self.r, self.n)
+            torch.Tensor(self.in_channels, self.out_channels, self.r, self.m)
         )
         self.H = Parameter(
             torch.Tensor(self.in_channels, self.out_channels, self.r, self.n)
@@ -53,14 +60,14 @@ class LDR(nn.Module):
         torch.nn.init.normal_(self.G, std=0.01)  # TODO
         torch.nn.init.normal_(self.H, std=0.01)
         if bias:
-            self.bias = Parameter(torch.zeros(self.out_channels, 1, self.n))
+            self.bias = Parameter(torch.zeros(self.out_channels, 1, self.m))
         if self.displacement == "toeplitz_corner" or self.displacement == "tc":
             self.corner = True
         elif self.displacement == "toeplitz" or self.displacement == "t":
             self.corner = False
         elif self.displacement == "subdiagonal" or self.displacement == "sd":
             self.subd_A = Parameter(
-                torch.ones((self.in_channels, self.out_channels, self.n - 1))
+                torch.ones((self.in_channels, self.out_channels, self.m - 1))
             )
             self.subd_B = Parameter(
                 torch.ones((self.in_channels, self.out_channels, self.n - 1))
@@ -69,15 +76,13 @@ class LDR(nn.Module):
     def forward(self, x):
         """
         x: (in_channels, batch, n)
-        out: (out_channels, batch, n)
+        out: (out_channels, batch, m)
         """
         _, b, n = x.shape
         assert n == self.n
 
         # print("shapes ", self.G[0,0].shape, self.H[0,0].shape, x[0].shape)
-        comps = Variable(
-            torch.Tensor(self.in_channels, self.out_channels, b, self.n)
-        ).cuda()
+        comps = x.new_empty(self.in_channels, self.out_channels, b, self.m)
         for i in range(self.in_channels):
             for j in range(self.out_channels):
                 if self.displacement in ["toeplitz_corner", "toeplitz", "tc", "t"]:
@@ -0,0 +1,94 @@
+# Copyright 2018 HazyResearch
+# https://github.com/HazyResearch/structured-nets
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Deployment of trained structured layers.
+
+For small layer sizes the explicit dense matrix is faster than the FFT /
+recursive Krylov multiplication, since the fast algorithms are dominated by
+kernel launch overhead. deploy() materializes each structured layer with
+Layer.to_dense() and keeps whichever execution is faster on this host.
+"""
+
+import time
+
+import torch
+import torch.nn as nn
+from torch.nn.parameter import Parameter
+
+from .layer import Layer
+
+
+class Dense(nn.Module):
+    """Dense replacement of a structured layer: x @ W + b."""
+
+    def __init__(self, layer):
+        super().__init__()
+        self.layer_size = layer.layer_size
+        self.abbrev = layer.name()
+        with torch.no_grad():
+            self.W = Parameter(layer.to_dense().detach().clone())
+            self.b = None if layer.b is None else Parameter(layer.b.detach().clone())
+
+    def name(self):
+        return self.abbrev + "dense"
+
+    def forward(self, x):
+        out = x @ self.W
+        return out if self.b is None else self.b + out
+
+    def loss(self):
+        return 0
+
+
+def time_forward(module, x, n_iters=20):
+    """Average wall-clock time (seconds) of module(x), after one warmup call."""
+    sync = torch.cuda.synchronize if x.is_cuda else (lambda: None)
+    with torch.no_grad():
+        module(x)
+        sync()
+        start = time.perf_counter()
+        for _ in range(n_iters):
+            module(x)
+        sync()
+    return (time.perf_counter() - start) / n_iters
+
+
+def deploy(net, batch_size=50, n_iters=20, threshold=None):
+    """Replace every structured Layer of net by its Dense equivalent when that is faster.
+    Parameters:
+        net: nn.Module containing structure.layer.Layer submodules; modified in place.
+        batch_size: batch size used to time both executions.
+        n_iters: number of timed forward passes per execution.
+        threshold: if not None, skip the timing and materialize exactly the
+            layers with layer_size <= threshold.
+    Returns:
+        decisions: dict from module name to 'dense' or 'structured'
+    """
+    decisions = {}
+    for parent_name, parent in list(net.named_modules()):
+        for name, child in list(parent.named_children()):
+            if not isinstance(child, Layer):
+                continue
+            full_name = parent_name + "." + name if parent_name else name
+            dense = Dense(child)
+            if threshold is not None:
+                use_dense = child.layer_size <= threshold
+            else:
+                x = torch.randn(batch_size, child.layer_size, device=dense.W.device)
+                use_dense = time_forward(dense, x, n_iters) < time_forward(child, x, n_iters)
+            if use_dense:
+                setattr(parent, name, dense)
+            decisions[full_name] = "dense" if use_dense else "structured"
+    return decisions
@@ -16,7 +16,6 @@
 
 from math import log2
 
-import hadamard_cuda
 import torch
 
 
@@ -45,6 +44,11 @@ class HadamardTransformCuda(torch.autograd.Function):
 
     @staticmethod
     def forward(ctx, u):
+        # The extension is only imported when needed; other tensors use the torch implementation
+        if not u.is_cuda:
+            return hadamard_transform_torch(u)
+        import hadamard_cuda
+
         return hadamard_cuda.hadamard_transform(u)
 
     @staticmethod
@@ -23,13 +23,14 @@ transpose multiply and Krylov multiply.
 
 For tridiagonal case, we implement the slow multiplication algorithm: construct
 the Krylov matrix then call regular matrix multiply.
+
+The diag_mult_cuda extension is only imported when a CUDA tensor needs it, so
+the module also works on machines without it.
 """
 
 import functools
 from math import ceil, log2
 
-import diag_mult_cuda
-
 import torch
 from torch.nn import functional as F
 
@@ -520,116 +521,155 @@ def krylov_multiply_old(subdiag, v, w):
     return du
 
 
+def _pad_to_power_of_2(subdiag, v, u=None):
+    """Zero-pad subdiag (n - 1, ), v (rank, n) and u (batch_size, n) so that n
+    is a power of 2, as required by the fast algorithms. Padding the subdiagonal
+    with zeros does not change the product on the first n entries.
+    """
+    n = v.shape[-1]
+    pad = (1 << int(ceil(log2(n)))) - n
+    if pad == 0:
+        return subdiag, v, u
+    return (
+        F.pad(subdiag, (0, pad)),
+        F.pad(v, (0, pad)),
+        F.pad(u, (0, pad)) if u is not None else None,
+    )
+
+
+def _subdiag_mult(KT_fn, K_fn, subdiag_A, subdiag_B, G, H, x):
+    """Multiply sum_i Krylov(A, G_i) @ Krylov(B, H_i)^T @ x given Krylov
+    transpose multiply and Krylov multiply functions. A is m x m and B is n x n;
+    when m != n the Krylov matrices are truncated to min(m, n) columns, which
+    is exact since subdiagonal matrices are nilpotent.
+    """
+    m, n = G.shape[-1], H.shape[-1]
+    KT_out = KT_fn(*_pad_to_power_of_2(subdiag_B, H, x))[..., : min(m, n)]
+    subdiag_A, G, _ = _pad_to_power_of_2(subdiag_A, G)
+    KT_out = F.pad(KT_out, (0, G.shape[-1] - KT_out.shape[-1]))
+    K_out = K_fn(subdiag_A, G, KT_out)
+    return K_out[:, :m]
+
+
 def subdiag_mult_conv(subdiag_A, subdiag_B, G, H, x):
     """Multiply sum_i Krylov(A, G_i) @ Krylov(B, H_i) @ x when A and B are zero except on the subdiagonal.
     Uses the fast algorithm.
     Use either Pytorch's conv1d or FFT for polynomial multiplication, depending
     on polynomial degree. This is the fastest implementation.
     Parameters:
-        subdiag_A: Tensor of shape (n - 1, )
+        subdiag_A: Tensor of shape (m - 1, )
         subdiag_B: Tensor of shape (n - 1, )
-        G: Tensor of shape (rank, n)
+        G: Tensor of shape (rank, m)
         H: Tensor of shape (rank, n)
         x: Tensor of shape (batch_size, n)
     Returns:
-        product: Tensor of shape (batch_size, n)
+        product: Tensor of shape (batch_size, m)
     """
-    rank, n = G.shape
-    batch_size = x.shape[0]
-    # if not power of 2, round everything up
-    # TODO: this can maybe be handled better. also should benchmark how much speed non-po2 FFT loses
-    m = int(ceil(log2(n)))
-    n_extended = 1 << m
-    if n != n_extended:
-        x = torch.cat(
-            (
-                x,
-                torch.zeros(batch_size, n_extended - n, dtype=x.dtype, device=x.device),
-            ),
-            dim=-1,
-        )
-        G = torch.cat(
-            (G, torch.zeros(rank, n_extended - n, dtype=G.dtype, device=G.device)),
-            dim=-1,
-        )
-        H = torch.cat(
-            (H, torch.zeros(rank, n_extended - n, dtype=H.dtype, device=H.device)),
-            dim=-1,
-        )
-        subdiag_A = torch.cat(
-            (
-                subdiag_A,
-                torch.zeros(
-                    n_extended - n, dtype=subdiag_A.dtype, device=subdiag_A.device
-                ),
-            )
-        )
-        subdiag_B = torch.cat(
-            (
-                subdiag_B,
-                torch.zeros(
-                    n_extended - n, dtype=subdiag_B.dtype, device=subdiag_B.device
-                ),
-            )
-        )
-    KT_out = krylov_transpose_multiply_conv(subdiag_B, H, x)
-    K_out = krylov_multiply_conv(subdiag_A, G, KT_out)
-    return K_out[:, :n] if n != n_extended else K_out
+    return _subdiag_mult(
+        krylov_transpose_multiply_conv, krylov_multiply_conv, subdiag_A, subdiag_B, G, H, x
+    )
 
 
 def subdiag_mult(subdiag_A, subdiag_B, G, H, x):
     """Multiply sum_i Krylov(A, G_i) @ Krylov(B, H_i) @ x when A and B are zero except on the subdiagonal.
     Uses the fast algorithm.
+    Parameters:
+        subdiag_A: Tensor of shape (m - 1, )
+        subdiag_B: Tensor of shape (n - 1, )
+        G: Tensor of shape (rank, m)
+        H: Tensor of shape (rank, n)
+        x: Tensor of shape (batch_size, n)
+    Returns:
+        product: Tensor of shape (batch_size, m)
+    """
+    return _subdiag_mult(
+        krylov_transpose_multiply, krylov_multiply, subdiag_A, subdiag_B, G, H, x
+    )
+
+
+def _unroll_corner(subdiag, corner, v):
+    """Subdiagonal (2n - 1, ) and zero-padded v (rank, 2n) of the 2n x 2n nilpotent
+    unrolling of the n x n subdiagonal matrix with upper right corner: the cycle
+    [s_0, ..., s_{n-2}, corner] is laid out twice along the subdiagonal.
+    """
+    corner = torch.as_tensor(corner, dtype=subdiag.dtype, device=subdiag.device).reshape(1)
+    return torch.cat((subdiag, corner, subdiag)), F.pad(v, (0, v.shape[-1]))
+
+
+def subdiag_mult_corner_unrolled(subdiag_A, subdiag_B, G, H, x, corner_A=0.0, corner_B=0.0):
+    """Multiply sum_i Krylov(A, G_i) @ Krylov(B, H_i)^T @ x when A and B are zero except on the
+    subdiagonal and the upper right corner.
+    Uses the fast algorithm, without constructing the Krylov matrices. The first n
+    columns of the Krylov matrix of A are [I I] @ Krylov(A', [g; 0])[:, :n] where A' is the
+    2n x 2n nilpotent unrolling of A (a path of length k < n through the corner of A is a
+    path from the first to the second copy in A'), so this is subdiag_mult at size 2n.
     Parameters:
         subdiag_A: Tensor of shape (n - 1, )
         subdiag_B: Tensor of shape (n - 1, )
         G: Tensor of shape (rank, n)
         H: Tensor of shape (rank, n)
         x: Tensor of shape (batch_size, n)
+        corner_A, corner_B: real numbers or Tensors of shape ()
     Returns:
         product: Tensor of shape (batch_size, n)
     """
-    rank, n = G.shape
-    batch_size = x.shape[0]
-    # if not power of 2, round everything up
-    # TODO: this can maybe be handled better. also should benchmark how much speed non-po2 FFT loses
-    m = int(ceil(log2(n)))
-    n_extended = 1 << m
-    if n != n_extended:
-        x = torch.cat(
-            (
-                x,
-                torch.zeros(batch_size, n_extended - n, dtype=x.dtype, device=x.device),
-            ),
-            dim=-1,
-        )
-        G = torch.cat(
-            (G, torch.zeros(rank, n_extended - n, dtype=G.dtype, device=G.device)),
-            dim=-1,
-        )
-        H = torch.cat(
-            (H, torch.zeros(rank, n_extended - n, dtype=H.dtype, device=H.device)),
-            dim=-1,
-        )
-        subdiag_A = torch.cat(
-            (
-                subdiag_A,
-                torch.zeros(
-                    n_extended - n, dtype=subdiag_A.dtype, device=subdiag_A.device
-                ),
-            )
-        )
-        subdiag_B = torch.cat(
-            (
-                subdiag_B,
-                torch.zeros(
-                    n_extended - n, dtype=subdiag_B.dtype, device=subdiag_B.device
-                ),
-            )
-        )
-    KT_out = krylov_transpose_multiply(subdiag_B, H, x)
-    K_out = krylov_multiply(subdiag_A, G, KT_out)
-    return K_out[:, :n] if n != n_extended else K_out
+    n = x.shape[-1]
+    subdiag_B, H = _unroll_corner(subdiag_B, corner_B, H)
+    KT_out = krylov_transpose_multiply(*_pad_to_power_of_2(subdiag_B, H, torch.cat((x, x), dim=-1)))[..., :n]
+    subdiag_A, G, _ = _pad_to_power_of_2(*_unroll_corner(subdiag_A, corner_A, G))
+    K_out = krylov_multiply(subdiag_A, G, F.pad(KT_out, (0, G.shape[-1] - n)))
+    return K_out[:, :n] + K_out[:, n : 2 * n]
+
+
+def _corner_terms(subdiag, v):
+    """Factors of the paths through the corner of A = S + corner * e_0 e_{n-1}^T, S subdiagonal.
+    For k < n such a path is taken at most once, and
+        Krylov(A, v)[i, k] = Krylov(S, v)[i, k] + corner * p[i] * q[n - k + i]  (zero unless k > i)
+    with p[i] = s_0 ... s_{i-1} (from 0 to i) and q[j] = s_j ... s_{n-2} v[j] (from j to n - 1).
+    Returns p (n, ) and q_rev (rank, n) with q_rev[d] = q[n - d] for d >= 1 and q_rev[0] = 0, in float64
+    so that the separate products do not overflow where their product would not.
+    """
+    subdiag = subdiag.double()
+    ones = torch.ones(1, dtype=subdiag.dtype, device=subdiag.device)
+    p = torch.cat((ones, subdiag)).cumprod(dim=0)
+    q = v.double() * torch.cat((subdiag, ones)).flip(0).cumprod(dim=0).flip(0)
+    return p, F.pad(q.flip(-1)[..., :-1], (1, 0))
+
+
+def subdiag_mult_corner(subdiag_A, subdiag_B, G, H, x, corner_A=0.0, corner_B=0.0):
+    """Multiply sum_i Krylov(A, G_i) @ Krylov(B, H_i)^T @ x when A and B are zero except on the
+    subdiagonal and the upper right corner.
+    Uses the fast algorithm for the subdiagonal part, at the same size n as subdiag_mult; the
+    paths through the corners (see _corner_terms) add a correlation / convolution with
+    q_rev, which is one more FFT of size 2n per product.
+    The corner terms are computed in float64; the accuracy is that of subdiag_mult, which
+    like every FFT-based product degrades when the subdiagonal products span many orders of magnitude.
+    Parameters:
+        subdiag_A: Tensor of shape (n - 1, )
+        subdiag_B: Tensor of shape (n - 1, )
+        G: Tensor of shape (rank, n)
+        H: Tensor of shape (rank, n)
+        x: Tensor of shape (batch_size, n)
+        corner_A, corner_B: real numbers or Tensors of shape ()
+    Returns:
+        product: Tensor of shape (batch_size, n)
+    """
+    n = x.shape[-1]
+    p_B, q_rev_B = _corner_terms(subdiag_B, H)
+    p_A, q_rev_A = _corner_terms(subdiag_A, G)
+
+    # Krylov(B, H_i)^T @ x: the corner adds sum_{d >= 1} q_rev[d] (p * x)[k - d], a causal convolution
+    KT_out = krylov_transpose_multiply(*_pad_to_power_of_2(subdiag_B, H, x))[..., :n]
+    px_f = torch.fft.rfft(p_B * x.double(), n=2 * n)
+    KT_corner = torch.fft.irfft(px_f[:, None] * torch.fft.rfft(q_rev_B, n=2 * n), n=2 * n)[..., :n]
+    KT_out = KT_out + (corner_B * KT_corner).to(x.dtype)
+
+    # sum_i Krylov(A, G_i) @ w_i: the corner adds p * sum_{d >= 1} q_rev[d] w[i + d], a correlation
+    subdiag_A_, G_, KT_out_ = _pad_to_power_of_2(subdiag_A, G, KT_out)
+    K_out = krylov_multiply(subdiag_A_, G_, KT_out_)[:, :n]
+    wq_f = (torch.fft.rfft(KT_out.double(), n=2 * n) * torch.fft.rfft(q_rev_A, n=2 * n).conj()).sum(dim=1)
+    K_corner = p_A * torch.fft.irfft(wq_f, n=2 * n)[..., :n]
+    return K_out + (corner_A * K_corner).to(x.dtype)
 
 
 ##### Slow multiplication for the subdiagonal case
@@ -683,9 +723,10 @@ def subdiag_linear_map(subdiag, upper_right_corner=0.0):
     shift_down = torch.arange(-1, n - 1, device=subdiag.device)
     subdiag_extended = torch.cat(
         (
-            torch.tensor(
-                [upper_right_corner], dtype=subdiag.dtype, device=subdiag.device
-            ),
+            # as_tensor keeps a learned corner in the autograd graph
+            torch.as_tensor(
+                upper_right_corner, dtype=subdiag.dtype, device=subdiag.device
+            ).reshape(1),
             subdiag,
         )
     )
@@ -716,9 +757,9 @@ def krylov_subdiag_fast(subdiag, v, upper_right_corner=0.0):
     v_circulant = v[:, indices]
     subdiag_extended = torch.cat(
         (
-            torch.tensor(
-                [upper_right_corner], dtype=subdiag.dtype, device=subdiag.device
-            ),
+            torch.as_tensor(
+                upper_right_corner, dtype=subdiag.dtype, device=subdiag.device
+            ).reshape(1),
             subdiag,
         )
     )
@@ -791,20 +832,36 @@ def subdiag_mult_slow_fast(subdiag_A, subdiag_B, G, H, x):
     return ((x @ K_H) @ K_G.transpose(1, 2)).sum(dim=0)
 
 
+def cycle_mult(subdiag, v, shift_subdiag, shift_v):
+    """Cycle the vectors and then do a pointwise multiplication:
+    output[..., i] = subdiag[..., (i + shift_subdiag) % n] * v[..., (i + shift_v) % n].
+    Runs the diag_mult_cuda kernel on CUDA (float32) tensors, and vectorized torch otherwise.
+    Parameters:
+        subdiag: Tensor of shape (n, ) or of the same shape as v
+        v: Tensor of shape (..., n)
+        shift_subdiag, shift_v: integers between -n and n - 1
+    Returns:
+        product: Tensor of the same shape as v
+    """
+    if v.is_cuda and v.dtype == torch.float32:
+        import diag_mult_cuda
+
+        return diag_mult_cuda.cycle_mult(subdiag, v, shift_subdiag, shift_v)
+    return subdiag.roll(-shift_subdiag, -1) * v.roll(-shift_v, -1)
+
+
 class CycleDownMultCuda(torch.autograd.Function):
     """Cycle v down and do pointwise multiplication with subdiag."""
 
     @staticmethod
     def forward(ctx, subdiag, v):
         ctx.save_for_backward(subdiag, v)
-        return diag_mult_cuda.cycle_mult(subdiag, v, 0, -1)
+        return cycle_mult(subdiag, v, 0, -1)
 
     @staticmethod
     def backward(ctx, grad):
         subdiag, v = ctx.saved_tensors
-        return diag_mult_cuda.cycle_mult(grad, v, 0, -1).sum(
-            dim=0
-        ), diag_mult_cuda.cycle_mult(subdiag, grad, 1, 1)
+        return cycle_mult(grad, v, 0, -1).sum(dim=0), cycle_mult(subdiag, grad, 1, 1)
 
 
 cycle_down_mult = CycleDownMultCuda.apply
@@ -812,7 +869,7 @@ cycle_down_mult = CycleDownMultCuda.apply
 
 def subdiag_linear_map_cuda(subdiag, upper_right_corner=0.0):
     """Construct the linear map for multiplying with a subdiagonal matrix (possibly with an upper right corner).
-    Uses the construction in CUDA, so it's pretty fast.
+    Uses cycle_mult (the CUDA kernel on GPU), so it's pretty fast.
     Parameters:
         subdiag: (n - 1, )
         upper_right_corner: real number
@@ -821,9 +878,9 @@ def subdiag_linear_map_cuda(subdiag, upper_right_corner=0.0):
     """
     subdiag_extended = torch.cat(
         (
-            torch.tensor(
-                [upper_right_corner], dtype=subdiag.dtype, device=subdiag.device
-            ),
+            torch.as_tensor(
+                upper_right_corner, dtype=subdiag.dtype, device=subdiag.device
+            ).reshape(1),
             subdiag,
         )
     )
@@ -832,7 +889,7 @@ def subdiag_linear_map_cuda(subdiag, upper_right_corner=0.0):
 
 def subdiag_mult_cuda(subdiag_A, subdiag_B, G, H, x, corner_A=0.0, corner_B=0.0):
     """Multiply sum_i Krylov(A, G_i) @ Krylov(B, H_i) @ x when A and B are zero except on the subdiagonal.
-    Uses the explicit Krylov construction in CUDA.
+    Uses the explicit Krylov construction with cycle_mult (in CUDA on GPU).
     Parameters:
         subdiag_A: Tensor of shape (n - 1, )
         subdiag_B: Tensor of shape (n - 1, )
@@ -847,6 +904,35 @@ def subdiag_mult_cuda(subdiag_A, subdiag_B, G, H, x, corner_A=0.0, corner_B=0.0)
     return ((x @ K_H) @ K_G.transpose(1, 2)).sum(dim=0)
 
 
+##### Diagonal operator: Krylov(diag(d), v) = diag(v) @ Vandermonde(d)
+
+
+def vandermonde_multiply(d, u, block_size=128):
+    """Multiply u @ V for the Vandermonde matrix V[k, j] = d[j] ** k, i.e.
+    evaluate the polynomials with coefficients u at the points d.
+    Horner's rule over blocks of block_size coefficients: only the first
+    block_size powers of d are formed, so the memory is O(block_size n)
+    instead of O(n^2), and the high powers are built up by repeated
+    multiplication by d ** block_size instead of raised directly.
+    Parameters:
+        d: (n, )
+        u: (..., n)
+        block_size: number of coefficients per block
+    Returns:
+        product: (..., n)
+    """
+    n = u.shape[-1]
+    block_size = min(block_size, n)
+    powers = d ** torch.arange(block_size, dtype=u.dtype, device=u.device)[:, None]
+    step = d ** block_size
+    out = None
+    for start in reversed(range(0, n, block_size)):
+        block = u[..., start : start + block_size]
+        block = block @ powers[: block.shape[-1]]
+        out = block if out is None else out * step + block
+    return out
+
+
 ##### Slow multiplication for the tridiagonal case
 
 
@@ -874,9 +960,9 @@ def tridiag_linear_map(
     shifts = torch.stack((shift_down, shift_none, shift_up))
     subdiag_extended = torch.cat(
         (
-            torch.tensor(
-                [upper_right_corner], dtype=subdiag.dtype, device=subdiag.device
-            ),
+            torch.as_tensor(
+                upper_right_corner, dtype=subdiag.dtype, device=subdiag.device
+            ).reshape(1),
             subdiag,
         )
     )
@@ -14,6 +14,8 @@
 # limitations under the License.
 
 
+import math
+
 import torch
 import torch.nn as nn
 from torch.autograd import Variable
@@ -25,22 +27,29 @@ from . import circulant as circ, fastfood as ff, krylov as kry, toeplitz as toep
 class Layer(nn.Module):
     class_type = None
     abbrev = None
+    # Whether the layer supports hidden_size != layer_size, i.e. a
+    # (layer_size x hidden_size) weight without padding the input
+    rectangular = False
 
     def name(self):
         return self.__class__.abbrev
 
-    def __init__(self, layer_size=None, bias=True, **kwargs):
+    def __init__(self, layer_size=None, hidden_size=None, bias=True, **kwargs):
         super().__init__()
         self.layer_size = layer_size
+        self.hidden_size = layer_size if hidden_size is None else hidden_size
         self.bias = bias
         self.__dict__.update(kwargs)
         self.reset_parameters()
 
     def reset_parameters(self):
         assert self.layer_size is not None
+        assert self.rectangular or self.hidden_size == self.layer_size, (
+            self.__class__.__name__ + " does not support hidden_size != layer_size"
+        )
         self.b = None
         if self.bias:
-            self.b = Parameter(torch.zeros(self.layer_size))
+            self.b = Parameter(torch.zeros(self.hidden_size))
 
     def apply_bias(self, out):
         if self.b is not None:
@@ -51,27 +60,30 @@ class Layer(nn.Module):
     def loss(self):
         return 0
 
+    def to_dense(self):
+        """Explicit matrix W such that self(x) == apply_bias(x @ W).
+        The default probes the layer with the identity; subclasses override
+        this with a direct construction of the matrix.
+        """
+        device = next(self.parameters()).device
+        out = self.forward(torch.eye(self.layer_size, device=device))
+        return out - self.b if self.b is not None else out
+
 
 class Unconstrained(Layer):
     class_type = "unconstrained"
     abbrev = "u"
+    rectangular = True
 
     def name(self):
         return self.__class__.abbrev + str(self.hidden_size)
 
-    def __init__(self, layer_size, hidden_size=None, **kwargs):
-        if hidden_size is None:
-            hidden_size = layer_size
-        super().__init__(layer_size, hidden_size=hidden_size, **kwargs)
-
     def reset_parameters(self):
         super().reset_parameters()
         self.W = Parameter(torch.Tensor(self.layer_size, self.hidden_size))
-        self.init_stddev = torch.sqrt(1.0 / self.layer_size)
+        self.init_stddev = math.sqrt(1.0 / self.layer_size)
         torch.nn.init.normal_(self.W, std=self.init_stddev)
         self.mask = None
-        if self.bias:
-            self.b = Parameter(torch.zeros(self.hidden_size))
 
     def set_mask(self, mask, device):
         self.mask = Variable(torch.FloatTensor(mask).to(device), requires_grad=False)
@@ -88,6 +100,9 @@ class Unconstrained(Layer):
             out = torch.matmul(x, self.W)
         return self.apply_bias(out)
 
+    def to_dense(self):
+        return self.W * self.mask if self.mask is not None else self.W
+
 
 class Circulant(Layer):
     class_type = "circulant"
@@ -96,12 +111,17 @@ class Circulant(Layer):
     def reset_parameters(self):
         super().reset_parameters()
         self.c = Parameter(torch.Tensor(self.layer_size))
-        self.init_stddev = torch.sqrt(1.0 / self.layer_size)
+        self.init_stddev = math.sqrt(1.0 / self.layer_size)
         torch.nn.init.normal_(self.c, std=self.init_stddev)
 
     def forward(self, x):
         return self.apply_bias(circ.circulant_multiply(self.c, x))
 
+    def to_dense(self):
+        n = self.layer_size
+        a = torch.arange(n, device=self.c.device)
+        return self.c[(a[None] - a[:, None]) % n]
+
 
 class FastFood(Layer):
     class_type = "fastfood"
@@ -113,14 +133,14 @@ class FastFood(Layer):
         # TODO: check initialization of S (scaling matrix) is correct
         # S,G,B: diagonal, learnable parameters
         # P: permutation, fixed
-        S = torch.sqrt(torch.random.chisquare(self.layer_size, size=self.layer_size))
-        G = torch.random.randn(self.layer_size)
+        S = torch.sqrt(torch.distributions.Chi2(float(self.layer_size)).sample((self.layer_size,)))
+        G = torch.randn(self.layer_size)
         S /= torch.linalg.norm(G)
-        B = torch.random.choice((-1, 1), size=self.layer_size)
+        B = torch.randint(0, 2, (self.layer_size,)) * 2 - 1
         self.S = Parameter(torch.FloatTensor(S))
         self.G = Parameter(torch.FloatTensor(G))
-        self.B = Parameter(torch.FloatTensor(B))
-        self.P = torch.LongTensor(torch.random.permutation(self.layer_size))
+        self.B = Parameter(torch.FloatTensor(B.float()))
+        self.P = torch.randperm(self.layer_size)
 
     def forward(self, x):
         return self.apply_bias(ff.fastfood_multiply(self.S, self.G, self.B, self.P, x))
@@ -129,6 +149,7 @@ class FastFood(Layer):
 class LowRank(Layer):
     class_type = "low_rank"
     abbrev = "lr"
+    rectangular = True
 
     def name(self):
         return self.__class__.abbrev + str(self.r)
@@ -138,10 +159,10 @@ class LowRank(Layer):
 
     def reset_parameters(self):
         super().reset_parameters()
-        self.G = Parameter(torch.Tensor(self.r, self.layer_size))
+        self.G = Parameter(torch.Tensor(self.r, self.hidden_size))
         self.H = Parameter(torch.Tensor(self.r, self.layer_size))
         # self.init_stddev = 0.01
-        self.init_stddev = torch.power(1.0 / (self.r * self.layer_size), 1 / 2)
+        self.init_stddev = math.sqrt(1.0 / (self.r * self.layer_size))
         torch.nn.init.normal_(self.G, std=self.init_stddev)
         torch.nn.init.normal_(self.H, std=self.init_stddev)
 
@@ -150,6 +171,9 @@ class LowRank(Layer):
         out = torch.matmul(xH, self.G)
         return self.apply_bias(out)
 
+    def to_dense(self):
+        return self.H.t() @ self.G
+
     def loss(self):
         return 0
         # lamb = 0.0001
@@ -168,6 +192,13 @@ class ToeplitzLike(LowRank):
         out = toep.toeplitz_mult(self.G, self.H, x, self.corner)
         return self.apply_bias(out)
 
+    def to_dense(self):
+        f_G, f_H = (1, -1) if self.corner else (0, 0)
+        N = min(self.layer_size, self.hidden_size)
+        K_G = toep.krylov_toeplitz_fast(self.G, f_G)[..., :N]
+        K_H = toep.krylov_toeplitz_fast(self.H, f_H)[..., :N]
+        return (K_H @ K_G.transpose(1, 2)).sum(dim=0)
+
 
 class ToeplitzLikeC(ToeplitzLike):
     class_type = "toeplitz_corner"
@@ -182,14 +213,37 @@ class HankelLike(LowRank):
     class_type = "hankel"
     abbrev = "h"
 
+    def reset_parameters(self):
+        super().reset_parameters()
+        self.corner = True
+
     def forward(self, x):
-        out = toep.toeplitz_mult(self.G, self.H, x, True)
-        return self.apply_bias(out.flip(out.dim() - 1))
+        out = toep.hankel_mult(self.G, self.H, x, self.corner)
+        return self.apply_bias(out)
+
+    def to_dense(self):
+        f_G, f_H = (1, -1) if self.corner else (0, 0)
+        N = min(self.layer_size, self.hidden_size)
+        K_G = toep.krylov_toeplitz_fast(self.G, f_G)[..., :N]
+        K_H = toep.krylov_toeplitz_fast(self.H, f_H)[..., :N]
+        return (K_H @ K_G.transpose(1, 2)).sum(dim=0).flip(1)
+
+
+class HankelLikeNC(HankelLike):
+    """Hankel-like with the nilpotent shift operators Z_0 instead of the (1, -1) corners of HankelLike."""
+
+    class_type = "hankel_nocorner"
+    abbrev = "hnc"
+
+    def reset_parameters(self):
+        super().reset_parameters()
+        self.corner = False
 
 
 class VandermondeLike(LowRank):
     class_type = "vandermonde"
     abbrev = "v"
+    rectangular = False
 
     def reset_parameters(self):
         super().reset_parameters()
@@ -197,24 +251,29 @@ class VandermondeLike(LowRank):
         torch.nn.init.uniform_(self.diag, -0.7, 0.7)
 
     def forward(self, x):
-        # want: K_A[i,j,k] = g_i[j] * d[j] ** k
+        # want: K_A[i,j,k] = g_i[j] * d[j] ** k, i.e. K_A[i] = diag(g_i) @ V^T with V[k,j] = d[j] ** k
         # K_A = kry.Krylov(lambda v: self.diag * v, self.G)
-        n = x.size(-1)
-        d_ = self.diag.unsqueeze(1) ** torch.arange(n, dtype=x.dtype, device=x.device)
-        K_A = self.G.unsqueeze(-1) * d_
 
         # K_B = kry.Krylov(lambda v: torch.cat((v[...,1:],0*v[...,:1]),dim=-1), self.H)
         # out = (x @ K_B) @ K_A.transpose(1,2)
 
         out = toep.toeplitz_krylov_transpose_multiply(self.H, x)
-        out = out.transpose(0, 1) @ K_A.transpose(1, 2)
-        out = torch.sum(out, dim=0)
+        # (x @ K_B) @ V scaled by g_i, without forming the (rank, n, n) K_A
+        out = kry.vandermonde_multiply(self.diag, out) * self.G
+        out = torch.sum(out, dim=1)
         return self.apply_bias(out)
 
         # transpose Vandermonde:
         # K_H = kry.Krylov(lambda v: self.diag * v, self.H)
         # out = toep.toeplitz_krylov_multiply(self.G, torch.transpose(x @ K_H, 0,1))
 
+    def to_dense(self):
+        n = self.layer_size
+        d_ = self.diag.unsqueeze(1) ** torch.arange(n, dtype=self.G.dtype, device=self.G.device)
+        K_A = self.G.unsqueeze(-1) * d_
+        K_B = toep.krylov_toeplitz_fast(self.H)
+        return (K_B @ K_A.transpose(1, 2)).sum(dim=0)
+
 
 class LearnedOperator(LowRank):
     """
@@ -235,8 +294,9 @@ class LDRSubdiagonal(LearnedOperator):
 
     def reset_parameters(self):
         super().reset_parameters()
-        self.subd_A = Parameter(torch.ones(self.layer_size - 1))
+        self.subd_A = Parameter(torch.ones(self.hidden_size - 1))
         if self.tie_operators:
+            assert self.hidden_size == self.layer_size, "tied operators must be square"
             self.subd_B = self.subd_A
         else:
             self.subd_B = Parameter(torch.ones(self.layer_size - 1))
@@ -246,10 +306,17 @@ class LDRSubdiagonal(LearnedOperator):
         # out = kry.subdiag_mult_conv(self.subd_A, self.subd_B, self.G, self.H, x)
         return self.apply_bias(out)
 
+    def to_dense(self):
+        N = min(self.layer_size, self.hidden_size)
+        K_G = kry.krylov_subdiag_fast(self.subd_A, self.G)[..., :N]
+        K_H = kry.krylov_subdiag_fast(self.subd_B, self.H)[..., :N]
+        return (K_H @ K_G.transpose(1, 2)).sum(dim=0)
+
 
 class LDRSubdiagonalC(LDRSubdiagonal):
     class_type = "subdiagonal_corner"
     abbrev = "sdc"
+    rectangular = False
 
     def reset_parameters(self):
         super().reset_parameters()
@@ -257,7 +324,7 @@ class LDRSubdiagonalC(LDRSubdiagonal):
         self.corner_B = Parameter(torch.tensor(0.0))
 
     def forward(self, x):
-        out = kry.subdiag_mult_cuda(
+        out = kry.subdiag_mult_corner(
             self.subd_A,
             self.subd_B,
             self.G,
@@ -268,10 +335,16 @@ class LDRSubdiagonalC(LDRSubdiagonal):
         )
         return self.apply_bias(out)
 
+    def to_dense(self):
+        K_G = kry.krylov_subdiag_fast(self.subd_A, self.G, upper_right_corner=self.corner_A)
+        K_H = kry.krylov_subdiag_fast(self.subd_B, self.H, upper_right_corner=self.corner_B)
+        return (K_H @ K_G.transpose(1, 2)).sum(dim=0)
+
 
 class LDRTridiagonal(LearnedOperator):
     class_type = "tridiagonal"
     abbrev = "td"
+    rectangular = False
 
     def reset_parameters(self):
         super().reset_parameters()
@@ -305,6 +378,17 @@ class LDRTridiagonal(LearnedOperator):
         )
         return self.apply_bias(out)
 
+    def to_dense(self):
+        K_G = kry.Krylov(
+            kry.tridiag_linear_map(self.subd_A, self.diag_A, self.supd_A, *self.corners_A),
+            self.G,
+        )
+        K_H = kry.Krylov(
+            kry.tridiag_linear_map(self.subd_B, self.diag_B, self.supd_B, *self.corners_B),
+            self.H,
+        )
+        return (K_H @ K_G.transpose(1, 2)).sum(dim=0)
+
 
 class LDRTridiagonalC(LDRTridiagonal):
     class_type = "tridiagonal_corner"
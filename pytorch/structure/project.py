@@ -0,0 +1,122 @@
+# Copyright 2018 HazyResearch
+# https://github.com/HazyResearch/structured-nets
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compression of trained dense layers into structured layers.
+
+project() replaces every nn.Linear of a model by a low displacement rank
+layer fitted to its weight. The layers of the supported classes satisfy the
+Stein equation W - A W B^T = H^T G with nilpotent subdiagonal operators A, B,
+so a rank r approximation of the displacement W - A W B^T of the trained
+weight gives the generators G, H directly. The displacement ranks are
+truncated by randomized SVD, batched over all layers of the same shape.
+"""
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from .layer import StructuredLinear
+
+# Classes whose operators are subdiagonal: (subdiagonal of A, subdiagonal of B) of a layer
+# with weight W (layer_size x hidden_size), or None for the low rank class (A = B = 0)
+operators = {
+    "low_rank": lambda layer: None,
+    "toeplitz": lambda layer: (
+        torch.ones(layer.layer_size - 1, device=layer.G.device),
+        torch.ones(layer.hidden_size - 1, device=layer.G.device),
+    ),
+    "subdiagonal": lambda layer: (layer.subd_B.detach(), layer.subd_A.detach()),
+}
+
+
+def subdiag_displacement(W, subd_A, subd_B):
+    """W - A W B^T for subdiagonal A, B given by their subdiagonals.
+    Parameters:
+        W: (..., m, n)
+        subd_A: (m - 1, )
+        subd_B: (n - 1, )
+    """
+    AWB = subd_A[:, None] * W[..., :-1, :-1] * subd_B
+    return W - F.pad(AWB, (1, 0, 1, 0))
+
+
+def randomized_svd(M, k, n_oversamples=10, n_iter=2):
+    """Top k singular triplets of a batch of matrices M (..., m, n) by randomized range finding
+    with n_iter power iterations. Returns U (..., m, k), S (..., k), V (..., n, k).
+    """
+    l = min(k + n_oversamples, *M.shape[-2:])
+    Q = torch.linalg.qr(M @ torch.randn(*M.shape[:-2], M.shape[-1], l, dtype=M.dtype, device=M.device))[0]
+    for _ in range(n_iter):
+        Q = torch.linalg.qr(M.transpose(-1, -2) @ Q)[0]
+        Q = torch.linalg.qr(M @ Q)[0]
+    U, S, Vh = torch.linalg.svd(Q.transpose(-1, -2) @ M, full_matrices=False)
+    return (Q @ U)[..., :k], S[..., :k], Vh[..., :k, :].transpose(-1, -2)
+
+
+def fit_layers(linears, class_type, r, n_oversamples=10, n_iter=2):
+    """Structured layers of class_type and displacement rank r fitted to nn.Linear modules of the same shape.
+    Returns:
+        layers: list of structure.layer.Layer, one per linear
+        errors: (len(linears), ) relative Frobenius errors of the fitted weights
+    """
+    out_features, in_features = linears[0].weight.shape
+    device = linears[0].weight.device
+    layers = [
+        StructuredLinear(class_type, layer_size=in_features, hidden_size=out_features, r=r,
+                         bias=linear.bias is not None).to(device)
+        for linear in linears
+    ]
+    with torch.no_grad():
+        W = torch.stack([linear.weight.t() for linear in linears])
+        ops = operators[class_type](layers[0])
+        E = W if ops is None else subdiag_displacement(W, *ops)
+        U, S, V = randomized_svd(E, r, n_oversamples, n_iter)
+        sqrt_S = S.sqrt()[..., None, :]
+        H, G = (U * sqrt_S).transpose(1, 2), (V * sqrt_S).transpose(1, 2)
+        errors = []
+        for layer, linear, H_i, G_i, W_i in zip(layers, linears, H, G, W):
+            layer.H.copy_(H_i)
+            layer.G.copy_(G_i)
+            if linear.bias is not None:
+                layer.b.copy_(linear.bias)
+            errors.append(torch.linalg.norm(layer.to_dense() - W_i) / torch.linalg.norm(W_i))
+    return layers, torch.stack(errors)
+
+
+def project(net, class_type="toeplitz", r=1, n_oversamples=10, n_iter=2):
+    """Replace every nn.Linear of net by the structured layer of class_type and rank r closest to it.
+    The linear layers are grouped by shape and each group is fitted in one batch.
+    Parameters:
+        net: nn.Module; modified in place.
+        class_type: one of the keys of operators, e.g. 'toeplitz' or 'subdiagonal'.
+        r: displacement rank of the structured layers.
+        n_oversamples, n_iter: parameters of the randomized SVD.
+    Returns:
+        errors: dict from module name to the relative Frobenius error of the fitted weight
+    """
+    assert class_type in operators, "class_type must be one of " + ", ".join(operators)
+    groups = {}
+    for parent_name, parent in list(net.named_modules()):
+        for name, child in list(parent.named_children()):
+            if isinstance(child, nn.Linear):
+                full_name = parent_name + "." + name if parent_name else name
+                groups.setdefault(tuple(child.weight.shape), []).append((full_name, parent, name, child))
+    errors = {}
+    for group in groups.values():
+        layers, group_errors = fit_layers([child for _, _, _, child in group], class_type, r, n_oversamples, n_iter)
+        for (full_name, parent, name, _), layer, error in zip(group, layers, group_errors):
+            setattr(parent, name, layer)
+            errors[full_name] = error.item()
+    return errors
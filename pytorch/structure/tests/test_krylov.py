@@ -10,12 +10,15 @@ from mle.structure.krylov import (
     subdiag_linear_map,
     subdiag_mult,
     subdiag_mult_conv,
+    subdiag_mult_corner,
+    subdiag_mult_corner_unrolled,
     subdiag_mult_cuda,
     subdiag_mult_slow,
     subdiag_mult_slow_fast,
     subdiag_mult_slow_old,
     tridiag_linear_map,
     tridiag_linear_map_slow,
+    vandermonde_multiply,
 )
 from torch.nn import functional as F
 
@@ -26,9 +29,6 @@ torch.manual_seed(0)
 
 
 def test_cycle_down_mult():
-    if not torch.cuda.is_available():
-        return
-
     n = 1 << 10
     rank = 16
     subdiag = torch.rand(n, requires_grad=True, device=device)
@@ -178,9 +178,8 @@ def test_subdiag_mult():
     result_slow_fast = subdiag_mult_slow_fast(subdiag, subdiag, v, v, u)
     torch.testing.assert_close(result, result_slow_fast)
 
-    if torch.cuda.is_available():
-        result_cuda = subdiag_mult_cuda(subdiag, subdiag, v, v, u)
-        torch.testing.assert_close(result, result_cuda)
+    result_cuda = subdiag_mult_cuda(subdiag, subdiag, v, v, u)
+    torch.testing.assert_close(result, result_cuda)
 
     # Test different ways to compute grad
     (grad,) = torch.autograd.grad(result.sum(), subdiag, retain_graph=True)
@@ -198,11 +197,32 @@ def test_subdiag_mult():
     )
     torch.testing.assert_close(grad, grad_slow_fast)
 
-    if torch.cuda.is_available():
-        (grad_cuda,) = torch.autograd.grad(
-            result_cuda.sum(), subdiag, retain_graph=True
-        )
-        torch.testing.assert_close(grad, grad_cuda)
+    (grad_cuda,) = torch.autograd.grad(result_cuda.sum(), subdiag, retain_graph=True)
+    torch.testing.assert_close(grad, grad_cuda)
+
+
+def test_subdiag_mult_corner():
+    batch_size = 10
+    rank = 4
+    for n in (64, 50):
+        subdiag_A = torch.rand(n - 1, requires_grad=True, device=device)
+        subdiag_B = torch.rand(n - 1, requires_grad=True, device=device)
+        corner_A = torch.tensor(0.7, requires_grad=True, device=device)
+        corner_B = torch.tensor(-0.3, requires_grad=True, device=device)
+        G = torch.rand((rank, n), requires_grad=True, device=device)
+        H = torch.rand((rank, n), requires_grad=True, device=device)
+        u = torch.rand((batch_size, n), device=device)
+        params = (subdiag_A, subdiag_B, corner_A, corner_B, G, H)
+
+        result_slow = subdiag_mult_cuda(subdiag_A, subdiag_B, G, H, u, corner_A, corner_B)
+        grads_slow = torch.autograd.grad(result_slow.sum(), params)
+        for mult in (subdiag_mult_corner, subdiag_mult_corner_unrolled):
+            result = mult(subdiag_A, subdiag_B, G, H, u, corner_A, corner_B)
+            torch.testing.assert_close(result, result_slow, rtol=1e-3, atol=1e-3)
+
+            grads = torch.autograd.grad(result.sum(), params)
+            for grad, grad_slow in zip(grads, grads_slow):
+                torch.testing.assert_close(grad, grad_slow, rtol=1e-3, atol=1e-3)
 
 
 def test_tridiag_mult():
@@ -219,6 +239,19 @@ def test_tridiag_mult():
     torch.testing.assert_close(K, K_old)
 
 
+def test_vandermonde_multiply():
+    n = 1000
+    batch_size, rank = 5, 3
+    # Points on and near the unit circle, where the powers neither vanish nor blow up
+    d = torch.cat((torch.tensor([1.0, -1.0]), 1 - 2 * torch.rand(n - 2) / n)).to(device)
+    d[1::2] *= -1
+    u = torch.randn(batch_size, rank, n, device=device)
+    V = d.double() ** torch.arange(n, dtype=torch.float64, device=device)[:, None]
+    expected = (u.double() @ V).float()
+    for block_size in (1, 64, n):
+        torch.testing.assert_close(vandermonde_multiply(d, u, block_size), expected, rtol=1e-3, atol=1e-3)
+
+
 def poly_mult_sum_benchmark(p, q):
     """Multiply and sum two sets of polynomials.
     Parameters:
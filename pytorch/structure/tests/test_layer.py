@@ -0,0 +1,73 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from mle.structure.deploy import Dense, deploy
+from mle.structure.layer import StructuredLinear, class_map
+
+device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+torch.manual_seed(0)
+
+
+def _test_to_dense(class_type, n, batch_size):
+    layer = StructuredLinear(class_type, layer_size=n, r=2).to(device)
+    if layer.b is not None:
+        torch.nn.init.normal_(layer.b)
+    x = torch.randn(batch_size, n, device=device)
+    W = layer.to_dense()
+    assert W.shape == (n, n)
+    torch.testing.assert_close(layer.apply_bias(x @ W), layer(x), rtol=1e-3, atol=1e-3)
+
+
+def test_to_dense():
+    for cls in set(class_map.values()):
+        _test_to_dense(cls.class_type, 64, 10)
+
+
+def _test_rectangular(class_type, m, n, batch_size):
+    layer = StructuredLinear(class_type, layer_size=n, hidden_size=m, r=2).to(device)
+    x = torch.randn(batch_size, n, device=device)
+    out = layer(x)
+    assert out.shape == (batch_size, m)
+    W = layer.to_dense()
+    assert W.shape == (n, m)
+    torch.testing.assert_close(layer.apply_bias(x @ W), out, rtol=1e-3, atol=1e-3)
+    # With nilpotent operators the rectangular matrix is the top-left block of
+    # the square one with zero-padded generators
+    if class_type in ("toeplitz", "subdiagonal"):
+        N = max(m, n)
+        square = StructuredLinear(class_type, layer_size=N, r=2).to(device)
+        with torch.no_grad():
+            square.G.copy_(F.pad(layer.G, (0, N - m)))
+            square.H.copy_(F.pad(layer.H, (0, N - n)))
+            if class_type == "subdiagonal":
+                square.subd_A[: m - 1] = layer.subd_A
+                square.subd_B[: n - 1] = layer.subd_B
+        expected = square(F.pad(x, (0, N - n)))[:, :m]
+        torch.testing.assert_close(out, expected, rtol=1e-3, atol=1e-3)
+
+
+def test_rectangular():
+    for cls in set(class_map.values()):
+        if not cls.rectangular:
+            continue
+        _test_rectangular(cls.class_type, 48, 64, 10)
+        _test_rectangular(cls.class_type, 100, 30, 10)
+
+
+def test_deploy():
+    net = nn.Sequential(
+        StructuredLinear("toeplitz", layer_size=64, r=2),
+        nn.ReLU(),
+        StructuredLinear("subdiagonal", layer_size=64, r=2),
+    ).to(device)
+    x = torch.randn(10, 64, device=device)
+    expected = net(x)
+
+    decisions = deploy(net, threshold=64)
+    assert decisions == {"0": "dense", "2": "dense"}
+    assert isinstance(net[0], Dense) and isinstance(net[2], Dense)
+    torch.testing.assert_close(net(x), expected, rtol=1e-3, atol=1e-3)
+
+    decisions = deploy(net, batch_size=10, n_iters=2)
+    assert decisions == {}  # Already materialized
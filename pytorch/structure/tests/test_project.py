@@ -0,0 +1,37 @@
+import torch
+import torch.nn as nn
+from mle.structure.layer import StructuredLinear
+from mle.structure.project import project, randomized_svd
+
+device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+torch.manual_seed(0)
+
+
+def test_randomized_svd():
+    M = torch.randn(3, 40, 4, device=device) @ torch.randn(3, 4, 30, device=device)
+    U, S, V = randomized_svd(M, 4)
+    torch.testing.assert_close(U @ torch.diag_embed(S) @ V.transpose(1, 2), M, rtol=1e-3, atol=1e-3)
+
+
+def _test_project(class_type, m, n, r):
+    # A dense model whose weights are exactly of class_type and rank r is recovered
+    net = nn.Sequential(nn.Linear(n, m), nn.ReLU(), nn.Linear(m, m), nn.ReLU(), nn.Linear(m, m)).to(device)
+    with torch.no_grad():
+        for linear in net[::2]:
+            out_features, in_features = linear.weight.shape
+            layer = StructuredLinear(class_type, layer_size=in_features, hidden_size=out_features, r=r).to(device)
+            linear.weight.copy_(layer.to_dense().t())
+    x = torch.randn(10, n, device=device)
+    expected = net(x)
+    errors = project(net, class_type, r)
+    assert set(errors) == {"0", "2", "4"}
+    assert max(errors.values()) < 1e-4
+    assert not any(isinstance(module, nn.Linear) for module in net.modules())
+    torch.testing.assert_close(net(x), expected, rtol=1e-3, atol=1e-3)
+
+
+def test_project():
+    for class_type in ("low_rank", "toeplitz", "subdiagonal"):
+        _test_project(class_type, 32, 32, 2)
+        _test_project(class_type, 24, 40, 3)
@@ -1,5 +1,7 @@
 import torch
 from mle.structure.toeplitz import (
+    hankel_krylov_multiply,
+    toeplitz_krylov_multiply,
     toeplitz_krylov_transpose_multiply,
     toeplitz_mult_slow,
     toeplitz_mult_slow_fast,
@@ -118,3 +120,17 @@ def _test_memory():
         b = torch.empty((2, 4096), dtype=torch.float, device=device, requires_grad=True)
         c = toeplitz_mult(a, a, b)
         (g,) = torch.autograd.grad(torch.sum(c), a, retain_graph=True)
+
+
+def test_hankel_krylov_multiply():
+    rank, n, batch_size = 3, 16, 5
+    v = torch.randn(rank, n, device=device)
+    for f in (0.0, 1.0, -1.0):
+        for k in (n, n // 2 + 1):
+            w = torch.randn(batch_size, rank, k, device=device)
+            torch.testing.assert_close(
+                hankel_krylov_multiply(v, w, f),
+                toeplitz_krylov_multiply(v, w, f).flip(-1),
+                rtol=1e-4,
+                atol=1e-4,
+            )
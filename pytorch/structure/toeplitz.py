@@ -47,42 +47,79 @@ def toeplitz_krylov_transpose_multiply(v, u, f=0.0):
         uv = torch.fft.fft(u_f[:, None] * v_f[None])
         return (eta * uv).real
     else:
-        u_f = torch.fft.rfft(torch.cat((u.flip(1), torch.zeros_like(u)), dim=-1))
-        v_f = torch.fft.rfft(torch.cat((v, torch.zeros_like(v)), dim=-1))
+        u_f = torch.fft.rfft(u.flip(1), n=2 * n)
+        v_f = torch.fft.rfft(v, n=2 * n)
         uv_f = u_f[:, None] * v_f[None]
         return torch.fft.irfft(uv_f)[..., :n].flip(2)
 
 
 def toeplitz_krylov_multiply(v, w, f=0.0):
     """Multiply sum_i Krylov(Z_f, v_i) @ w_i.
+    w may be shorter than v, in which case only the first k columns of the
+    Krylov matrices are used (the zero padding is done inside the FFT).
     Parameters:
         v: (rank, n)
-        w: (batch_size, rank, n)
+        w: (batch_size, rank, k) with k <= n
         f: real number
     Returns:
         product: (batch, n)
     """
-    _, rank, n = w.shape
-    rank_, n_ = v.shape
-    assert n == n_, "w and v must have the same last dimension"
+    _, rank, k = w.shape
+    rank_, n = v.shape
+    assert k <= n, "w can not be longer than v"
     assert rank == rank_, "w and v must have the same rank"
     if f != 0.0:  # cycle version
         eta = torch.tensor(f, dtype=torch.complex64) ** (
             torch.arange(n, dtype=v.dtype, device=v.device) / n
         )
-        w_f = torch.fft.fft(1 / eta * w)
+        w_f = torch.fft.fft(1 / eta[:k] * w, n=n)
         v_f = torch.fft.fft(eta * v)
         wv_sum_f = (w_f * v_f).sum(dim=1)  # Does this happen in the right space?
-        wv_sum = torch.fft.ifft(wv_sum_f, 1)
+        wv_sum = torch.fft.ifft(wv_sum_f)
         return (1 / eta * wv_sum).real
     else:
-        w_f = torch.fft.rfft(torch.cat((w, torch.zeros_like(w)), dim=-1))
-        v_f = torch.fft.rfft(torch.cat((v, torch.zeros_like(v)), dim=-1))
+        w_f = torch.fft.rfft(w, n=2 * n)
+        v_f = torch.fft.rfft(v, n=2 * n)
         wv_sum_f = (w_f * v_f).sum(dim=1)
         # return torch.fft.irfft(wv_sum_f, 1, signal_sizes=(2 * n,))[..., :n]
         return torch.fft.irfft(wv_sum_f)[..., :n]
 
 
+def hankel_krylov_multiply(v, w, f=0.0):
+    """Multiply J @ sum_i Krylov(Z_f, v_i) @ w_i, where J reverses the order of the rows.
+    Same as toeplitz_krylov_multiply(v, w, f).flip(-1), but the reversal is folded
+    into the inverse FFT (reversing the output is a phase shift of its spectrum,
+    plus a conjugation in the real case), so the output is never copied to flip it.
+    Parameters:
+        v: (rank, n)
+        w: (batch_size, rank, k) with k <= n
+        f: real number
+    Returns:
+        product: (batch, n)
+    """
+    _, rank, k = w.shape
+    rank_, n = v.shape
+    assert k <= n, "w can not be longer than v"
+    assert rank == rank_, "w and v must have the same rank"
+    arange = torch.arange(n, dtype=v.dtype, device=v.device)
+    if f != 0.0:  # cycle version
+        eta = torch.tensor(f, dtype=torch.complex64) ** (arange / n)
+        w_f = torch.fft.fft(1 / eta[:k] * w, n=n)
+        v_f = torch.fft.fft(eta * v)
+        wv_sum_f = (w_f * v_f).sum(dim=1)
+        # (1 / eta * ifft(wv_sum_f))[n - 1 - j] = fft(wv_sum_f * omega^(-m))[j] / (n * eta[n - 1 - j])
+        shift = torch.exp(-2j * torch.pi / n * arange)
+        eta_rev = torch.tensor(f, dtype=torch.complex64) ** ((n - 1 - arange) / n)
+        return (torch.fft.fft(wv_sum_f * shift) / (n * eta_rev)).real
+    else:
+        w_f = torch.fft.rfft(w, n=2 * n)
+        v_f = torch.fft.rfft(v, n=2 * n)
+        wv_sum_f = (w_f * v_f).sum(dim=1)
+        # s = irfft(wv_sum_f): irfft(conj(wv_sum_f))[t] = s[-t], and shifting by n + 1 gives s[n - 1 - j]
+        shift = torch.exp(1j * torch.pi * (n + 1) / n * torch.arange(n + 1, dtype=v.dtype, device=v.device))
+        return torch.fft.irfft(wv_sum_f.conj() * shift, n=2 * n)[..., :n]
+
+
 def toeplitz_krylov_multiply_by_autodiff(v, w, f=0.0):
     """Multiply sum_i Krylov(Z_f, v_i) @ w_i, using Pytorch's autodiff.
     This function is just to check the result of toeplitz_krylov_multiply.
@@ -105,18 +142,36 @@ def toeplitz_krylov_multiply_by_autodiff(v, w, f=0.0):
 
 
 def toeplitz_mult(G, H, x, cycle=True):
-    """Multiply sum_i Krylov(Z_f, G_i) @ Krylov(Z_f, H_i) @ x.
+    """Multiply sum_i Krylov(Z_f, G_i) @ Krylov(Z_f, H_i)^T @ x.
+    G and H may have different lengths m and n (a rectangular m x n matrix),
+    in which case both Krylov matrices are truncated to min(m, n) columns.
     Parameters:
-        G: Tensor of shape (rank, n)
+        G: Tensor of shape (rank, m)
         H: Tensor of shape (rank, n)
         x: Tensor of shape (batch_size, n)
         cycle: whether to use f = (1, -1) or f = (0, 0)
     Returns:
-        product: Tensor of shape (batch_size, n)
+        product: Tensor of shape (batch_size, m)
+    """
+    f = (1, -1) if cycle else (0, 0)
+    transpose_out = toeplitz_krylov_transpose_multiply(H, x, f[1])
+    return toeplitz_krylov_multiply(G, transpose_out[..., : G.shape[-1]], f[0])
+
+
+def hankel_mult(G, H, x, cycle=True):
+    """Multiply J @ sum_i Krylov(Z_f, G_i) @ Krylov(Z_f, H_i)^T @ x, where J reverses the
+    order of the rows, i.e. toeplitz_mult(G, H, x, cycle).flip(-1) without the flip.
+    Parameters:
+        G: Tensor of shape (rank, m)
+        H: Tensor of shape (rank, n)
+        x: Tensor of shape (batch_size, n)
+        cycle: whether to use f = (1, -1) or f = (0, 0)
+    Returns:
+        product: Tensor of shape (batch_size, m)
     """
     f = (1, -1) if cycle else (0, 0)
     transpose_out = toeplitz_krylov_transpose_multiply(H, x, f[1])
-    return toeplitz_krylov_multiply(G, transpose_out, f[0])
+    return hankel_krylov_multiply(G, transpose_out[..., : G.shape[-1]], f[0])
 
 
 ##### Slow multiplication for the Toeplitz-like case
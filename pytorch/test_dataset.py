@@ -0,0 +1,44 @@
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from dataset import SyntheticBatch, SyntheticDataset, counter_randn, synthetic_target
+
+
+def test_synthetic_target():
+    target = synthetic_target("true_toeplitz_n64_r3")
+    assert target.class_type == "toeplitz"
+    assert (target.layer_size, target.hidden_size, target.r) == (64, 64, 3)
+    assert not any(p.requires_grad for p in target.parameters())
+    # Fixed by the name
+    torch.testing.assert_close(target.to_dense(), synthetic_target("true_toeplitz_n64_r3").to_dense())
+    target = synthetic_target("true_low_rank")
+    assert (target.class_type, target.layer_size, target.r) == ("low_rank", 1024, 2)
+
+
+def test_synthetic_batch():
+    target = synthetic_target("true_toeplitz_n64_r3")
+    collate = SyntheticBatch(target)
+    dataset = SyntheticDataset(100, seed=0)
+    X, Y = collate([dataset[i] for i in [3, 17, 42]])
+    assert X.shape == Y.shape == (3, 64)
+    torch.testing.assert_close(Y, X @ target.to_dense(), rtol=1e-4, atol=1e-4)
+    # Example i does not depend on the batch it is in
+    X_shuffled, _ = collate([dataset[i] for i in [42, 99, 3]])
+    torch.testing.assert_close(X_shuffled[[2, 0]], X[[0, 2]], rtol=0, atol=0)
+    # nor on earlier draws from the global generator
+    torch.randn(10)
+    torch.testing.assert_close(collate([dataset[17]])[0][0], X[1], rtol=0, atol=0)
+    # The seed selects a different set of examples
+    X_other, _ = collate([(1, i) for i in [3, 17, 42]])
+    assert not torch.allclose(X_other, X)
+
+
+def test_counter_randn():
+    X = counter_randn(0, range(60000), 64)
+    assert abs(X.mean().item()) < 1e-2 and abs(X.std().item() - 1) < 1e-2
+    # No row is a permutation of another one
+    assert len(torch.unique(X.sort(1).values, dim=0)) == len(X)
+    assert counter_randn(0, [5], 7).shape == (1, 7)
@@ -0,0 +1,74 @@
+"""Training throughput of the structured layers as a function of batch size.
+
+For each class in structure.layer.class_map, times forward + backward of a
+single layer for increasing batch sizes and reports the cost per sample. The
+fast multiplications amortize their FFTs / recursions over the batch, so the
+per-sample cost drops until the device is saturated; the batch size where it
+flattens out is the smallest one worth training with, and --accum-steps in
+main.py lets a larger batch than fits in memory be split into micro-batches of
+that size.
+
+Example:
+python throughput.py --layer-size 1024 --rank 4 --batch-sizes 1 4 16 64 256 1024
+"""
+
+import sys, os
+import argparse
+import time
+import torch
+
+pytorch_root = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, pytorch_root)
+import structure.layer as sl
+
+device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+
+def time_step(layer, batch_size, n_iters):
+    """Average time (seconds) of a forward and backward pass of layer on a random batch."""
+    x = torch.randn(batch_size, layer.layer_size, device=device)
+    sync = torch.cuda.synchronize if device.type == 'cuda' else (lambda: None)
+    layer(x).sum().backward()  # Warmup
+    sync()
+    start = time.perf_counter()
+    for _ in range(n_iters):
+        layer.zero_grad()
+        layer(x).sum().backward()
+    sync()
+    return (time.perf_counter() - start) / n_iters
+
+
+def flat_batch_size(batch_sizes, per_sample, tol):
+    """Smallest batch size whose per-sample cost is within a factor (1 + tol) of the best one."""
+    best = min(per_sample)
+    return next(b for b, t in zip(batch_sizes, per_sample) if t <= (1 + tol) * best)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--layer-size', type=int, default=1024)
+    parser.add_argument('--rank', type=int, default=4)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 4, 16, 64, 256, 1024])
+    parser.add_argument('--class-types', nargs='+', default=None, help='Default: every class in class_map')
+    parser.add_argument('--iters', type=int, default=10, help='Timed iterations per measurement')
+    parser.add_argument('--tol', type=float, default=0.1, help='Tolerance on the per-sample cost to call it flat')
+    args = parser.parse_args()
+
+    class_types = args.class_types
+    if class_types is None:
+        class_types = sorted(set(cls.class_type for cls in sl.class_map.values()))
+    print('Per-sample forward+backward time (us), layer size %d, rank %d, %s' % (args.layer_size, args.rank, device))
+    print('%-20s' % 'class' + ''.join('%10d' % b for b in args.batch_sizes) + '%10s' % 'flat at')
+    for class_type in class_types:
+        try:
+            layer = sl.StructuredLinear(class_type, layer_size=args.layer_size, r=args.rank).to(device)
+            per_sample = [time_step(layer, b, args.iters) / b for b in args.batch_sizes]
+        except Exception as e:  # e.g. classes that need the CUDA extensions
+            print('%-20s skipped: %s' % (class_type, e))
+            continue
+        flat = flat_batch_size(args.batch_sizes, per_sample, args.tol)
+        print('%-20s' % class_type + ''.join('%10.2f' % (1e6 * t) for t in per_sample) + '%10d' % flat)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,7 +4,6 @@ import struct
 import numpy as np
 #import matplotlib.pyplot as plt
 import scipy.misc
-from tqdm import tqdm
 from os import makedirs
 from os.path import join
 from os.path import exists
@@ -43,9 +42,11 @@ class NORBExample:
 
 class NORBDataset:
 
-    # Number of examples in both train and test set
+    # Number of examples in each archive of the train and test set
     n_examples = 29160
 
+    splits = ['train' + str(i+1) for i in range(10)] + ['test1', 'test2']
+
     # Categories present in small NORB dataset
     categories = ['animal', 'human', 'airplane', 'truck', 'car']
 
@@ -62,69 +63,8 @@ class NORBDataset:
         self.dataset_root = dataset_root
         self.initialized  = False
 
-        # Store path for each file in small NORB dataset (for compatibility the original filename is kept)
-        self.dataset_files = {
-            'train1': {
-                'cat':  join(self.dataset_root, 'norb-5x46789x9x18x6x2x108x108-training-01-cat.mat'),
-                'info': join(self.dataset_root, 'norb-5x46789x9x18x6x2x108x108-training-01-info.mat'),
-                'dat':  join(self.dataset_root, 'norb-5x46789x9x18x6x2x108x108-training-01-dat.mat')
-            },
-            'train2': {
-                'cat':  join(self.dataset_root, 'norb-5x46789x9x18x6x2x108x108-training-02-cat.mat'),
-                'info': join(self.dataset_root, 'norb-5x46789x9x18x6x2x108x108-training-02-info.mat'),
-                'dat':  join(self.dataset_root, 'norb-5x46789x9x18x6x2x108x108-training-02-dat.mat')
-            },
-            'train3': {
-                'cat':  join(self.dataset_root, 'norb-5x46789x9x18x6x2x108x108-training-03-cat.mat'),
-                'info': join(self.dataset_root, 'norb-5x46789x9x18x6x2x108x108-training-03-info.mat'),
-                'dat':  join(self.dataset_root, 'norb-5x46789x9x18x6x2x108x108-training-03-dat.mat')
-            },
-            'train4': {
-                'cat':  join(self.dataset_root, 'norb-5x46789x9x18x6x2x108x108-training-04-cat.mat'),
-                'info': join(self.dataset_root, 'norb-5x46789x9x18x6x2x108x108-training-04-info.mat'),
-                'dat':  join(self.dataset_root, 'norb-5x46789x9x18x6x2x108x108-training-04-dat.mat')
-            },
-            'train5': {
-                'cat':  join(self.dataset_root, 'norb-5x46789x9x18x6x2x108x108-training-05-cat.mat'),
-                'info': join(self.dataset_root, 'norb-5x46789x9x18x6x2x108x108-training-05-info.mat'),
-                'dat':  join(self.dataset_root, 'norb-5x46789x9x18x6x2x108x108-training-05-dat.mat')
-            },
-            'train6': {
-                'cat':  join(self.dataset_root, 'norb-5x46789x9x18x6x2x108x108-training-06-cat.mat'),
-                'info': join(self.dataset_root, 'norb-5x46789x9x18x6x2x108x108-training-06-info.mat'),
-                'dat':  join(self.dataset_root, 'norb-5x46789x9x18x6x2x108x108-training-06-dat.mat')
-            },
-            'train7': {
-                'cat':  join(self.dataset_root, 'norb-5x46789x9x18x6x2x108x108-training-07-cat.mat'),
-                'info': join(self.dataset_root, 'norb-5x46789x9x18x6x2x108x108-training-07-info.mat'),
-                'dat':  join(self.dataset_root, 'norb-5x46789x9x18x6x2x108x108-training-07-dat.mat')
-            },
-            'train8': {
-                'cat':  join(self.dataset_root, 'norb-5x46789x9x18x6x2x108x108-training-08-cat.mat'),
-                'info': join(self.dataset_root, 'norb-5x46789x9x18x6x2x108x108-training-08-info.mat'),
-                'dat':  join(self.dataset_root, 'norb-5x46789x9x18x6x2x108x108-training-08-dat.mat')
-            },
-            'train9': {
-                'cat':  join(self.dataset_root, 'norb-5x46789x9x18x6x2x108x108-training-09-cat.mat'),
-                'info': join(self.dataset_root, 'norb-5x46789x9x18x6x2x108x108-training-09-info.mat'),
-                'dat':  join(self.dataset_root, 'norb-5x46789x9x18x6x2x108x108-training-09-dat.mat')
-            },
-            'train10': {
-                'cat':  join(self.dataset_root, 'norb-5x46789x9x18x6x2x108x108-training-10-cat.mat'),
-                'info': join(self.dataset_root, 'norb-5x46789x9x18x6x2x108x108-training-10-info.mat'),
-                'dat':  join(self.dataset_root, 'norb-5x46789x9x18x6x2x108x108-training-10-dat.mat')
-            },
-            'test1':  {
-                'cat':  join(self.dataset_root, 'norb-5x01235x9x18x6x2x108x108-testing-01-cat.mat'),
-                'info': join(self.dataset_root, 'norb-5x01235x9x18x6x2x108x108-testing-01-info.mat'),
-                'dat':  join(self.dataset_root, 'norb-5x01235x9x18x6x2x108x108-testing-01-dat.mat')
-            },
-            'test2':  {
-                'cat':  join(self.dataset_root, 'norb-5x01235x9x18x6x2x108x108-testing-02-cat.mat'),
-                'info': join(self.dataset_root, 'norb-5x01235x9x18x6x2x108x108-testing-02-info.mat'),
-                'dat':  join(self.dataset_root, 'norb-5x01235x9x18x6x2x108x108-testing-02-dat.mat')
-            }
-        }
+        # Store path for each file in NORB dataset (for compatibility the original filename is kept)
+        self.dataset_files = {name: NORBDataset.file_paths(self.dataset_root, name) for name in NORBDataset.splits}
 
         # Initialize both train and test data structures
         self.data = {}
@@ -246,6 +186,17 @@ class NORBDataset:
             small_norb_example.azimuth   = info_data[i][2]
             small_norb_example.lighting  = info_data[i][3]
 
+    @staticmethod
+    def file_paths(dataset_root, split):
+        """
+        Paths of the 'cat', 'info' and 'dat' files of a split ('train1', ..., 'train10', 'test1', 'test2')
+        """
+        if split.startswith('train'):
+            prefix = 'norb-5x46789x9x18x6x2x108x108-training-{:02d}-'.format(int(split[len('train'):]))
+        else:
+            prefix = 'norb-5x01235x9x18x6x2x108x108-testing-{:02d}-'.format(int(split[len('test'):]))
+        return {kind: join(dataset_root, prefix + kind + '.mat') for kind in ['cat', 'info', 'dat']}
+
     @staticmethod
     def matrix_type_from_magic(magic_number):
         """
@@ -299,85 +250,88 @@ class NORBDataset:
                             'dimensions': dimensions}
         return file_header_data
 
+    # Numpy dtype of each matrix type (all little endian)
+    matrix_dtypes = {'single precision matrix': '<f4',
+                     'double precision matrix': '<f8',
+                     'integer matrix': '<i4',
+                     'byte matrix': 'u1',
+                     'short matrix': '<i2'}
+
     @staticmethod
-    def _parse_NORB_cat_file(file_path):
+    def memmap_NORB_file(file_path):
         """
-        Parse small NORB category file
+        Memory map the matrix stored in a NORB binary file, without reading it
 
         Parameters
         ----------
         file_path: str
-            Path of the small NORB `*-cat.mat` file
+            Path of a NORB `*-cat.mat`, `*-info.mat` or `*-dat.mat` file
 
         Returns
         -------
-        examples: ndarray
-            Ndarray of shape (24300,) containing the category of each example
+        matrix: np.memmap
+            Read-only array with the dimensions given in the file header
         """
         with open(file_path, mode='rb') as f:
             header = NORBDataset._parse_small_NORB_header(f)
+        dimensions = header['dimensions']
+        # The header always stores at least 3 dimensions, the unused ones are ignored
+        offset = 8 + 4 * max(len(dimensions), 3)
+        return np.memmap(file_path, dtype=NORBDataset.matrix_dtypes[header['matrix_type']], mode='r',
+                         offset=offset, shape=tuple(dimensions))
 
-            num_examples, = header['dimensions']
-
-            struct.unpack('<BBBB', f.read(4))  # ignore this integer
-            struct.unpack('<BBBB', f.read(4))  # ignore this integer
+    @staticmethod
+    def _parse_NORB_cat_file(file_path):
+        """
+        Parse NORB category file
 
-            examples = np.zeros(shape=num_examples, dtype=np.int32)
-            for i in tqdm(list(range(num_examples)), desc='Loading categories...'):
-                category, = struct.unpack('<i', f.read(4))
-                examples[i] = category
+        Parameters
+        ----------
+        file_path: str
+            Path of the NORB `*-cat.mat` file
 
-            return examples
+        Returns
+        -------
+        examples: ndarray
+            Ndarray of shape (29160,) containing the category of each example
+        """
+        return np.array(NORBDataset.memmap_NORB_file(file_path), dtype=np.int32)
 
     @staticmethod
     def _parse_NORB_dat_file(file_path):
         """
-        Parse small NORB data file
+        Parse NORB data file
 
         Parameters
         ----------
         file_path: str
-            Path of the small NORB `*-dat.mat` file
+            Path of the NORB `*-dat.mat` file
 
         Returns
         -------
         examples: ndarray
-            Ndarray of shape (48600, 96, 96) containing images couples. Each image couple
+            Ndarray of shape (58320, 108, 108) containing images couples. Each image couple
             is stored in position [i, :, :] and [i+1, :, :]
         """
         print('norb file path: ', file_path)
-        with open(file_path, mode='rb') as f:
-
-            header = NORBDataset._parse_small_NORB_header(f)
-            print('header: ', header)
-            num_examples, channels, height, width = header['dimensions']
-
-            examples = np.zeros(shape=(num_examples * channels, height, width), dtype=np.uint8)
-
-            for i in tqdm(list(range(num_examples * channels)), desc='Loading images...'):
-
-                # Read raw image data and restore shape as appropriate
-                image = struct.unpack('<' + height * width * 'B', f.read(height * width))
-                image = np.uint8(np.reshape(image, newshape=(height, width)))
-
-                examples[i] = image
-
-        return examples
+        dat = NORBDataset.memmap_NORB_file(file_path)
+        num_examples, channels, height, width = dat.shape
+        return np.array(dat).reshape(num_examples * channels, height, width)
 
     @staticmethod
     def _parse_NORB_info_file(file_path):
         """
-        Parse small NORB information file
+        Parse NORB information file
 
         Parameters
         ----------
         file_path: str
-            Path of the small NORB `*-info.mat` file
+            Path of the NORB `*-info.mat` file
 
         Returns
         -------
         examples: ndarray
-            Ndarray of shape (24300,4) containing the additional info of each example.
+            Ndarray of shape (29160,4) containing the additional info of each example.
 
              - column 1: the instance in the category (0 to 9)
              - column 2: the elevation (0 to 8, which mean cameras are 30, 35,40,45,50,55,60,65,70
@@ -385,20 +339,4 @@ class NORBDataset:
              - column 3: the azimuth (0,2,4,...,34, multiply by 10 to get the azimuth in degrees)
              - column 4: the lighting condition (0 to 5)
         """
-        with open(file_path, mode='rb') as f:
-
-            header = NORBDataset._parse_small_NORB_header(f)
-
-            struct.unpack('<BBBB', f.read(4))  # ignore this integer
-
-            num_examples, num_info = header['dimensions']
-
-            examples = np.zeros(shape=(num_examples, num_info), dtype=np.int32)
-
-            for r in tqdm(list(range(num_examples)), desc='Loading info...'):
-                for c in range(num_info):
-                    info, = struct.unpack('<i', f.read(4))
-                    examples[r, c] = info
-
-        return examples
-
+        return np.array(NORBDataset.memmap_NORB_file(file_path), dtype=np.int32)
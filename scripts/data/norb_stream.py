@@ -0,0 +1,124 @@
+"""
+Streaming preprocessing of the NORB / small NORB binary archives.
+
+The `*-dat.mat` archives are memory mapped and read in chunks of examples;
+each chunk is downsampled (nearest neighbour, left stereo image only) by a
+pool of worker processes that write it straight into a preallocated .npy file
+on disk. Memory use is bounded by the chunk size times the number of workers,
+whatever the size of the dataset.
+
+The outputs are out_loc + '_X.npy' (float32, one flattened image per row) and
+out_loc + '_Y.npy' (float32 one-hot labels), the files pytorch/dataset.py maps
+for the dataset at out_loc.
+"""
+
+import multiprocessing
+import numpy as np
+
+CHUNK_SIZE = 1024
+
+
+def resize_indices(in_size, out_size):
+    """Source pixel of each output pixel for nearest neighbour resizing (as scipy.misc.imresize 'nearest')."""
+    return np.floor((np.arange(out_size) + 0.5) * in_size / out_size).astype(np.int64)
+
+
+def _open_output(path, shape):
+    return np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=shape)
+
+
+def _process_chunk(task):
+    """
+    Downsample the left images of examples [start, stop) of dat_file, scale them,
+    and write them to the rows out_rows of the X file.
+    Returns the sum and sum of squares of the written rows, for normalization.
+    """
+    memmap_file, dat_file, start, stop, out_rows, X_path, size, scale = task
+    dat = memmap_file(dat_file)
+    rows = resize_indices(dat.shape[2], size[0])
+    cols = resize_indices(dat.shape[3], size[1])
+    images = dat[start:stop, 0][:, rows[:, None], cols]
+    images = images.reshape(stop - start, -1).astype(np.float32) / scale
+    X = np.load(X_path, mmap_mode='r+')
+    X[out_rows] = images
+    X.flush()
+    images = images.astype(np.float64)
+    return images.sum(axis=0), (images ** 2).sum(axis=0)
+
+
+def _normalize_chunk(task):
+    X_path, start, stop, mean, sd = task
+    X = np.load(X_path, mmap_mode='r+')
+    X[start:stop] = (X[start:stop] - mean) / sd
+    X.flush()
+
+
+def process_archives(memmap_file, archives, out_loc, size, n_categories, scale=1.0, normalize=False,
+                     mean=None, sd=None, processes=None, chunk_size=CHUNK_SIZE):
+    """
+    Downsample, shuffle and save the examples of archives.
+
+    Parameters
+    ----------
+    memmap_file: function
+        Memory maps a NORB binary file, e.g. NORBDataset.memmap_NORB_file
+    archives: list
+        (dat_file, cat_file) of each archive to process
+    out_loc: str
+        Prefix of the output .npy files
+    size: tuple
+        Size of the downsampled images
+    n_categories: int
+        Number of classes (width of the one-hot labels)
+    scale: float
+        Pixel values are divided by scale
+    normalize: bool
+        Standardize each pixel to zero mean and unit variance, with mean and sd
+        if given (e.g. those of the training set) or else with those of this set
+
+    Returns
+    -------
+    mean, sd: ndarray
+        Per-pixel statistics used for normalization (None if normalize is False)
+    """
+    categories = [np.array(memmap_file(cat_file), dtype=np.int64) for _, cat_file in archives]
+    n_examples = sum(len(cat) for cat in categories)
+    n_features = size[0] * size[1]
+    print('Examples: ', n_examples)
+
+    # Shuffle: example i is written to row perm[i]
+    perm = np.random.permutation(n_examples)
+    X_path, Y_path = out_loc + '_X.npy', out_loc + '_Y.npy'
+    _open_output(X_path, (n_examples, n_features)).flush()
+    Y = _open_output(Y_path, (n_examples, n_categories))
+    Y[perm, np.concatenate(categories)] = 1
+    Y.flush()
+    del Y
+
+    tasks = []
+    offset = 0
+    for (dat_file, _), cat in zip(archives, categories):
+        for start in range(0, len(cat), chunk_size):
+            stop = min(start + chunk_size, len(cat))
+            tasks.append((memmap_file, dat_file, start, stop, perm[offset+start:offset+stop], X_path, size, scale))
+        offset += len(cat)
+
+    with multiprocessing.Pool(processes) as pool:
+        total, total_sq = np.zeros(n_features), np.zeros(n_features)
+        for i, (s, s_sq) in enumerate(pool.imap_unordered(_process_chunk, tasks)):
+            total += s
+            total_sq += s_sq
+            print('Processed chunk {}/{}'.format(i + 1, len(tasks)))
+
+        if normalize:
+            if mean is None and sd is None:
+                mean = total / n_examples
+                sd = np.sqrt(np.maximum(total_sq / n_examples - mean ** 2, 0))
+            tasks = [(X_path, start, min(start + chunk_size, n_examples), mean.astype(np.float32), sd.astype(np.float32))
+                     for start in range(0, n_examples, chunk_size)]
+            for _ in pool.imap_unordered(_normalize_chunk, tasks):
+                pass
+        else:
+            mean = sd = None
+    print('Saved ', X_path, Y_path)
+    return mean, sd
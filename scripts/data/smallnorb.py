@@ -4,7 +4,6 @@ import struct
 import numpy as np
 import matplotlib.pyplot as plt
 import scipy.misc
-from tqdm import tqdm
 from os import makedirs
 from os.path import join
 from os.path import exists
@@ -246,6 +245,36 @@ class SmallNORBDataset:
                             'dimensions': dimensions}
         return file_header_data
 
+    # Numpy dtype of each matrix type (all little endian)
+    matrix_dtypes = {'single precision matrix': '<f4',
+                     'double precision matrix': '<f8',
+                     'integer matrix': '<i4',
+                     'byte matrix': 'u1',
+                     'short matrix': '<i2'}
+
+    @staticmethod
+    def memmap_NORB_file(file_path):
+        """
+        Memory map the matrix stored in a small NORB binary file, without reading it
+
+        Parameters
+        ----------
+        file_path: str
+            Path of a small NORB `*-cat.mat`, `*-info.mat` or `*-dat.mat` file
+
+        Returns
+        -------
+        matrix: np.memmap
+            Read-only array with the dimensions given in the file header
+        """
+        with open(file_path, mode='rb') as f:
+            header = SmallNORBDataset._parse_small_NORB_header(f)
+        dimensions = header['dimensions']
+        # The header always stores at least 3 dimensions, the unused ones are ignored
+        offset = 8 + 4 * max(len(dimensions), 3)
+        return np.memmap(file_path, dtype=SmallNORBDataset.matrix_dtypes[header['matrix_type']], mode='r',
+                         offset=offset, shape=tuple(dimensions))
+
     @staticmethod
     def _parse_NORB_cat_file(file_path):
         """
@@ -261,20 +290,7 @@ class SmallNORBDataset:
         examples: ndarray
             Ndarray of shape (24300,) containing the category of each example
         """
-        with open(file_path, mode='rb') as f:
-            header = SmallNORBDataset._parse_small_NORB_header(f)
-
-            num_examples, = header['dimensions']
-
-            struct.unpack('<BBBB', f.read(4))  # ignore this integer
-            struct.unpack('<BBBB', f.read(4))  # ignore this integer
-
-            examples = np.zeros(shape=num_examples, dtype=np.int32)
-            for i in tqdm(list(range(num_examples)), desc='Loading categories...'):
-                category, = struct.unpack('<i', f.read(4))
-                examples[i] = category
-
-            return examples
+        return np.array(SmallNORBDataset.memmap_NORB_file(file_path), dtype=np.int32)
 
     @staticmethod
     def _parse_NORB_dat_file(file_path):
@@ -292,23 +308,9 @@ class SmallNORBDataset:
             Ndarray of shape (48600, 96, 96) containing images couples. Each image couple
             is stored in position [i, :, :] and [i+1, :, :]
         """
-        with open(file_path, mode='rb') as f:
-
-            header = SmallNORBDataset._parse_small_NORB_header(f)
-
-            num_examples, channels, height, width = header['dimensions']
-
-            examples = np.zeros(shape=(num_examples * channels, height, width), dtype=np.uint8)
-
-            for i in tqdm(list(range(num_examples * channels)), desc='Loading images...'):
-
-                # Read raw image data and restore shape as appropriate
-                image = struct.unpack('<' + height * width * 'B', f.read(height * width))
-                image = np.uint8(np.reshape(image, newshape=(height, width)))
-
-                examples[i] = image
-
-        return examples
+        dat = SmallNORBDataset.memmap_NORB_file(file_path)
+        num_examples, channels, height, width = dat.shape
+        return np.array(dat).reshape(num_examples * channels, height, width)
 
     @staticmethod
     def _parse_NORB_info_file(file_path):
@@ -331,19 +333,4 @@ class SmallNORBDataset:
              - column 3: the azimuth (0,2,4,...,34, multiply by 10 to get the azimuth in degrees)
              - column 4: the lighting condition (0 to 5)
         """
-        with open(file_path, mode='rb') as f:
-
-            header = SmallNORBDataset._parse_small_NORB_header(f)
-
-            struct.unpack('<BBBB', f.read(4))  # ignore this integer
-
-            num_examples, num_info = header['dimensions']
-
-            examples = np.zeros(shape=(num_examples, num_info), dtype=np.int32)
-
-            for r in tqdm(list(range(num_examples)), desc='Loading info...'):
-                for c in range(num_info):
-                    info, = struct.unpack('<i', f.read(4))
-                    examples[r, c] = info
-
-        return examples
+        return np.array(SmallNORBDataset.memmap_NORB_file(file_path), dtype=np.int32)
@@ -1,18 +1,19 @@
 import h5py
 import scipy.io as sio
 import numpy as np
-import pickle as pkl
 
-def process(feat_loc,lab_loc,train,top_N_classes=None,N=None):
-	lab = sio.loadmat(lab_loc)['lab']
-	if train:
-		with h5py.File(feat_loc) as f:
-			feat = np.array(f['fea'])
-	else:
-		feat = sio.loadmat(feat_loc)['fea']
+CHUNK_SIZE = 65536
+
+"""
+Selects the frames of the top N classes and writes out_loc + '_X.npy' (features) and
+out_loc + '_Y.npy' (one-hot labels, in the order of top_N_classes), which pytorch/dataset.py maps.
+The training features are read from the h5 file in chunks of rows, so they never have to fit in memory.
+"""
+def process(feat_loc,lab_loc,out_loc,train,top_N_classes=None,N=None):
+	lab = sio.loadmat(lab_loc)['lab'].flatten()
 	if top_N_classes is None:
 		assert N is not None
-		counts = np.bincount(lab.flatten())
+		counts = np.bincount(lab)
 		print('counts: ', counts)
 		idx_array = np.argsort(counts)
 		print('idx array: ', idx_array)
@@ -20,30 +21,47 @@ def process(feat_loc,lab_loc,train,top_N_classes=None,N=None):
 		print('top N classes: ', top_N_classes)
 		print('top N counts: ', counts[top_N_classes])
 		print('top N total: ', np.sum(counts[top_N_classes]))
-	idx = np.array([i for i in range(lab.size) if lab[i] in top_N_classes])
-	print('idx: ', idx.shape)
+	mask = np.isin(lab, top_N_classes)
+	print('idx: ', np.count_nonzero(mask))
 
-	return feat[idx,:],lab[idx], top_N_classes
+	# Labels: position of each selected frame's class in top_N_classes
+	class_idx = np.full(max(lab.max(), np.max(top_N_classes)) + 1, -1)
+	class_idx[top_N_classes] = np.arange(len(top_N_classes))
+	Y = np.lib.format.open_memmap(out_loc + '_Y.npy', mode='w+', dtype=np.float32, shape=(np.count_nonzero(mask), len(top_N_classes)))
+	Y[np.arange(Y.shape[0]), class_idx[lab[mask]]] = 1
+	Y.flush()
+
+	if train:
+		with h5py.File(feat_loc, 'r') as f:
+			fea = f['fea']
+			X = np.lib.format.open_memmap(out_loc + '_X.npy', mode='w+', dtype=np.float32, shape=(Y.shape[0], fea.shape[1]))
+			row = 0
+			for start in range(0, fea.shape[0], CHUNK_SIZE):
+				chunk_mask = mask[start:start+CHUNK_SIZE]
+				chunk = fea[start:start+CHUNK_SIZE][chunk_mask]
+				X[row:row+chunk.shape[0]] = chunk
+				row += chunk.shape[0]
+			assert row == X.shape[0]
+	else:
+		feat = sio.loadmat(feat_loc)['fea']
+		X = np.lib.format.open_memmap(out_loc + '_X.npy', mode='w+', dtype=np.float32, shape=(Y.shape[0], feat.shape[1]))
+		X[:] = feat[mask]
+	X.flush()
 
-N = 25
-train_feat_loc = '../timit/timit_train_feat.mat'
-train_lab_loc = '../timit/timit_train_lab.mat'
-test_feat_loc = '../timit/timit_heldout_feat.mat'
-test_lab_loc = '../timit/timit_heldout_lab.mat'
-train_feat_out_loc = '../timit/timit_train_feat_top' + str(N) + '.p'
-train_lab_out_loc = '../timit/timit_train_lab_top' + str(N) + '.p'
-test_feat_out_loc = '../timit/timit_test_feat_top' + str(N) + '.p'
-test_lab_out_loc = '../timit/timit_test_lab_top' + str(N) + '.p'
+	return X, Y, top_N_classes
 
-train_feat,train_lab, top_N_classes = process(train_feat_loc,train_lab_loc,True,top_N_classes=None,N=N)
-test_feat,test_lab, _ = process(test_feat_loc,test_lab_loc,False,top_N_classes=top_N_classes,N=N)
-print('train_feat,train_lab: ', train_feat.shape, train_lab.shape)
-print('test_feat,test_lab: ', test_feat.shape, test_lab.shape)
-print('train_lab: ', np.unique(train_lab))
-print('test_lab: ', np.unique(test_lab))
+if __name__ == '__main__':
+	N = 25
+	train_feat_loc = '../timit/timit_train_feat.mat'
+	train_lab_loc = '../timit/timit_train_lab.mat'
+	test_feat_loc = '../timit/timit_heldout_feat.mat'
+	test_lab_loc = '../timit/timit_heldout_lab.mat'
+	train_out_loc = '../timit/timit_train_top' + str(N)
+	test_out_loc = '../timit/timit_test_top' + str(N)
 
-# Dump
-pkl.dump(train_feat, open(train_feat_out_loc, 'wb'),protocol=2)
-pkl.dump(train_lab, open(train_lab_out_loc, 'wb'),protocol=2)
-pkl.dump(test_feat, open(test_feat_out_loc, 'wb'),protocol=2)
-pkl.dump(test_lab, open(test_lab_out_loc, 'wb'),protocol=2)
+	train_feat,train_lab, top_N_classes = process(train_feat_loc,train_lab_loc,train_out_loc,True,top_N_classes=None,N=N)
+	test_feat,test_lab, _ = process(test_feat_loc,test_lab_loc,test_out_loc,False,top_N_classes=top_N_classes,N=N)
+	print('train_feat,train_lab: ', train_feat.shape, train_lab.shape)
+	print('test_feat,test_lab: ', test_feat.shape, test_lab.shape)
+	print('train_lab: ', top_N_classes[np.unique(np.argmax(train_lab, axis=1))])
+	print('test_lab: ', top_N_classes[np.unique(np.argmax(test_lab, axis=1))])
@@ -13,28 +13,33 @@ def kth_diag_indices(A, k):
     else:
         return rows, cols
 
-# Projects onto Toeplitz matrices, under Frobenius norm.
-def toeplitz_project_frob(A):
-	assert A.shape[0] == A.shape[1]
+# Label j - i + m - 1 of the diagonal of each entry of an m x n matrix, in [0, m + n - 1)
+def diag_labels(m, n):
+	return np.arange(n) - np.arange(m)[:, None] + m - 1
 
-	A_proj = np.zeros(A.shape)
+# Projects onto Toeplitz matrices, under Frobenius norm: every diagonal is replaced by its mean.
+# A: (..., m, n), a matrix or a batch of them. The sums of all diagonals of all matrices are
+# computed by a single bincount.
+def toeplitz_project_frob(A):
+	A = np.asarray(A, dtype=np.float64)
+	m, n = A.shape[-2:]
+	n_diags = m + n - 1
+	batch = A.reshape(-1, m*n)
 
-	# Get indices of each diagonal
-	for diag_idx in np.arange(-(A.shape[0]-1),A.shape[0]):
-		this_idx = kth_diag_indices(A, diag_idx)
-		# Get average
-		avg = np.mean(A[this_idx])
-		A_proj[this_idx] = avg
+	labels = diag_labels(m, n).ravel()
+	batch_labels = (labels + n_diags*np.arange(batch.shape[0])[:, None]).ravel()
+	sums = np.bincount(batch_labels, weights=batch.ravel(), minlength=n_diags*batch.shape[0])
+	means = sums.reshape(-1, n_diags) / np.bincount(labels, minlength=n_diags)
 
-	return A_proj
+	return means[:, labels].reshape(A.shape)
 
 # Projects onto Hankel matrices, under Frobenius norm.
 def hankel_project_frob(A):
-	A_flip = np.flipud(A)
+	A_flip = np.flip(A, axis=-2)
 
 	A_flip_proj = toeplitz_project_frob(A_flip)
 
-	return np.flipud(A_flip_proj)
+	return np.flip(A_flip_proj, axis=-2)
 
 if __name__ == '__main__':
 	A = np.random.randint(5, size=(3,3))
@@ -18,7 +18,7 @@ def vandermonde_like(dataset, params, test_freq=100, verbose=False):
 
 	W1 = vand_recon(G, H, v, params.layer_size, params.layer_size, f_V, params.r)
 	
-	y = compute_y(x, W1, params)
+	y = compute_y(x, dense_mult(W1), params)
 	
 	y_ = tf.placeholder(tf.float64, [None, params.out_size])
 	
@@ -125,7 +125,7 @@ def hankel_like(dataset, params, test_freq=100, verbose=False):
 
 	W1 = rect_recon_tf(G, H, B, params.layer_size, params.layer_size, f, g, params.r)
 
-	y = compute_y(x, W1, params)
+	y = compute_y(x, dense_mult(W1), params)
 	
 	y_ = tf.placeholder(tf.float64, [None, params.out_size])
 	
@@ -228,7 +228,7 @@ def toeplitz_like(dataset, params, test_freq=100, verbose=False):
 
 	W1 = toeplitz_like_recon(G, H, params.layer_size, params.r)
 
-	y = compute_y(x, W1, params)
+	y = compute_y(x, dense_mult(W1), params)
 	
 	y_ = tf.placeholder(tf.float64, [None, params.out_size])
 	
@@ -331,7 +331,7 @@ def low_rank(dataset, params, test_freq=100, verbose=False):
 
 	W1 = tf.matmul(G, H)
 
-	y = compute_y(x, W1, params)
+	y = compute_y(x, dense_mult(W1), params)
 	y_ = tf.placeholder(tf.float64, [None, params.out_size])
 	
 	loss, accuracy = compute_loss_and_accuracy(y, y_, params)
@@ -420,7 +420,7 @@ def unconstrained(dataset, params, test_freq=100, verbose=False):
 	# Create the model
 	x = tf.placeholder(tf.float64, [None, params.input_size])
 	W1 = tf.Variable(tf.truncated_normal([params.layer_size, params.layer_size], stddev=0.01, dtype=tf.float64))
-	y = compute_y(x, W1, params)
+	y = compute_y(x, dense_mult(W1), params)
 	y_ = tf.placeholder(tf.float64, [None, params.out_size])
 	
 	loss, accuracy = compute_loss_and_accuracy(y, y_, params)
@@ -141,18 +141,31 @@ def diag_mult_fn(d, x, n):
 
 def krylov(fn, v, n):
     # fn: takes as input a vector and multiplies by a matrix.
-    v_exp = tf.expand_dims(v,1)
-    cols = [v_exp]
-    this_col = v
-
-    for i in range(n-1):
-        this_col = fn(this_col, n)
-
-        cols.append(tf.expand_dims(this_col,1))
-
-    K = tf.stack(cols)
-
-    return tf.transpose(tf.squeeze(K))
+    # The n-1 products are a tf.scan, so the graph has a constant number of ops whatever n is
+    # (instead of n-1 copies of fn), and each step costs one application of fn.
+    cols = tf.scan(lambda col, _: fn(col, n), tf.range(n-1), initializer=v)
+    K = tf.concat([tf.expand_dims(v, 0), cols], axis=0)
+
+    return tf.transpose(K)
+
+def krylov_left_mult(fn, v, x, n):
+    # x K for K = krylov(fn, v, n) and x of shape (batch_size, n): column k is x A^k v.
+    # The Krylov vectors are computed one at a time in a tf.while_loop and never stored together,
+    # so the memory is O(batch_size n) instead of the O(n^2) of K.
+    def step(k, col, out):
+        return k + 1, fn(col, n), out.write(k, tf.squeeze(tf.matmul(x, tf.expand_dims(col, 1)), 1))
+    _, _, out = tf.while_loop(lambda k, col, out: k < n, step, (0, v, tf.TensorArray(x.dtype, size=n)))
+
+    return tf.transpose(out.stack())
+
+def krylov_right_mult(fn, v, u, n):
+    # u K^T for K = krylov(fn, v, n) and u of shape (batch_size, n): sum over k of u[:, k] (A^k v)^T,
+    # accumulated in a tf.while_loop without storing K.
+    def step(k, col, y):
+        return k + 1, fn(col, n), y + tf.expand_dims(tf.gather(u, k, axis=1), 1) * tf.expand_dims(col, 0)
+    _, _, y = tf.while_loop(lambda k, col, y: k < n, step, (0, v, tf.zeros_like(u)))
+
+    return y
 
 def test_circ_sparsity():
     n = 4
@@ -1,4 +1,5 @@
 from scipy.sparse import diags
+from scipy import sparse
 import numpy as np
 import tensorflow as tf
 import functools
@@ -6,10 +7,11 @@ from reconstruction import *
 from utils import *
 from krylov import *
 
-def check_rank(sess, x, y_, batch_xs, batch_ys, params, model):
-    if not params.check_disp:
-        return 
-
+def get_operators(sess, x, y_, batch_xs, batch_ys, params, model):
+    """
+    Current W and displacement operators A, B of the model as numpy arrays.
+    A and B are None for low_rank (E = W); returns None for classes without displacement structure.
+    """
     if params.class_type in ['unconstrained', 'symmetric']:
         if params.class_type == 'symmetric':
             A = sess.run(model['A'], feed_dict={x: batch_xs, y_: batch_ys})
@@ -23,11 +25,6 @@ def check_rank(sess, x, y_, batch_xs, batch_ys, params, model):
         A,B = gen_operators(params)
         W = sess.run(model['W'], feed_dict={x: batch_xs, y_: batch_ys})
         print('W: ', W.shape)
-        E = compute_disp(params.disp_type, W, A, B)
-
-        dr = np.linalg.matrix_rank(E)
-        norm_res = np.linalg.norm(E)
-        norm_W = np.linalg.norm(W)
 
     elif params.class_type == 'symm_tridiag_pan':
         return
@@ -53,11 +50,6 @@ def check_rank(sess, x, y_, batch_xs, batch_ys, params, model):
         B = gen_tridiag_corner(subdiag_B, supdiag_B, diag_B, f_B)
 
         W = sess.run(model['W'], feed_dict={x: batch_xs, y_: batch_ys})
-        E = compute_disp(params.disp_type, W, A, B)
-
-        dr = np.linalg.matrix_rank(E)
-        norm_res = np.linalg.norm(E)
-        norm_W = np.linalg.norm(W)
 
     elif params.class_type == 'circulant_sparsity':
         # Construct A
@@ -73,10 +65,6 @@ def check_rank(sess, x, y_, batch_xs, batch_ys, params, model):
         B = gen_Z_f(params.layer_size, x_f_B[-1], x_f_B[:-1])
 
         W = sess.run(model['W'], feed_dict={x: batch_xs, y_: batch_ys})
-        E = compute_disp(params.disp_type, W, A, B)
-        dr = np.linalg.matrix_rank(E)
-        norm_res = np.linalg.norm(E)
-        norm_W = np.linalg.norm(W)
 
     elif params.class_type == 'tridiagonal_corners':
         # Construct A
@@ -87,49 +75,93 @@ def check_rank(sess, x, y_, batch_xs, batch_ys, params, model):
             feed_dict={x: batch_xs, y_: batch_ys})     
         B = gen_tridiag_corners(subdiag_B, supdiag_B, diag_B, f_ur_B, f_ll_B)
         W = sess.run(model['W'], feed_dict={x: batch_xs, y_: batch_ys})
-        E = compute_disp(params.disp_type, W, A, B)
-        dr = np.linalg.matrix_rank(E)
-        norm_res = np.linalg.norm(E)
-        norm_W = np.linalg.norm(W)
 
     elif params.class_type == 'low_rank':
-        E = sess.run(model['W'], feed_dict={x: batch_xs, y_: batch_ys})
-
-        dr = np.linalg.matrix_rank(E)
-        norm_res = 0
-        norm_W = np.linalg.norm(E)
+        W = sess.run(model['W'], feed_dict={x: batch_xs, y_: batch_ys})
+        A, B = None, None
     elif params.class_type == 'vandermonde_like':
         v, W = sess.run([model['v'], model['W']], feed_dict={x: batch_xs, y_: batch_ys})
         A = np.diag(v)
         B = gen_Z_f(params.layer_size, 0).T
-        E = compute_disp(params.disp_type, W, A, B)
-        dr = np.linalg.matrix_rank(E)
-        norm_res = np.linalg.norm(E)
-        norm_W = np.linalg.norm(W)
     else:
         print('class_type not supported: ', params.class_type)
         assert 0 
+    return W, A, B
+
+def disp_diagnostics(W, A, B, params):
+    """
+    Displacement rank, ||E||, ||W|| and the top singular values of E and W, where E is the
+    displacement of W (E = W for low_rank).
+    The operators are applied as sparse matrices, so forming E is O(n^2); the ranks and singular
+    values are estimated by randomized SVD from O(r) products with E and W instead of dense
+    decompositions. Cheap enough to run every check_disp_freq steps, e.g. on a background thread.
+    Only the 2r + 10 largest singular values are estimated, so the returned rank is capped there:
+    capped is True when the displacement rank is at least dr rather than equal to it (e.g. for
+    unconstrained W); check_rank computes the exact rank.
+    """
+    if A is None:
+        E = W
+    else:
+        E = compute_disp(params.disp_type, W, sparse.csr_matrix(A), sparse.csr_matrix(B))
+    k = min(W.shape[0], 2*params.r + 10)
+    E_sv = randomized_singular_values(E, k)
+    W_sv = randomized_singular_values(W, k)
+    dr = numerical_rank(E_sv, E.shape)
+    capped = dr == k and k < min(E.shape)
+    norm_res = 0 if A is None else np.linalg.norm(E)
+    norm_W = np.linalg.norm(W)
+    return dr, capped, norm_res, norm_W, E_sv, W_sv
+
+def check_rank(sess, x, y_, batch_xs, batch_ys, params, model):
+    """
+    Full (dense) displacement diagnostics, including all eigenvalues of E, W, A and B.
+    O(n^3): use disp_diagnostics during training.
+    """
+    if not params.check_disp:
+        return 
+
+    operators = get_operators(sess, x, y_, batch_xs, batch_ys, params, model)
+    if operators is None:
+        return
+    W, A, B = operators
+    if A is None:
+        E = W
+        norm_res = 0
+    else:
+        E = compute_disp(params.disp_type, W, A, B)
+        norm_res = np.linalg.norm(E)
+    dr = np.linalg.matrix_rank(E)
+    norm_W = np.linalg.norm(W)
     ratio = norm_res/norm_W
     print(E.shape)
-    print(('(Displacement) Rank: ', np.linalg.matrix_rank(E)))
+    print(('(Displacement) Rank: ', dr))
     print(('||E||/||W||: ', ratio))
     eigvals_E = np.abs(np.linalg.eigvals(E))
     eigvals_W = np.abs(np.linalg.eigvals(W))
-    eigvals_A = np.abs(np.linalg.eigvals(A))
-    eigvals_B = np.abs(np.linalg.eigvals(B))
+    eigvals_A = None if A is None else np.abs(np.linalg.eigvals(A))
+    eigvals_B = None if B is None else np.abs(np.linalg.eigvals(B))
     #print('eigvals_E: ', eigvals_E)
     #print('eigvals_W: ', eigvals_W)
     #print('eigvals_A: ', eigvals_A)
     #print('eigvals_B: ', eigvals_B)
     return dr, norm_res, norm_W, eigvals_E, eigvals_W, eigvals_A, eigvals_B, E, W, A, B
 
+def dense_mult(W):
+    return lambda x: tf.matmul(x, W)
+
 def get_structured_W(params):
+    """
+    Returns W, mult, model: mult(x) computes x W. For the classes with a fast product, mult
+    never forms W, and W (None otherwise) is only built for check_disp and visualization.
+    """
     model = {}
+    need_W = params.check_disp or params.viz_freq > 0
+    W, mult = None, None
     if params.class_type == 'unconstrained':
         W = tf.Variable(tf.truncated_normal([params.layer_size, params.layer_size], stddev=params.init_stddev, dtype=tf.float64))
         if params.check_disp or params.viz_freq > 0:
             model['W'] = W
-        return W, model
+        return W, dense_mult(W), model
     elif params.class_type in ['low_rank', 'symm_tridiag_corner_pan', 'symm_tridiag_corner_krylov','symmetric', 'toeplitz_like', 
         'vandermonde_like', 'hankel_like', 'circulant_sparsity', 'tridiagonal_corner', 'tridiagonal_corners']:
         G = tf.Variable(tf.truncated_normal([params.layer_size, params.r], stddev=params.init_stddev, dtype=tf.float64))
@@ -137,7 +169,9 @@ def get_structured_W(params):
         model['G'] = G
         model['H'] = H
         if params.class_type == 'low_rank':
-            W = tf.matmul(G, tf.transpose(H))
+            mult = lambda x: tf.matmul(tf.matmul(x, G), H, transpose_b=True)
+            if need_W:
+                W = tf.matmul(G, tf.transpose(H))
         elif params.class_type == 'symm_tridiag_corner_pan':
             mask = symm_tridiag_corner_mask(n)
             A = tf.Variable(tf.truncated_normal([params.layer_size, params.layer_size], stddev=params.init_stddev, dtype=tf.float64))
@@ -146,7 +180,10 @@ def get_structured_W(params):
             A = tf.multiply(A, mask)
             B = tf.multiply(B, mask)
 
-            W = general_recon(G, H, A, B)
+            basis = sylvester_eigenbasis(A, B)
+            mult = lambda x: general_mult(G, H, basis, x)
+            if need_W:
+                W = general_recon(G, H, A, B, basis)
             if params.check_disp or params.viz_freq > 0:
                 model['A'] = A
                 model['B'] = B
@@ -198,22 +235,31 @@ def get_structured_W(params):
             B_upper = tf.matrix_band_part(B, 0, -1)
             B_symm = 0.5 * (B_upper + tf.transpose(B_upper))
 
-            W = general_recon(G, H, A_symm, B_symm)
+            basis = sylvester_eigenbasis(A_symm, B_symm)
+            mult = lambda x: general_mult(G, H, basis, x)
+            if need_W:
+                W = general_recon(G, H, A_symm, B_symm, basis)
             if params.check_disp or params.viz_freq > 0:
                 model['A'] = A_symm
                 model['B'] = B_symm
         elif params.class_type == 'toeplitz_like':
-            W = toeplitz_like_recon(G, H, params.layer_size, params.r)
+            mult = lambda x: toeplitz_like_mult(G, H, x, params.layer_size)
+            if need_W:
+                W = toeplitz_like_recon(G, H, params.layer_size, params.r)
         elif params.class_type == 'hankel_like':
             f = 0
             g = 1
-            B = gen_Z_f(params.layer_size, g)
-            W = rect_recon_tf(G, H, B, params.layer_size, params.layer_size, f, g, params.r)
+            mult = lambda x: hankel_like_mult(G, H, x, params.layer_size)
+            if need_W:
+                B = gen_Z_f(params.layer_size, g)
+                W = rect_recon_tf(G, H, B, params.layer_size, params.layer_size, f, g, params.r)
         elif params.class_type == 'vandermonde_like':
             f_V = 0
             v = tf.Variable(tf.truncated_normal([params.layer_size], stddev=params.init_stddev, dtype=tf.float64))
             model['v'] = v
-            W = vand_recon(G, H, v, params.layer_size, params.layer_size, f_V, params.r)
+            mult = lambda x: vand_mult(G, H, v, x, params.layer_size, f_V)
+            if need_W:
+                W = vand_recon(G, H, v, params.layer_size, params.layer_size, f_V, params.r)
         elif params.class_type == 'circulant_sparsity':
             x_f_A, x_f_B = get_x_f(params.layer_size, params.init_type, params.learn_corner, params.n_diag_learned, params.init_stddev)
 
@@ -233,15 +279,15 @@ def get_structured_W(params):
                 fn_A = functools.partial(circ_transpose_mult_fn, x_f_A)
                 fn_B = functools.partial(circ_transpose_mult_fn, x_f_B)
 
-            W = krylov_recon(params, G, H, fn_A, fn_B)
-
             # Compute a and b
             a = tf.reduce_prod(x_f_A)
             b = tf.reduce_prod(x_f_B)
 
             coeff = 1.0/(1 - a*b)
 
-            W = tf.scalar_mul(coeff, W)
+            mult = lambda x: tf.scalar_mul(coeff, krylov_mult(params, G, H, fn_A, fn_B, x))
+            if need_W:
+                W = tf.scalar_mul(coeff, krylov_recon(params, G, H, fn_A, fn_B))
             if params.check_disp or params.viz_freq > 0:
                 model['x_f_A'] = x_f_A
                 model['x_f_B'] = x_f_B
@@ -261,14 +307,15 @@ def get_structured_W(params):
 
             fn_A = functools.partial(tridiag_corners_transpose_mult_fn, subdiag_A, diag_A, supdiag_A, f_ur_A, f_ll_A)
             fn_B = functools.partial(tridiag_corners_transpose_mult_fn, subdiag_B, diag_B, supdiag_B, f_ur_B, f_ll_B)
-            W = krylov_recon(params, G, H, fn_A, fn_B)
             # Compute a and b
             a = tf.multiply(f_ur_A, tf.reduce_prod(subdiag_A))
             b = tf.multiply(f_ur_B, tf.reduce_prod(subdiag_B))
 
             coeff = 1.0/(1 - a*b)
 
-            W = tf.multiply(coeff, W)
+            mult = lambda x: tf.multiply(coeff, krylov_mult(params, G, H, fn_A, fn_B, x))
+            if need_W:
+                W = tf.multiply(coeff, krylov_recon(params, G, H, fn_A, fn_B))
         elif params.class_type == 'tridiagonal_corner':
             subdiag_A, supdiag_A, diag_A, subdiag_B, supdiag_B, diag_B, f_A, f_B = get_tridiag_corner_vars(params.layer_size, params.init_type, params.init_stddev, params.learn_corner)
             if params.check_disp or params.viz_freq > 0:
@@ -283,17 +330,20 @@ def get_structured_W(params):
             
             fn_A = functools.partial(tridiag_corner_transpose_mult_fn, subdiag_A, diag_A, supdiag_A, f_A)
             fn_B = functools.partial(tridiag_corner_transpose_mult_fn, subdiag_B, diag_B, supdiag_B, f_B)
-            W = krylov_recon(params, G, H, fn_A, fn_B)
             # Compute a and b
             a = tf.multiply(f_A, tf.reduce_prod(subdiag_A))
             b = tf.multiply(f_B, tf.reduce_prod(subdiag_B))
 
             coeff = 1.0/(1 - a*b)
 
-            W = tf.multiply(coeff, W)
+            mult = lambda x: tf.multiply(coeff, krylov_mult(params, G, H, fn_A, fn_B, x))
+            if need_W:
+                W = tf.multiply(coeff, krylov_recon(params, G, H, fn_A, fn_B))
+        if mult is None:
+            mult = dense_mult(W)
         if params.check_disp or params.viz_freq > 0:
             model['W'] = W
-        return W, model
+        return W, mult, model
 
 
     else:
@@ -301,21 +351,22 @@ def get_structured_W(params):
         assert 0    
 
 def forward(x, params):
-    W, model = get_structured_W(params)
-    y = compute_y(x, W, params)
+    W, mult, model = get_structured_W(params)
+    y = compute_y(x, mult, params)
     return y, model
 
-def compute_y(x, W1, params):
+# mult1: function x -> x W1
+def compute_y(x, mult1, params):
     if 'cnn' in params.transform:
-        return compute_y_cnn(x, W1, params)
+        return compute_y_cnn(x, mult1, params)
     elif params.num_layers==0:
-        y = tf.matmul(x, W1,name='forward')
+        y = tf.identity(mult1(x), name='forward')
         return y
     elif params.num_layers==1:
         b1 = tf.Variable(tf.truncated_normal([params.layer_size], stddev=params.init_stddev, dtype=tf.float64))
         W2 = tf.Variable(tf.truncated_normal([params.layer_size, params.out_size], stddev=params.init_stddev, dtype=tf.float64))
         b2 = tf.Variable(tf.truncated_normal([params.out_size], stddev=params.init_stddev, dtype=tf.float64))
-        xW = tf.matmul(x, W1)
+        xW = mult1(x)
 
         h = tf.nn.relu(xW + b1)
         prod = tf.matmul(h, W2)
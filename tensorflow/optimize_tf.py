@@ -9,6 +9,7 @@ from visualize import visualize
 from model import *
 import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 def restore_from_checkpoint(dataset, params, sess, saver, x, y_, loss, accuracy):
     # Restore the best validation checkpoint, test on that
@@ -48,8 +49,25 @@ def optimize_tf(dataset, params):
         val_loss,val_accuracy = restore_from_checkpoint(dataset,params,sess,saver,x,y_,loss,accuracy)
 
     eigvals = {'E': [], 'W': [], 'A': [], 'B': []}
+    singvals = {'E': [], 'W': []}
     model_params = {'E': [], 'W': [], 'A': [], 'B': []}
-    losses = {'train': [], 'val': [], 'DR': [], 'ratio': [], 'eigvals': eigvals, 'params': model_params}
+    losses = {'train': [], 'val': [], 'DR': [], 'ratio': [], 'norm_res': [], 'norm_W': [], 'eigvals': eigvals,
+        'singvals': singvals, 'params': model_params}
+
+    # Displacement diagnostics run on a background thread (numpy releases the GIL), in order
+    disp_executor = ThreadPoolExecutor(max_workers=1)
+    disp_pending = []
+    def record_disp(wait=False):
+        while disp_pending and (wait or disp_pending[0].done()):
+            dr, capped, norm_res, norm_W, E_sv, W_sv = disp_pending.pop(0).result()
+            losses['DR'].append(dr)
+            losses['norm_res'].append(norm_res)
+            losses['norm_W'].append(norm_W)
+            losses['ratio'].append(norm_res/norm_W)
+            losses['singvals']['E'].append(E_sv)
+            losses['singvals']['W'].append(W_sv)
+            # A capped rank is only a lower bound, logged as '>= dr'
+            logging.debug('(Displacement) rank, ||E||/||W||: %s%d, %f' % ('>=' if capped else '', dr, norm_res/norm_W))
     accuracies = {'train': [], 'val': [], 'best_val': 0.0, 'best_val_iter': 0}
     t1 = time.time()
     for _ in range(params.steps):
@@ -63,14 +81,10 @@ def optimize_tf(dataset, params):
             logging.debug('Training step: ' + str(this_step))
             # Verify displacement rank
             if params.check_disp and this_step % params.check_disp_freq == 0:
-                dr, norm_res, norm_W, E_ev, W_ev, A_ev, B_ev = check_rank(sess, x, y_, batch_xs, batch_ys, params, model)
-                losses['DR'].append(dr)
-                losses['norm_res'].append(norm_res)
-                losses['norm_W'].append(norm_W)
-                losses['eigvals']['E'].append(E_ev)
-                losses['eigvals']['W'].append(W_ev)
-                losses['eigvals']['A'].append(A_ev)
-                losses['eigvals']['B'].append(B_ev)
+                operators = get_operators(sess, x, y_, batch_xs, batch_ys, params, model)
+                if operators is not None:
+                    disp_pending.append(disp_executor.submit(disp_diagnostics, *operators, params))
+            record_disp()
             train_loss, train_accuracy, train_loss_summ, train_acc_summ, y_pred = sess.run([loss, accuracy, train_loss_summary,
                 train_acc_summary, y], feed_dict={x: batch_xs, y_: batch_ys})
             val_loss, val_accuracy, val_loss_summ, val_acc_summ = sess.run([loss, accuracy, val_loss_summary,
@@ -113,12 +127,20 @@ def optimize_tf(dataset, params):
         if this_step > 0 and params.viz_freq > 0 and this_step % params.viz_freq == 0:
             visualize(params,sess,model,x,y_,batch_xs,batch_ys,y_pred,this_step)
 
+    record_disp(wait=True)
+    disp_executor.shutdown()
+
     # Get final params
-    if params.check_disp:
-        dr, norm_res, norm_W, E_ev, W_ev, A_ev, B_ev, E, W, A, B = check_rank(sess, x, y_, batch_xs, batch_ys, params, model)
+    disp = check_rank(sess, x, y_, batch_xs, batch_ys, params, model)
+    if disp is not None:
+        dr, norm_res, norm_W, E_ev, W_ev, A_ev, B_ev, E, W, A, B = disp
         losses['DR'].append(dr)
         losses['norm_res'].append(norm_res)
         losses['norm_W'].append(norm_W)
+        losses['eigvals']['E'].append(E_ev)
+        losses['eigvals']['W'].append(W_ev)
+        losses['eigvals']['A'].append(A_ev)
+        losses['eigvals']['B'].append(B_ev)
         losses['params']['E'] = E
         losses['params']['W'] = W
         losses['params']['A'] = A
@@ -5,38 +5,37 @@ from scipy.linalg import solve_sylvester
 import time
 from krylov import *
 
-def eigendecomp(A):
-    d, P = tf.self_adjoint_eig(A)
-
-    return P, tf.diag(d), tf.matrix_inverse(P)
-
-def general_recon(G, H, A, B):
-    P,D_A, Pinv = eigendecomp(A)
-    Q, D_B, Qinv = eigendecomp(B)
-
-  #sess = tf.InteractiveSession()
-  #tf.initialize_all_variables().run()
-
-    eig_A = tf.diag_part(D_A)
-    eig_B = tf.diag_part(D_B)
-
-    eig_A_reshaped = tf.reshape(eig_A, [-1, 1])
-
-
-    diff = eig_A_reshaped - eig_B
-    C = 1.0/diff
-
-    E = tf.matmul(G, tf.transpose(H))
-
-    term = tf.matmul(Pinv, tf.matmul(E, Q))
-    term = tf.multiply(term, C) # Elementwise
-    W = tf.matmul(P, tf.matmul(term, Qinv))
-
-  #print 'W: ', sess.run(W)
-  #print 'Q: ', sess.run(Q)
-  #quit()
-
-    return W
+# Solution of A W - W B = G H^T for symmetric A, B in their eigenbases: W = P (C o P^T G H^T Q) Q^T,
+# with C_ij = 1/(eig_A_i - eig_B_j). Returns (P, Q, C); pass it to general_recon and general_mult
+# to share one decomposition between them.
+# The operators of every caller (symmetric and pan classes) are learned, so both are decomposed
+# on every step: O(n^3) per step. Given (P, Q, C), the products themselves cost O(n^2 r).
+def sylvester_eigenbasis(A, B):
+    eig_A, P = tf.self_adjoint_eig(A)
+    eig_B, Q = tf.self_adjoint_eig(B)
+    C = 1.0/(tf.reshape(eig_A, [-1, 1]) - eig_B)
+
+    return P, Q, C
+
+def _eigenbasis_term(G, H, basis):
+    P, Q, C = basis
+    # P^T G H^T Q without forming G H^T: O(n^2 r)
+    return tf.multiply(tf.matmul(tf.matmul(P, G, transpose_a=True), tf.matmul(Q, H, transpose_a=True), transpose_b=True), C)
+
+def general_recon(G, H, A, B, basis=None):
+    if basis is None:
+        basis = sylvester_eigenbasis(A, B)
+    P, Q, _ = basis
+    term = _eigenbasis_term(G, H, basis)
+
+    return tf.matmul(P, tf.matmul(term, Q, transpose_b=True))
+
+# x W for W = general_recon(G, H, A, B, basis), without forming W
+def general_mult(G, H, basis, x):
+    P, Q, _ = basis
+    term = _eigenbasis_term(G, H, basis)
+
+    return tf.matmul(tf.matmul(tf.matmul(x, P), term), Q, transpose_b=True)
 
 def krylov_recon_params(layer_size, r, flip_K_B, G,H,fn_A,fn_B):
     W1 = tf.zeros([layer_size, layer_size], dtype=tf.float64)
@@ -230,6 +229,70 @@ def vand_recon(G, H, v, m, n, f, r):
 
     return recon
 
+##### Matrix-free products x W, with x of shape (batch_size, n), for the reconstructions above.
+# Z_f(v) denotes the f-circulant matrix with first column v (= Krylov(Z_f, v), circulant_tf with an f mask).
+# G and H are (n, r), as in the reconstructions.
+
+def _eta(f, n):
+    # The DFT diagonalizes Z_f after scaling by diag(eta), eta^n = f
+    return tf.constant(np.power(complex(f), np.arange(n) / n), dtype=tf.complex128)
+
+def _complex(x):
+    return tf.cast(x, tf.complex128)
+
+def _pad(x):
+    return tf.concat([x, tf.zeros_like(x)], axis=-1)
+
+# Z_f(v) w along the last axis, in O(n log n). v and w broadcast against each other.
+def f_circulant_mult(v, w, f, n):
+    if f != 0:
+        eta = _eta(f, n)
+        return tf.real(tf.ifft(tf.fft(eta * _complex(v)) * tf.fft(eta * _complex(w))) / eta)
+    # Lower triangular Toeplitz: linear convolution
+    prod = tf.ifft(tf.fft(_complex(_pad(v))) * tf.fft(_complex(_pad(w))))
+    return tf.real(prod)[..., :n]
+
+# Z_f(v)^T u along the last axis, in O(n log n).
+def f_circulant_transpose_mult(v, u, f, n):
+    if f != 0:
+        eta = _eta(f, n)
+        return tf.real(eta * tf.fft(tf.ifft(_complex(u) / eta) * tf.fft(eta * _complex(v))))
+    prod = tf.ifft(tf.fft(_complex(_pad(tf.reverse(u, [-1])))) * tf.fft(_complex(_pad(v))))
+    return tf.reverse(tf.real(prod)[..., :n], [-1])
+
+# x W for W = toeplitz_like_recon(G, H, n, r)
+def toeplitz_like_mult(G, H, x, n):
+    u = f_circulant_transpose_mult(tf.transpose(G), tf.expand_dims(x, 1), 1, n)
+    y = f_circulant_transpose_mult(tf.reverse(tf.transpose(H), [1]), u, -1, n)
+    return 0.5 * tf.reduce_sum(y, 1)
+
+# x W for the hankel_like W = rect_recon_tf(G, H, Z_1, n, n, 0, 1, r)
+def hankel_like_mult(G, H, x, n):
+    u = f_circulant_transpose_mult(tf.transpose(G), tf.expand_dims(x, 1), 0, n)
+    y = f_circulant_mult(tf.reverse(tf.transpose(H), [1]), u, 1, n)
+    return tf.reverse(tf.reduce_sum(y, 1), [1])
+
+# x W for W = vand_recon(G, H, v, n, n, f, r)
+def vand_mult(G, H, v, x, n, f):
+    D = 1.0/(1 - f*tf.pow(v, n))
+    V = tf.pow(tf.expand_dims(v, 1), tf.range(n, dtype=tf.float64))
+    xDG = tf.expand_dims(x*D, 1) * tf.expand_dims(tf.transpose(G), 0)
+    u = tf.reshape(tf.matmul(tf.reshape(xDG, [-1, n]), V), tf.shape(xDG))
+    return tf.reduce_sum(f_circulant_mult(tf.transpose(H), u, f, n), 1)
+
+# x W for W = krylov_recon(params, G, H, fn_A, fn_B).
+# The Krylov matrices of general (tridiagonal, circulant sparsity) operators have no FFT form;
+# they are applied by recurrence, one operator product at a time, and neither they nor W are formed:
+# O(r n^2) time and O(n) memory per example instead of the O(r n^3) reconstruction.
+def krylov_mult(params, G, H, fn_A, fn_B, x):
+    y = tf.zeros_like(x)
+    for i in range(params.r):
+        u = krylov_left_mult(fn_A, G[:, i], x, params.layer_size)
+        if params.flip_K_B:
+            u = tf.reverse(u, [1])
+        y = tf.add(y, krylov_right_mult(fn_B, H[:, i], u, params.layer_size))
+    return y
+
 def sylvester(M, N, n, r):
   # Generate random rank r error matrix
     G = np.random.random((n, r))
@@ -0,0 +1,84 @@
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import functools
+from types import SimpleNamespace
+import numpy as np
+import tensorflow as tf
+from reconstruction import (f_circulant_mult, f_circulant_transpose_mult, toeplitz_like_mult, toeplitz_like_recon,
+	hankel_like_mult, rect_recon_tf, vand_mult, vand_recon, krylov_mult, krylov_recon)
+from utils import gen_Z_f
+from krylov import circ_transpose_mult_fn, tridiag_corner_transpose_mult_fn
+
+# Checks that every matrix-free product x W equals x times the dense reconstruction of W
+
+n, r, batch_size = 8, 2, 3
+
+def run(*tensors):
+	with tf.Session() as sess:
+		return sess.run(tensors)
+
+def random_inputs(seed=0):
+	np.random.seed(seed)
+	G = tf.constant(np.random.randn(n, r))
+	H = tf.constant(np.random.randn(n, r))
+	x = tf.constant(np.random.randn(batch_size, n))
+	return G, H, x
+
+def assert_mult(mult, W, x, params=()):
+	y, W_val, x_val = run(mult, W, x)
+	np.testing.assert_allclose(y, x_val @ W_val, rtol=1e-8, atol=1e-8)
+	# Gradients with respect to params, e.g. through the loops of krylov_mult
+	if params:
+		c = tf.constant(np.random.randn(batch_size, n))
+		grads = run(*tf.gradients(tf.reduce_sum(mult * c), params))
+		grads_W = run(*tf.gradients(tf.reduce_sum(tf.matmul(x, W) * c), params))
+		for grad, grad_W in zip(grads, grads_W):
+			np.testing.assert_allclose(grad, grad_W, rtol=1e-8, atol=1e-8)
+
+def test_f_circulant_mult():
+	for f in [0, 1, -1]:
+		v, w = np.random.randn(n), np.random.randn(batch_size, n)
+		# Z_f(v) = Krylov(Z_f, v)
+		Z = np.stack([np.linalg.matrix_power(gen_Z_f(n, f), k) @ v for k in range(n)], axis=1)
+		y, y_T = run(f_circulant_mult(tf.constant(v), tf.constant(w), f, n),
+					 f_circulant_transpose_mult(tf.constant(v), tf.constant(w), f, n))
+		np.testing.assert_allclose(y, w @ Z.T, rtol=1e-8, atol=1e-8)
+		np.testing.assert_allclose(y_T, w @ Z, rtol=1e-8, atol=1e-8)
+
+def test_toeplitz_like_mult():
+	G, H, x = random_inputs()
+	assert_mult(toeplitz_like_mult(G, H, x, n), toeplitz_like_recon(G, H, n, r), x)
+
+def test_hankel_like_mult():
+	G, H, x = random_inputs()
+	assert_mult(hankel_like_mult(G, H, x, n), rect_recon_tf(G, H, gen_Z_f(n, 1), n, n, 0, 1, r), x)
+
+def test_vand_mult():
+	G, H, x = random_inputs()
+	v = tf.constant(0.9*np.random.rand(n))
+	for f in [0, 1, -1]:
+		assert_mult(vand_mult(G, H, v, x, n, f), vand_recon(G, H, v, n, n, f, r), x)
+
+def test_krylov_mult():
+	G, H, x = random_inputs()
+	subdiag, diag, supdiag = (tf.constant(0.5*np.random.randn(k)) for k in [n-1, n, n-1])
+	for flip_K_B in [False, True]:
+		params = SimpleNamespace(layer_size=n, r=r, flip_K_B=flip_K_B)
+		for f in [0, 1, -1]:
+			# circulant_sparsity
+			v_f = tf.constant(np.append(np.random.randn(n-1), f))
+			fn = functools.partial(circ_transpose_mult_fn, v_f)
+			assert_mult(krylov_mult(params, G, H, fn, fn, x), krylov_recon(params, G, H, fn, fn), x, [G, H, v_f])
+			# tridiagonal_corner
+			fn = functools.partial(tridiag_corner_transpose_mult_fn, subdiag, diag, supdiag, tf.constant([float(f)], dtype=tf.float64))
+			assert_mult(krylov_mult(params, G, H, fn, fn, x), krylov_recon(params, G, H, fn, fn), x, [G, H, subdiag, diag])
+
+def run_tests():
+	test_f_circulant_mult()
+	test_toeplitz_like_mult()
+	test_hankel_like_mult()
+	test_vand_mult()
+	test_krylov_mult()
+
+if __name__ == '__main__':
+	run_tests()
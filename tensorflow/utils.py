@@ -29,11 +29,12 @@ def symm_tridiag_corner_mask(n):
 
   return mask
 
+# A and B may also be scipy.sparse matrices
 def sylvester_disp(M, A, B):
-  return np.dot(A,M) - np.dot(M,B)
+  return A @ M - M @ B
 
 def stein_disp(M, A, B):
-  return M - np.dot(A,np.dot(M,B))
+  return M - A @ (M @ B)
 
 def compute_disp(disp_type, M, A, B):
   if disp_type == 'sylvester':
@@ -44,6 +45,27 @@ def compute_disp(disp_type, M, A, B):
     print('disp_type not supported: ', disp_type)
     assert 0    
 
+def randomized_singular_values(M, k, n_oversamples=10, n_iter=2):
+  """
+  Estimates of the k largest singular values of M from products of M and M^T with k + n_oversamples
+  vectors (randomized range finder with power iterations, Halko et al. 2011). O(n^2 k) instead of O(n^3).
+  """
+  Q = np.random.randn(M.shape[1], min(k + n_oversamples, min(M.shape)))
+  Q, _ = np.linalg.qr(M @ Q)
+  for _ in range(n_iter):
+    Q, _ = np.linalg.qr(M.T @ Q)
+    Q, _ = np.linalg.qr(M @ Q)
+  # M ~ Q Q^T M, whose singular values are those of Q^T M
+  return np.linalg.svd(Q.T @ M, compute_uv=False)[:k]
+
+def numerical_rank(singular_values, shape):
+  """
+  Rank from singular values, with the default tolerance of np.linalg.matrix_rank.
+  From randomized_singular_values(M, k), ranks of k or more are reported as k.
+  """
+  tol = singular_values.max() * max(shape) * np.finfo(singular_values.dtype).eps
+  return int(np.sum(singular_values > tol))
+
 def gen_tridiag_corner_transpose(subdiag,supdiag,diag,f):
   T = diags([subdiag, diag, supdiag], [-1, 0, 1]).toarray()
   T[-1, 0] = f
@@ -211,7 +233,8 @@ def compute_loss_and_accuracy(y, y_, params):
     print('Not supported: ', params.loss)
     assert 0
 
-def compute_y_cnn(x, W1, params):
+# mult1: function x -> x W1
+def compute_y_cnn(x, mult1, params):
   if params.dataset_name == 'cifar10' and 'grayscale' not in params.transform:
     input_layer = tf.reshape(x, [-1, 32, 32, 3])
   else:
@@ -245,7 +268,7 @@ def compute_y_cnn(x, W1, params):
 
     print('pool2_flat: ', pool2_flat)
 
-    dense = tf.nn.relu(tf.matmul(pool2_flat, W1))
+    dense = tf.nn.relu(mult1(pool2_flat))
   else:
     # Convolutional Layer #2 and Pooling Layer #2
     conv2 = tf.layers.conv2d(
@@ -268,7 +291,7 @@ def compute_y_cnn(x, W1, params):
 
     print('pool2_flat: ', pool2_flat)
 
-    dense = tf.nn.relu(tf.matmul(pool2_flat, W1))
+    dense = tf.nn.relu(mult1(pool2_flat))
 
   print('dense ', dense)
   #dense = tf.layers.dense(inputs=pool3_flat, units=1024, activation=tf.nn.relu)
@@ -660,21 +683,20 @@ def krylov_circ_transpose(n, x, v, num_learned, f_mask, scaling_mask, index_arr)
   # Elementwise multiplication by scale_term
   return tf.multiply(scale_term, JZ)
 
+# Krylov matrix [v, Av, ..., A^{n-1} v] of a dense A, by doubling: [K, A^{2^k} K] has twice the columns
+# of K = [v, ..., A^{2^k - 1} v]. O(log n) matrix products instead of a product per column.
 def krylov_tf(A, v, n):
-  v_exp = tf.expand_dims(v,1)
-  cols = [v_exp]
+  K = tf.expand_dims(v,1)
   this_pow = A
+  n_cols = 1
 
-  for i in range(n-1):
-    this_col = tf.matmul(this_pow, v_exp)
-
-    this_pow = tf.matmul(A, this_pow)
+  while n_cols < n:
+    K = tf.concat([K, tf.matmul(this_pow, K)], axis=1)
+    n_cols *= 2
+    if n_cols < n:
+      this_pow = tf.matmul(this_pow, this_pow)
 
-    cols.append(this_col)
-
-    K = tf.stack(cols)
-
-  return tf.transpose(tf.squeeze(K))
+  return K[:, :n]
 
 def Ax_circ(f_v, x, n):
   # Circular shift x to the right
@@ -684,18 +706,10 @@ def Ax_circ(f_v, x, n):
   return tf.multiply(y, f_v)
 
 def krylov_tf_circ(f_x, v, n):
-  v_exp = tf.expand_dims(v,1)
-  cols = [v_exp]
-  this_col = v
-
-  for i in range(n-1):
-    this_col = Ax_circ(f_x, this_col, n)
-
-    cols.append(tf.expand_dims(this_col,1))
-
-  K = tf.stack(cols)
+  cols = tf.scan(lambda col, _: Ax_circ(f_x, col, n), tf.range(n-1), initializer=v)
+  K = tf.concat([tf.expand_dims(v, 0), cols], axis=0)
 
-  return tf.transpose(tf.squeeze(K))
+  return tf.transpose(K)
 
 def V_mn(v, m, n):
   # Stack columns